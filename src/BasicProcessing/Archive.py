@@ -0,0 +1,52 @@
+'''
+Packs Unispec files into a season archive (see :class:`~BasicProcessing.SpuArchive`).
+
+Run with "python Archive.py ARCHIVE SOURCE [SOURCE ...]".  Every .spu file
+below each SOURCE directory is appended to ARCHIVE under its path relative to
+SOURCE; files already in the archive are skipped, so the command can be re-run
+as new days are collected.  Set "Archive = ARCHIVE" in the [Input] section of
+config.txt to process from the archive.
+'''
+from BasicProcessing import SpuArchive
+import argparse
+import os.path
+import time
+
+
+def ListSpu(source_path):
+    """
+    Returns all non-empty .spu files below a directory, relative to it and sorted.
+
+    :param source_path: Directory to search
+    :type source_path: String
+    :rtype: List of Strings
+
+    """
+    flist = []
+    for root, dirs, files in os.walk(source_path):
+        for file in files:
+            if file.endswith(".spu") and os.path.getsize(os.path.join(root, file)) > 0:
+                flist.append(os.path.relpath(os.path.join(root, file), source_path))
+    flist.sort()
+    return flist
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Append Unispec files to a season archive.")
+    parser.add_argument("archive", help="archive file, created if it does not exist")
+    parser.add_argument("sources", nargs="+", help="directories of .spu files")
+    parser.add_argument("--headerlen", type=int, default=10, metavar="LINES",
+                        help="header length of the files, as HeaderLines in config.txt")
+    args = parser.parse_args(argv)
+
+    for source_path in args.sources:
+        start = time.perf_counter()
+        flist = ListSpu(source_path)
+        added, skipped = SpuArchive.Ingest(args.archive, source_path, flist, args.headerlen)
+        print("Added " + str(added) + " of " + str(len(flist)) + " files from " + source_path + " in " + "%.2f" % (time.perf_counter() - start) + " s.")
+        for file in skipped:
+            print("\tSkipped " + file + " (unexpected size)")
+
+
+if __name__ == "__main__":
+    main()
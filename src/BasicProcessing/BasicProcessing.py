@@ -5,21 +5,22 @@ Created on Aug 4, 2015
 '''
 
 import os.path
+import ast
 import configparser
-import sys
+import contextlib
+import functools
+import hashlib
+import json
+import re
+import struct
+import time
+from collections import deque
 
 import numpy as np
-from scipy import interpolate
 from math import floor, ceil, log10
 
-import matplotlib.pyplot as plt
-
-
-# Hard-coded paths - TO BE REMOVED
-sys.path.append('C:\Python34')
-sys.path.append('C:\Python34\Lib')
-sys.path.append('C:\Python34\DLLs')
-sys.path.append('C:\Python34\Lib\site-packages')
+#Optional or rarely needed modules are imported where they are used, so processing does not pay for loading them:
+#    matplotlib (plotting), scipy (sensor bands), h5py (HDF5 output), sqlite3 (catalog), concurrent.futures (prefetch)
 
 class consts:
     """Class of constants to make understanding various lists/arrays simpler."""
@@ -32,8 +33,16 @@ class consts:
     CH_A_WL = 2
     CH_A = 3 
     
-    WL_Lims = 2
+    remarks = 0
     datetime = 1
+    WL_Lims = 2
+    environment = 3
+    minimum = 4
+    maximum = 5
+    integration = 6
+    scans = 7
+    GPS = 8
+    station = 9
     
     CH_B_WL_Start = 0
     CH_B_WL_End = 1
@@ -46,7 +55,1313 @@ class consts:
     int_WL = 0
     int_CH_B = 1
     int_CH_A = 2
-    
+
+
+class SpectralRun:
+    """Container for a run (or any group of files) holding all spectra in one contiguous array.
+
+    Indexing a run returns *[header, data]* for a single file, so it can be used anywhere the nested list from :func:`~BasicProcessing.UnispecProcessing.ReadFiles` is expected.
+
+    """
+
+    #: File names, indexed as *[file index]*
+    files = []
+    #: Header lines, indexed as *[file index][line]*
+    headers = []
+    #: Spectra indexed as *[file index, row index,* :const:`~BasicProcessing.consts.CH_B_WL` / :const:`~BasicProcessing.consts.CH_B` / :const:`~BasicProcessing.consts.CH_A_WL` / :const:`~BasicProcessing.consts.CH_A` *]*
+    data = np.zeros((0, 0, 4))
+    #: Wavelength limits indexed as *[file index,* :const:`~BasicProcessing.consts.CH_B_WL_Start` / :const:`~BasicProcessing.consts.CH_B_WL_End` / :const:`~BasicProcessing.consts.CH_A_WL_Start` / :const:`~BasicProcessing.consts.CH_A_WL_End` *]*
+    limits = np.zeros((0, 4))
+    #: Date and time of each file indexed as *[file index][*:const:`~BasicProcessing.consts.date` / :const:`~BasicProcessing.consts.time` *]*
+    datetime = []
+    #: Parsed header of each file (see :data:`~BasicProcessing.SpectralRun.HeaderType`), indexed as *[file index]* or by field name for a column
+    fields = None
+    #: Dark level subtracted by :func:`~BasicProcessing.UnispecProcessing.Normalize` (*none* until normalized)
+    dark = "none"
+
+    #: Fields of a parsed header.  Values missing from a header are NaN (floats), NaT (time) or -1 (integers).
+    #:
+    #: * *remarks*: Remarks line
+    #: * *time*: Date and time the file was recorded
+    #: * *limits*: Wavelength limits indexed as :const:`~BasicProcessing.consts.CH_B_WL_Start` / :const:`~BasicProcessing.consts.CH_B_WL_End` / :const:`~BasicProcessing.consts.CH_A_WL_Start` / :const:`~BasicProcessing.consts.CH_A_WL_End`
+    #: * *temperature*, *battery*: Environment line, in degrees C and V
+    #: * *aux*: A1 - A4 of the environment line
+    #: * *minimum*, *maximum*: Wavelength and counts of the minimum / maximum, indexed as :const:`~BasicProcessing.consts.CH_B_WL` / :const:`~BasicProcessing.consts.CH_B` / :const:`~BasicProcessing.consts.CH_A_WL` / :const:`~BasicProcessing.consts.CH_A`
+    #: * *integration*: Integration time in ms
+    #: * *scans*: Number of scans
+    #: * *lat*, *lon*, *alt*, *gps_updated*: GPS line
+    #: * *station*: Station number
+    HeaderType = np.dtype([("remarks", "U128"), ("time", "datetime64[s]"), ("limits", "f8", (4,)),
+                           ("temperature", "f8"), ("battery", "f8"), ("aux", "i4", (4,)),
+                           ("minimum", "f8", (4,)), ("maximum", "f8", (4,)),
+                           ("integration", "f8"), ("scans", "i4"),
+                           ("lat", "f8"), ("lon", "f8"), ("alt", "f8"), ("gps_updated", "U32"), ("station", "i4")])
+
+    #: Patterns of the header lines, in file order
+    HeaderLines = [
+        r'"Remarks:\s*(?P<remarks>[^"\n]*)"',
+        r'"Time:\s*(?P<date>\d{4}-\d{2}-\d{2})\s+(?P<clock>\d{2}:\d{2}:\d{2})"',
+        r'"Limits_Ch_A:\s*(?P<a_start>\S+)\s+-\s+(?P<a_end>\S+)\s+Limits_Ch_B:\s*(?P<b_start>\S+)\s+-\s+(?P<b_end>[^\s"]+)"',
+        r'"Environment:\s*DegreesC=(?P<temperature>\S+)\s+BattV=(?P<battery>\S+)\s+A1=(?P<a1>\S+)\s+A2=(?P<a2>\S+)\s+A3=(?P<a3>\S+)\s+A4=(?P<a4>[^\s"]+)"',
+        r'"Minimum CH A:\s*(?P<min_a_wl>[^\s"]+?)nm\s+(?P<min_a>\S+)\s+Minimum CH B:\s*(?P<min_b_wl>[^\s"]+?)nm\s+(?P<min_b>[^\s"]+)"',
+        r'"Maximum CH A:\s*(?P<max_a_wl>[^\s"]+?)nm\s+(?P<max_a>\S+)\s+Maximum CH B:\s*(?P<max_b_wl>[^\s"]+?)nm\s+(?P<max_b>[^\s"]+)"',
+        r'"Integration:\s*(?P<integration>[^\s"]+)\s*ms"',
+        r'"Number Scans:\s*(?P<scans>[^\s"]+)"',
+        r'"GPS:\s*LAT=\s*(?P<lat>\S+)\s+LON=\s*(?P<lon>\S+)\s+ALT=\s*(?P<alt>\S+)\s+Updated=\s*(?P<gps_updated>[^"\n]*?)\s*"',
+        r'"Station#:\s*(?P<station>[^\s"]+)"']
+    #: Matches a complete header in one go
+    HeaderPattern = re.compile("\n".join(HeaderLines))
+    #: Matches any header line, setting the groups of that line only (used for incomplete or reordered headers)
+    HeaderLinePattern = re.compile("|".join(HeaderLines))
+
+
+    def __init__(self, files, headers, data, fields=None):
+        """Builds the run and parses the header table.
+
+        :param files: File names
+        :type files: List of Strings
+        :param headers: Header lines for each file
+        :type headers: Nested list of Strings
+        :param data: Spectra for each file
+        :type data: [file, row, column] Array of Floats
+        :param fields: Parsed headers, if already known (as returned from :func:`~BasicProcessing.SpectralRun.ParseHeaders`)
+        :type fields: Structured array
+
+        """
+
+        self.files = list(files)
+        self.headers = list(headers)
+        self.data = data
+        self.fields = SpectralRun.ParseHeaders(self.headers) if fields is None else fields
+        self.limits = self.fields["limits"].copy()
+        self.datetime = [str(dt).split("T") for dt in self.fields["time"]]
+
+
+    @staticmethod
+    def ParseHeaders(headers):
+        """Parses the header lines of many files into a structured array.
+
+        :param headers: Header lines for each file
+        :type headers: Nested list of Strings
+        :returns: One record per file
+        :rtype: Structured array of :data:`~BasicProcessing.SpectralRun.HeaderType`
+
+        """
+
+        def column(values, default=np.nan):
+#            Converts a whole column at once, falling back to one value at a time if some are missing or not numbers
+            if None not in values:
+                try:
+                    return np.array(values, dtype=np.float64)
+                except ValueError:
+                    pass
+            out = np.full(len(values), default, dtype=np.float64)
+            for i, value in enumerate(values):
+                try:
+                    out[i] = float(value)
+                except (TypeError, ValueError):
+                    pass
+            return out
+
+        parsed = []
+        for header in headers:
+            text = "".join(header)
+            match = SpectralRun.HeaderPattern.match(text)
+            if match is not None:
+                parsed.append(match.groupdict())
+            else:
+                h = {}
+                for match in SpectralRun.HeaderLinePattern.finditer(text):
+                    h.update((k, v) for k, v in match.groupdict().items() if v is not None)
+                parsed.append(h)
+
+        fields = np.empty(len(headers), dtype=SpectralRun.HeaderType)
+        fields["remarks"] = [h.get("remarks") or "" for h in parsed]
+        fields["time"] = [h["date"] + "T" + h["clock"] if h.get("date") else "NaT" for h in parsed]
+        for name, keys, default in [("limits", ("b_start", "b_end", "a_start", "a_end"), np.nan),
+                                    ("aux", ("a1", "a2", "a3", "a4"), -1),
+                                    ("minimum", ("min_b_wl", "min_b", "min_a_wl", "min_a"), np.nan),
+                                    ("maximum", ("max_b_wl", "max_b", "max_a_wl", "max_a"), np.nan)]:
+            for k_idx, key in enumerate(keys):
+                fields[name][:, k_idx] = column([h.get(key) for h in parsed], default)
+        for name, default in [("temperature", np.nan), ("battery", np.nan), ("integration", np.nan), ("scans", -1),
+                              ("lat", np.nan), ("lon", np.nan), ("alt", np.nan), ("station", -1)]:
+            fields[name] = column([h.get(name) for h in parsed], default)
+        fields["gps_updated"] = [h.get("gps_updated") or "" for h in parsed]
+        return fields
+
+
+    @classmethod
+    def from_list(cls, data, files=None):
+        """Creates a run from the nested list returned by :func:`~BasicProcessing.UnispecProcessing.ReadFiles`.
+
+        Files with fewer rows than the longest file are padded with rows that have a wavelength of -1 so they are ignored when interpolating.
+
+        :param data: List of full run data
+        :type data: Nested list
+        :param files: File names, if known
+        :type files: List of Strings
+        :returns: Run containing the same data
+        :rtype: :class:`~BasicProcessing.SpectralRun`
+
+        """
+
+        spectra = [np.asarray(d[consts.data], dtype=np.float64) for d in data]
+        rows = max([len(s) for s in spectra] + [0])
+        if all(len(s) == rows for s in spectra) and len(spectra) > 0:
+            cube = np.stack(spectra)
+        else:
+            cube = np.zeros((len(spectra), rows, 4))
+            cube[:, :, [consts.CH_B_WL, consts.CH_A_WL]] = -1
+            for f_idx, s in enumerate(spectra):
+                cube[f_idx, :len(s)] = s
+
+        if files is None:
+            files = [""] * len(data)
+        return cls(files, [d[consts.header] for d in data], cube)
+
+
+    def select(self, keep):
+        """Returns a new run with only the files selected by **keep**.
+
+        :param keep: Boolean mask or indices of files to keep
+        :type keep: Array
+        :returns: Reduced run
+        :rtype: :class:`~BasicProcessing.SpectralRun`
+
+        """
+
+        idx = np.arange(len(self))[keep]
+        run = SpectralRun([self.files[i] for i in idx], [self.headers[i] for i in idx], self.data[idx], self.fields[idx])
+        run.dark = self.dark
+        return run
+
+
+    def __len__(self):
+        return len(self.headers)
+
+
+    def __getitem__(self, idx):
+        return [self.headers[idx], self.data[idx]]
+
+
+    def __iter__(self):
+        for f_idx in range(0, len(self)):
+            yield self[f_idx]
+
+
+class CompactRun(SpectralRun):
+    """Run holding raw counts as 16 bit integers and each distinct wavelength calibration once, rather than a float64 array with the wavelengths of every file.
+
+    This uses less than a third of the memory of a :class:`~BasicProcessing.SpectralRun` with the same files.  :data:`~BasicProcessing.CompactRun.data` is rebuilt in the full layout when accessed, so methods that do not use the compact arrays still work, at the cost of a full-size copy.
+
+    """
+
+    #: Counts indexed as *[file index, row index, Ch B(0) / Ch A(1)]*, uint16 as read (float32 once normalized)
+    counts = np.zeros((0, 0, 2), dtype=np.uint16)
+    #: Distinct wavelength axes indexed as *[axis, row index, Ch B(0) / Ch A(1)]*
+    axes = np.zeros((0, 0, 2))
+    #: Axis of each file, indexed as *[file index]*
+    axis = np.zeros(0, dtype=np.intp)
+
+
+    def __init__(self, files, headers, counts, axes, axis, fields=None):
+        """Builds the run and parses the header table.
+
+        :param files: File names
+        :type files: List of Strings
+        :param headers: Header lines for each file
+        :type headers: Nested list of Strings
+        :param counts: Counts for each file
+        :type counts: [file, row, Ch B / Ch A] Array of uint16 or Floats
+        :param axes: Distinct wavelength axes
+        :type axes: [axis, row, Ch B / Ch A] Array of Floats
+        :param axis: Axis of each file
+        :type axis: Array of Integers
+        :param fields: Parsed headers, if already known (as returned from :func:`~BasicProcessing.SpectralRun.ParseHeaders`)
+        :type fields: Structured array
+
+        """
+
+        self.files = list(files)
+        self.headers = list(headers)
+        self.counts = counts
+        self.axes = axes
+        self.axis = axis
+        self.fields = SpectralRun.ParseHeaders(self.headers) if fields is None else fields
+        self.limits = self.fields["limits"].copy()
+        self.datetime = [str(dt).split("T") for dt in self.fields["time"]]
+
+
+    @classmethod
+    def from_run(cls, run):
+        """Converts a :class:`~BasicProcessing.SpectralRun`.
+
+        :param run: Run with raw counts
+        :type run: :class:`~BasicProcessing.SpectralRun`
+        :returns: Run containing the same spectra
+        :rtype: :class:`~BasicProcessing.CompactRun`
+        :raises ValueError: If a count is not an integer from 0 to 65535
+
+        """
+
+        WLs = run.data[:, :, [consts.CH_B_WL, consts.CH_A_WL]]
+        counts = run.data[:, :, [consts.CH_B, consts.CH_A]]
+#        Rows without a wavelength (system parameters, padding) are masked and never used, so they are stored as 0
+        counts = np.where(WLs < 0, 0, counts)
+        if ((counts < 0) | (counts > 65535) | (counts != np.round(counts))).any():
+            raise ValueError("Counts are not 16 bit integers, so the run cannot be stored compactly")
+
+        axes = []
+        axis = np.zeros(len(run), dtype=np.intp)
+        todo = np.ones(len(run), dtype=bool)
+        while todo.any():
+            x = WLs[np.argmax(todo)]
+            files = todo & (WLs == x).all(axis=(1, 2))
+            todo &= ~files
+            axis[files] = len(axes)
+            axes.append(x)
+        axes = np.array(axes).reshape(-1, run.data.shape[1], 2)
+        return cls(run.files, run.headers, counts.astype(np.uint16), axes, axis, run.fields)
+
+
+    @property
+    def data(self):
+        data = np.empty(self.counts.shape[:2] + (4,))
+        WLs = self.axes[self.axis]
+        for chan_idx, chan in enumerate([consts.CH_B_WL, consts.CH_A_WL]):
+            data[:, :, chan] = WLs[:, :, chan_idx]
+            data[:, :, chan + 1] = np.where(WLs[:, :, chan_idx] < 0, -1.0, self.counts[:, :, chan_idx])
+        return data
+
+
+    def select(self, keep):
+        """Returns a new run with only the files selected by **keep**.
+
+        :param keep: Boolean mask or indices of files to keep
+        :type keep: Array
+        :returns: Reduced run
+        :rtype: :class:`~BasicProcessing.CompactRun`
+
+        """
+
+        idx = np.arange(len(self))[keep]
+        run = CompactRun([self.files[i] for i in idx], [self.headers[i] for i in idx], self.counts[idx], self.axes, self.axis[idx], self.fields[idx])
+        run.dark = self.dark
+        return run
+
+
+    def __getitem__(self, idx):
+        return [self.headers[idx], self.select([idx]).data[0]]
+
+
+class AtomicFile:
+    """Context manager giving a temporary name to write a file under, which is renamed to the file when the block completes, so other programs never see a partially written file.
+
+    The temporary name is in the same directory and includes the process ID, so pool workers writing the same file do not collide.  If the block raises, the temporary file is removed and any existing file is left unchanged.
+
+    """
+
+    #: File to write
+    Path = ""
+    #: Temporary name written to
+    TempPath = ""
+
+
+    def __init__(self, filename, stats=None):
+        """Sets up the names.  The file's directory is created on entry if needed.
+
+        :param filename: File to write
+        :type filename: String
+        :param stats: Counts *files_written* and *bytes_written* when the file is complete, or None
+        :type stats: :class:`~BasicProcessing.ProcessingStats`
+
+        """
+
+        self.Path = filename
+        self.TempPath = os.path.join(os.path.dirname(filename), "." + os.path.basename(filename) + "." + str(os.getpid()) + ".tmp")
+        self.Stats = stats
+
+
+    def __enter__(self):
+        if os.path.dirname(self.Path):
+            os.makedirs(os.path.dirname(self.Path), exist_ok=True)
+        return self.TempPath
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                if self.Stats is not None:
+                    self.Stats.Count("files_written")
+                    self.Stats.Count("bytes_written", os.path.getsize(self.TempPath))
+                os.replace(self.TempPath, self.Path)
+        finally:
+            if os.path.exists(self.TempPath):
+                os.remove(self.TempPath)
+        return False
+
+
+class SpectrumCache:
+    """On-disk cache of parsed spectra, with least recently used entries removed once the cache exceeds its size limit.
+
+    Each entry is a small binary file holding the header lines and the (rows, 4) spectrum array of one Unispec file, keyed by the file's path, size and modification time so edited files are parsed again.
+
+    """
+
+    #: Identifies cache entry files (and their layout version)
+    Magic = b"USPC0003"
+    #: Directory holding cache entries
+    Path = ""
+    #: Maximum total size of cache entries in bytes
+    SizeLimit = 0
+    #: Current total size of cache entries in bytes, or None if not yet measured
+    Size = None
+
+
+    def __init__(self, path, size_limit):
+        """Sets up the cache directory.
+
+        :param path: Directory holding cache entries (created if needed)
+        :type path: String
+        :param size_limit: Maximum total size of cache entries in bytes
+        :type size_limit: Integer
+
+        """
+
+        self.Path = path
+        self.SizeLimit = size_limit
+        self.Size = None
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+
+    def Key(self, file, headerlen, dtype=np.float64):
+        """Returns the cache key for a Unispec file.
+
+        :param file: Path of the Unispec file
+        :type file: String
+        :param headerlen: Header length the file is parsed with
+        :type headerlen: Integer
+        :param dtype: Data type the spectra are parsed as
+        :type dtype: numpy dtype
+        :rtype: String
+
+        """
+
+        st = os.stat(file)
+        ident = "%s|%d|%d|%d|%s" % (os.path.realpath(file), st.st_size, st.st_mtime_ns, headerlen, np.dtype(dtype).str)
+        return hashlib.sha1(ident.encode()).hexdigest()
+
+
+    def Load(self, key):
+        """Returns the cached header and spectra for **key**, or None if there is no entry.
+
+        :param key: Cache key (as returned from :func:`~BasicProcessing.SpectrumCache.Key`)
+        :type key: String
+        :returns: Header lines and spectra
+        :rtype: [List of Strings, (rows, 4) Array of Floats]
+
+        """
+
+        entry = os.path.join(self.Path, key + ".spc")
+        try:
+            with open(entry, "rb") as fh:
+                buf = fh.read()
+        except OSError:
+            return None
+        if buf[:8] != self.Magic:
+            return None
+
+        headersize, rows, dtype = struct.unpack_from("<II4s", buf, 8)
+        header = buf[20:20 + headersize].decode().splitlines(True)
+        data = np.frombuffer(buf, dtype=dtype.rstrip(b"\0").decode(), count=rows * 4, offset=20 + headersize).reshape(rows, 4).copy()
+
+#        Mark the entry as recently used, unless another process has evicted it since it was read
+        try:
+            os.utime(entry)
+        except FileNotFoundError:
+            pass
+        return [header, data]
+
+
+    def Store(self, key, header, data):
+        """Writes a cache entry, then removes old entries if the size limit is exceeded.
+
+        :param key: Cache key (as returned from :func:`~BasicProcessing.SpectrumCache.Key`)
+        :type key: String
+        :param header: Header lines
+        :type header: List of Strings
+        :param data: Spectra
+        :type data: (rows, 4) Array of Floats
+
+        """
+
+        headerbytes = "".join(header).encode()
+        entry = os.path.join(self.Path, key + ".spc")
+        buf = self.Magic + struct.pack("<II4s", len(headerbytes), len(data), data.dtype.str.encode()) + headerbytes
+        with AtomicFile(entry) as tmpname:
+            with open(tmpname, "wb") as fh:
+                fh.write(buf)
+                fh.write(np.ascontiguousarray(data).tobytes())
+
+        if self.Size is None:
+            self.Size = sum(size for mtime, size, path in self.Entries())
+        else:
+            self.Size += len(buf) + data.nbytes
+        if self.Size > self.SizeLimit:
+            self.Evict()
+
+
+    def Entries(self):
+        """Returns the last use, size and path of every complete cache entry.
+
+        Other processes may share the cache, so entries removed while the directory is listed are skipped, as are the temporary files of entries being written.
+
+        :rtype: List of (Float, Integer, String)
+
+        """
+
+        entries = []
+        for e in os.scandir(self.Path):
+            if not e.name.endswith(".spc"):
+                continue
+            try:
+                st = e.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, e.path))
+        return entries
+
+
+    def Evict(self):
+        """Removes least recently used entries until the cache is within 90% of its size limit."""
+
+        entries = sorted(self.Entries())
+        self.Size = sum(e[1] for e in entries)
+        for mtime, size, path in entries:
+            if self.Size <= 0.9 * self.SizeLimit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                #Already evicted by another process
+                pass
+            self.Size -= size
+
+
+class SpuArchive:
+    """Single append-only file holding many Unispec files as fixed-size records, read through a memory map.
+
+    The file starts with a 64 byte header (format identifier, rows per spectrum, header length and header size) followed by one record per Unispec file holding its name, its header text and its (rows, 4) spectra before the Ch B system parameters are masked.  Records are looked up by name through an index built when the archive is opened.
+
+    """
+
+    #: Identifies archive files (and their layout version)
+    Magic = b"USPA0001"
+    #: Size of the file header in bytes
+    HeaderSize = 64
+    #: Path of the archive file
+    Path = ""
+    #: Number of spectrum rows per record
+    Rows = 0
+    #: Header length the files were ingested with (see :func:`~BasicProcessing.UnispecProcessing.ReadFiles`)
+    HeaderLines = 0
+    #: Record layout
+    dtype = None
+    #: Memory-mapped records, or None for an empty archive
+    records = None
+    #: Record number of each file, keyed by name
+    index = {}
+
+
+    def __init__(self, path):
+        """Opens an archive and builds its index.
+
+        :param path: Archive file
+        :type path: String
+
+        """
+
+        self.Path = path
+        with open(path, "rb") as fh:
+            head = fh.read(self.HeaderSize)
+        if head[:8] != self.Magic:
+            raise ValueError(path + " is not a Unispec archive")
+        self.Rows, self.HeaderLines, headerbytes = struct.unpack_from("<III", head, 8)
+        self.dtype = SpuArchive.RecordType(self.Rows, headerbytes)
+
+        count = (os.path.getsize(path) - self.HeaderSize) // self.dtype.itemsize
+        self.records = np.memmap(path, dtype=self.dtype, mode="r", offset=self.HeaderSize, shape=(count,)) if count > 0 else None
+        self.index = {}
+        if self.records is not None:
+            for i, name in enumerate(self.records["name"]):
+                self.index[name.decode()] = i
+
+
+    @staticmethod
+    def RecordType(rows, headerbytes):
+        """Returns the record layout for spectra of **rows** rows and headers of up to **headerbytes** bytes.
+
+        :rtype: numpy dtype
+
+        """
+
+        return np.dtype([("name", "S128"), ("header", "S" + str(headerbytes)), ("data", "<f8", (rows, 4))])
+
+
+    @classmethod
+    def Ingest(cls, path, source_path, flist, headerlen, rows=256, headerbytes=1024):
+        """Appends Unispec files to an archive, creating it if needed.  Files already in the archive are skipped, and a partial record left by an interrupted ingest is removed first.
+
+        :param path: Archive file
+        :type path: String
+        :param source_path: Directory that the names in **flist** are relative to
+        :type source_path: String
+        :param flist: Files to add, in the order they should be stored
+        :type flist: List of Strings
+        :param headerlen: Header length of the files (see :func:`~BasicProcessing.UnispecProcessing.ReadFiles`)
+        :type headerlen: Integer
+        :param rows: Spectrum rows per file, used when creating the archive
+        :type rows: Integer
+        :param headerbytes: Space reserved for header text, used when creating the archive
+        :type headerbytes: Integer
+        :returns: Number of files added and list of files that could not be added
+        :rtype: Integer, List of Strings
+
+        """
+
+        if not os.path.isfile(path):
+            with open(path, "wb") as fh:
+                fh.write(struct.pack("<8sIII", cls.Magic, rows, headerlen, headerbytes).ljust(cls.HeaderSize, b"\0"))
+        archive = cls(path)
+        if archive.HeaderLines != headerlen:
+            raise ValueError(path + " was created with a header length of " + str(archive.HeaderLines))
+
+        #An interrupted ingest can leave part of a record at the end, which would misalign every record appended after it
+        end = cls.HeaderSize + (os.path.getsize(path) - cls.HeaderSize) // archive.dtype.itemsize * archive.dtype.itemsize
+        archive.records = None
+
+        added = 0
+        skipped = []
+        record = np.zeros(1, dtype=archive.dtype)
+        with open(path, "r+b") as fh:
+            fh.truncate(end)
+            fh.seek(end)
+            for file in flist:
+                name = file.replace(os.sep, "/")
+                if name in archive.index:
+                    continue
+                with open(os.path.join(source_path, file), "r") as sf:
+                    lines = sf.read().split("\n", headerlen + 1)
+                header = "\n".join(lines[0:headerlen + 1]).encode()
+                spectra = np.fromstring(lines[-1] if len(lines) > headerlen + 1 else "", dtype=np.float64, sep=" ")
+                if len(spectra) != archive.Rows * 4 or len(header) > archive.dtype["header"].itemsize or len(name.encode()) > archive.dtype["name"].itemsize:
+                    skipped.append(file)
+                    continue
+                record["name"] = name.encode()
+                record["header"] = header
+                record["data"] = spectra.reshape(archive.Rows, 4)
+                fh.write(record.tobytes())
+                archive.index[name] = -1
+                added += 1
+        return added, skipped
+
+
+    def Names(self):
+        """Returns the names of all files in the archive in stored order.
+
+        :rtype: List of Strings
+
+        """
+
+        return sorted(self.index, key=self.index.get)
+
+
+    def Find(self, flist):
+        """Returns the record numbers of the files in **flist**.
+
+        :param flist: File names
+        :type flist: List of Strings
+        :rtype: Array of Integers
+
+        """
+
+        return np.array([self.index[file.replace(os.sep, "/")] for file in flist], dtype=np.intp)
+
+
+    def Headers(self, idx, headerlen):
+        """Returns the header lines of records **idx** as :func:`~BasicProcessing.UnispecProcessing.ReadFiles` does.
+
+        :param idx: Record numbers
+        :type idx: Array of Integers
+        :param headerlen: Header length (see :func:`~BasicProcessing.UnispecProcessing.ReadFiles`)
+        :type headerlen: Integer
+        :rtype: Nested list of Strings
+
+        """
+
+        if headerlen != self.HeaderLines:
+            raise ValueError(self.Path + " was created with a header length of " + str(self.HeaderLines))
+        return [[line + "\n" for line in h.decode().split("\n")[0:headerlen]] for h in self.records["header"][idx]]
+
+
+class FileCatalog:
+    """SQLite index of the Unispec files below a source directory.
+
+    The catalog records the name (relative to the source directory), size, modification time, timestamp, station number, white plate / stop classification and run number of every .spu file.  :func:`~BasicProcessing.FileCatalog.Update` rescans only directories that changed since the previous scan and renumbers the runs only when files changed, so runs are read by a query instead of a directory listing.
+
+    """
+
+    #: Matches the timestamp and station number in Unispec file names, e.g. Uni_2015-06-25__00_02_26_000.spu
+    NamePattern = re.compile(r"(\d{4}-\d{2}-\d{2})__(\d{2})_(\d{2})_(\d{2})_(\d+)\.spu$")
+    #: Path of the SQLite database
+    Path = ""
+    #: Directory that is cataloged
+    SourcePath = ""
+    #: White plate identifier used to classify files
+    WP_identifier = ""
+    #: Largest gap in seconds between files of a run (see :class:`~BasicProcessing.RunSegmenter`)
+    RunGap = 1800.0
+
+
+    def __init__(self, path, source_path, wp_identifier, run_gap=1800.0):
+        """Opens a catalog, creating it if needed.
+
+        :param path: SQLite database file
+        :type path: String
+        :param source_path: Directory to catalog
+        :type source_path: String
+        :param wp_identifier: White plate identifier (see :data:`~BasicProcessing.UnispecProcessing.WP_identifier`)
+        :type wp_identifier: String
+        :param run_gap: Largest gap in seconds between files of a run (see :data:`~BasicProcessing.UnispecProcessing.RunGap`)
+        :type run_gap: Float
+
+        """
+
+        self.Path = path
+        self.SourcePath = os.path.realpath(source_path)
+        self.WP_identifier = wp_identifier
+        self.RunGap = run_gap
+        with self.Connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, dir TEXT NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+                       "timestamp TEXT, station INTEGER, is_wp INTEGER NOT NULL, run INTEGER) WITHOUT ROWID")
+            db.execute("CREATE INDEX IF NOT EXISTS files_dir ON files (dir)")
+            db.execute("CREATE TABLE IF NOT EXISTS dirs (dir TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+#            A catalog of another directory, or classified with another identifier, is rebuilt
+            meta = dict(db.execute("SELECT key, value FROM meta"))
+            if meta.get("source") != self.SourcePath:
+                db.execute("DELETE FROM files")
+                db.execute("DELETE FROM dirs")
+            if meta.get("wp_identifier") != wp_identifier:
+                db.executemany("UPDATE files SET is_wp = ? WHERE name = ?",
+                               [(int(self.IsWP(name)), name) for name, in db.execute("SELECT name FROM files")])
+                self.Group(db)
+            elif meta.get("run_gap") != repr(float(run_gap)):
+                self.Group(db)
+            db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)", [("source", self.SourcePath), ("wp_identifier", wp_identifier), ("run_gap", repr(float(run_gap)))])
+
+
+    @contextlib.contextmanager
+    def Connect(self):
+        """Opens a connection to the catalog database for a **with** block, committing when the block completes (or rolling back if it raises) and closing the connection.
+
+        :rtype: sqlite3.Connection
+
+        """
+
+        import sqlite3
+
+        db = sqlite3.connect(self.Path)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+
+    def IsWP(self, name):
+        """Returns whether the file **name** is a white plate.
+
+        :rtype: Boolean
+
+        """
+
+        return name.endswith(self.WP_identifier + ".spu")
+
+
+    def Update(self):
+        """Brings the catalog up to date with the source directory and its subdirectories.
+
+        Directories whose modification time has not changed are skipped unless they hold empty files, which may still be being written.  A file rewritten in place does not change its directory's modification time, so it is only noticed by :func:`~BasicProcessing.FileCatalog.LastModified`.
+
+        :returns: Number of files added or changed, number of files removed
+        :rtype: Integer, Integer
+
+        """
+
+        changed = 0
+        removed = 0
+        with self.Connect() as db:
+            known_dirs = dict(db.execute("SELECT dir, mtime_ns FROM dirs"))
+            pending = set(d for d, in db.execute("SELECT DISTINCT dir FROM files WHERE size = 0"))
+            seen_dirs = set()
+            todo = [""]
+            while todo:
+                rel = todo.pop()
+                seen_dirs.add(rel)
+                path = os.path.join(self.SourcePath, rel)
+                mtime = os.stat(path).st_mtime_ns
+                rescan = known_dirs.get(rel) != mtime or rel in pending
+
+                files = {}
+                with os.scandir(path) as it:
+                    for entry in it:
+                        name = entry.name if rel == "" else rel + "/" + entry.name
+                        if entry.is_dir():
+                            todo.append(name)
+                        elif rescan and entry.name.endswith(".spu"):
+                            try:
+                                st = entry.stat()
+                            except FileNotFoundError:
+                                continue
+                            files[name] = (st.st_size, st.st_mtime_ns)
+                if not rescan:
+                    continue
+
+                known = dict((name, (size, mtime_ns)) for name, size, mtime_ns in db.execute("SELECT name, size, mtime_ns FROM files WHERE dir = ?", (rel,)))
+                gone = [(name,) for name in known if name not in files]
+                db.executemany("DELETE FROM files WHERE name = ?", gone)
+                rows = []
+                for name, stat in files.items():
+                    if known.get(name) != stat:
+                        match = self.NamePattern.search(name)
+                        timestamp = match.group(1) + " " + ":".join(match.group(2, 3, 4)) if match else None
+                        station = int(match.group(5)) if match else None
+                        rows.append((name, rel, stat[0], stat[1], timestamp, station, int(self.IsWP(name)), None))
+                db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (rel, mtime))
+                changed += len(rows)
+                removed += len(gone)
+
+#            Forget directories that were deleted
+            for rel in set(known_dirs) - seen_dirs:
+                removed += db.execute("DELETE FROM files WHERE dir = ?", (rel,)).rowcount
+                db.execute("DELETE FROM dirs WHERE dir = ?", (rel,))
+
+            if changed or removed:
+                self.Group(db)
+        return changed, removed
+
+
+    def Group(self, db):
+        """Numbers the runs of the non-empty files in name order with :class:`~BasicProcessing.RunSegmenter`, using the stored timestamps and station numbers.
+
+        :param db: Open catalog connection
+        :type db: sqlite3.Connection
+
+        """
+
+        files = db.execute("SELECT name, timestamp, station, is_wp, run FROM files WHERE size > 0 ORDER BY name").fetchall()
+        if files:
+            names, timestamps, stations, is_wp, old = zip(*files)
+            segmenter = RunSegmenter(self.WP_identifier, self.RunGap)
+            runs = segmenter.Segment(np.array([t.replace(" ", "T") if t else "NaT" for t in timestamps], dtype="datetime64[s]"),
+                                     np.array([-1 if s is None else s for s in stations], dtype=np.int64), np.array(is_wp, dtype=bool))
+            db.executemany("UPDATE files SET run = ? WHERE name = ?", [(run, name) for name, run, prev in zip(names, runs.tolist(), old) if run != prev])
+        db.execute("UPDATE files SET run = NULL WHERE size = 0")
+
+
+    def LastModified(self, flist):
+        """Returns the latest modification time of the files in **flist**, in seconds.
+
+        The files are checked on disk rather than read from the catalog, since :func:`~BasicProcessing.FileCatalog.Update` does not notice files rewritten in place.  Changed sizes and times are recorded in the catalog.
+
+        :param flist: File names
+        :type flist: List of Strings
+        :rtype: Float
+
+        """
+
+        stats = {}
+        for name in flist:
+            try:
+                st = os.stat(os.path.join(self.SourcePath, name))
+            except FileNotFoundError:
+                continue
+            stats[name] = (st.st_size, st.st_mtime_ns)
+
+        with self.Connect() as db:
+            db.execute("CREATE TEMP TABLE IF NOT EXISTS selected (name TEXT)")
+            db.execute("DELETE FROM selected")
+            db.executemany("INSERT INTO selected VALUES (?)", [(name,) for name in stats])
+            known = dict((name, (size, mtime_ns)) for name, size, mtime_ns in
+                         db.execute("SELECT name, size, mtime_ns FROM files WHERE name IN (SELECT name FROM selected)"))
+            changed = [(stat[0], stat[1], name) for name, stat in stats.items() if name in known and known[name] != stat]
+            db.executemany("UPDATE files SET size = ?, mtime_ns = ? WHERE name = ?", changed)
+#            Files that were empty are not part of any run, so runs are renumbered if one has been written or emptied
+            if any((size == 0) != (known[name][0] == 0) for size, mtime_ns, name in changed):
+                self.Group(db)
+        return max([stat[1] for stat in stats.values()] or [0]) / 1e9
+
+
+    def Runs(self):
+        """Returns the non-empty files in name order with their runs (see :func:`~BasicProcessing.FileCatalog.Group`).
+
+        :returns: Run number, white plate flag and name of each file
+        :rtype: List of (Integer, Integer, String)
+
+        """
+
+        with self.Connect() as db:
+            return db.execute("SELECT run, is_wp, name FROM files WHERE size > 0 ORDER BY name").fetchall()
+
+
+class RunSegmenter:
+    """Splits Unispec files into runs using their timestamps, station numbers and white plate flags.
+
+    A run is a set of white plates followed by stops.  A new run starts at a white plate that follows a stop, as in the original filename-order grouping.  It also starts after a gap of more than :data:`~BasicProcessing.RunSegmenter.RunGap` seconds between two files, or at a stop whose station number is lower than that of the stop before it.  Both happen when the white plates that should separate two runs are missing.  All rules are evaluated in one pass over arrays of the whole file list.
+
+    """
+
+    #: Matches the timestamp and station number in Unispec file names
+    NamePattern = FileCatalog.NamePattern
+    #: White plate identifier (see :data:`~BasicProcessing.UnispecProcessing.WP_identifier`)
+    WP_identifier = ""
+    #: Largest gap in seconds between consecutive files of a run, or 0 to split runs on white plates and stations only
+    RunGap = 1800.0
+
+
+    def __init__(self, wp_identifier, run_gap=1800.0):
+        """Initializes the segmenter.
+
+        :param wp_identifier: White plate identifier
+        :type wp_identifier: String
+        :param run_gap: Largest gap in seconds between consecutive files of a run (0 to disable)
+        :type run_gap: Float
+
+        """
+
+        self.WP_identifier = wp_identifier
+        self.RunGap = run_gap
+
+
+    def Parse(self, names):
+        """Returns the timestamps, station numbers and white plate flags of files from their names.
+
+        :param names: File names
+        :type names: List of Strings
+        :returns: Times (NaT where the name has no timestamp), station numbers (-1 where the name has none), white plate flags
+        :rtype: Array of datetime64, Array of Integers, Array of Booleans
+
+        """
+
+        matches = [self.NamePattern.search(name) for name in names]
+        times = np.array([match.group(1) + "T" + ":".join(match.group(2, 3, 4)) if match else "NaT" for match in matches], dtype="datetime64[s]")
+        stations = np.array([int(match.group(5)) if match else -1 for match in matches], dtype=np.int64)
+        is_wp = np.array([name.endswith(self.WP_identifier + ".spu") for name in names], dtype=bool)
+        return times, stations, is_wp
+
+
+    def Segment(self, times, stations, is_wp):
+        """Returns the run number of each file.  Files must be in chronological order.
+
+        :param times: Time of each file, NaT if unknown (no gap is detected next to it)
+        :type times: Array of datetime64
+        :param stations: Station number of each file, -1 if unknown
+        :type stations: Array of Integers
+        :param is_wp: White plate flag of each file
+        :type is_wp: Array of Booleans
+        :rtype: Array of Integers
+
+        """
+
+        breaks = np.zeros(len(is_wp), dtype=bool)
+        if len(is_wp) > 1:
+            after_stop = ~is_wp[:-1]
+            breaks[1:] = after_stop & is_wp[1:]
+            breaks[1:] |= after_stop & ~is_wp[1:] & (stations[1:] >= 0) & (stations[1:] < stations[:-1])
+            if self.RunGap > 0:
+#                NaT gives a NaN gap, which never exceeds the limit
+                breaks[1:] |= (times[1:] - times[:-1]) / np.timedelta64(1, "s") > self.RunGap
+        return np.cumsum(breaks)
+
+
+    def Brackets(self, run, is_wp):
+        """Returns, for each run, the nearest run at or before it and the nearest run after it that have white plates.
+
+        :param run: Run number of each file (as returned from :func:`~BasicProcessing.RunSegmenter.Segment`)
+        :type run: Array of Integers
+        :param is_wp: White plate flag of each file
+        :type is_wp: Array of Booleans
+        :returns: Preceding and following run numbers, -1 where there is none
+        :rtype: Array of Integers, Array of Integers
+
+        """
+
+        count = int(run[-1]) + 1 if len(run) else 1
+        has_wp = np.zeros(count, dtype=bool)
+        has_wp[run[is_wp]] = True
+        idx = np.arange(count)
+        preceding = np.maximum.accumulate(np.where(has_wp, idx, -1))
+        following = np.minimum.accumulate(np.where(has_wp, idx, count)[::-1])[::-1]
+        following = np.append(following[1:], count)
+        following[following == count] = -1
+        return preceding, following
+
+
+class SpectralIndices:
+    """Evaluates a set of spectral index expressions for all stops of a run at once.
+
+    Expressions use *R[wl]* for the reflectance at the grid wavelength nearest to *wl* and *R[lo:hi]* for the mean reflectance from *lo* to *hi* nm (inclusive), combined with numbers, parentheses and + - * / **.  For example NDVI = (R[800] - R[670]) / (R[800] + R[670]).
+
+    Each expression is compiled once.  The grid index range of every wavelength window is worked out once per wavelength grid, and each window is averaged across all stops in one array operation.
+
+    """
+
+    #: Index names, in output order
+    Names = []
+    #: Compiled expressions, in the order of :data:`~BasicProcessing.SpectralIndices.Names`
+    Code = []
+    #: Wavelength windows referenced by the expressions as (lo, hi), hi is None for a single wavelength
+    Windows = []
+    #: Grid index ranges of :data:`~BasicProcessing.SpectralIndices.Windows`, keyed by the wavelength grid
+    SliceCache = {}
+
+    #: Expression syntax that may be used besides wavelength windows
+    Allowed = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd, ast.Constant, ast.Name, ast.Load)
+
+
+    def __init__(self, definitions):
+        """Compiles the index expressions.
+
+        :param definitions: Expression of each index, keyed by name
+        :type definitions: Dictionary of Strings
+        :raises ValueError: If an expression is not valid
+
+        """
+
+        self.Names = []
+        self.Code = []
+        self.Windows = []
+        self.SliceCache = {}
+        for name, expression in definitions.items():
+            try:
+                tree = ast.parse(expression.strip(), mode="eval")
+            except SyntaxError as err:
+                raise ValueError("Invalid expression for index " + name + ": " + str(err))
+            tree = ast.fix_missing_locations(self.ReplaceWindows(tree, name))
+            for node in ast.walk(tree):
+                if not isinstance(node, self.Allowed) or (isinstance(node, ast.Constant) and not isinstance(node.value, (int, float))):
+                    raise ValueError("Invalid expression for index " + name + ": " + expression)
+            self.Names.append(name)
+            self.Code.append(compile(tree, "<index " + name + ">", "eval"))
+
+
+    def ReplaceWindows(self, tree, name):
+        """Replaces the wavelength windows in an expression tree with variables *w0*, *w1*, ... that :func:`~BasicProcessing.SpectralIndices.Compute` fills in.
+
+        :rtype: ast.Expression
+
+        """
+
+        indices = self
+
+        class Transformer(ast.NodeTransformer):
+            def visit_Subscript(self, node):
+                bounds = node.slice
+                if isinstance(node.value, ast.Name) and node.value.id == "R":
+                    if isinstance(bounds, ast.Constant) and isinstance(bounds.value, (int, float)):
+                        window = (float(bounds.value), None)
+                    elif isinstance(bounds, ast.Slice) and bounds.step is None and all(isinstance(b, ast.Constant) and isinstance(b.value, (int, float)) for b in (bounds.lower, bounds.upper)):
+                        window = (float(bounds.lower.value), float(bounds.upper.value))
+                    else:
+                        window = None
+                    if window is not None:
+                        if window not in indices.Windows:
+                            indices.Windows.append(window)
+                        return ast.Name(id="w" + str(indices.Windows.index(window)), ctx=ast.Load())
+                raise ValueError("Invalid wavelength window in index " + name + ": " + ast.unparse(node))
+
+            def visit_Name(self, node):
+                raise ValueError("Unknown name in index " + name + ": " + node.id)
+
+        return Transformer().visit(tree)
+
+
+    def Slices(self, grid):
+        """Returns the grid index range of each window, (0, 0) where a window is outside the grid.
+
+        :param grid: Wavelengths of the reflectance data
+        :type grid: Array of Floats
+        :rtype: List of (Integer, Integer)
+
+        """
+
+        key = grid.tobytes()
+        if key not in self.SliceCache:
+            slices = []
+            for lo, hi in self.Windows:
+                if hi is None:
+                    if grid[0] <= lo <= grid[-1]:
+                        start = int(np.argmin(np.abs(grid - lo)))
+                        slices.append((start, start + 1))
+                    else:
+                        slices.append((0, 0))
+                else:
+                    slices.append((int(np.searchsorted(grid, lo, "left")), int(np.searchsorted(grid, hi, "right"))))
+            self.SliceCache[key] = slices
+        return self.SliceCache[key]
+
+
+    def Compute(self, data):
+        """Evaluates all indices for every stop in **data**.  Indices that use a window outside the wavelength range are NaN.
+
+        :param data: Array of reflectance data (as returned from :func:`~BasicProcessing.UnispecProcessing.Refl`)
+        :type data: Array of Floats indexed as [File, WL/Reflectance]
+        :returns: Index values
+        :rtype: Array of Floats indexed as [File, index]
+
+        """
+
+        refl = data[:, 1]
+        bands = {}
+        for w_idx, (start, stop) in enumerate(self.Slices(data[0, 0])):
+            if stop > start:
+                bands["w" + str(w_idx)] = refl[:, start:stop].mean(axis=1)
+            else:
+                bands["w" + str(w_idx)] = np.full(len(data), np.nan)
+
+        out = np.empty((len(data), len(self.Names)))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for i_idx, code in enumerate(self.Code):
+                out[:, i_idx] = eval(code, {"__builtins__": {}}, bands)
+        return out
+
+
+class SensorBands:
+    """Resamples reflectance to the bands of another sensor through a sparse band response matrix.
+
+    Each row of the matrix holds the spectral response of one band on the reflectance wavelength grid, normalized to sum to 1, so a band value is the response-weighted mean reflectance.  The matrix is built once per wavelength grid and applied to all stops of a run in one sparse matrix product.
+
+    """
+
+    #: Band names, in output order
+    Names = []
+    #: Gaussian bands as (center, FWHM) in nm, or None for tabulated responses
+    Gaussian = None
+    #: Tabulated responses as (wavelengths, [band, wavelength] responses), or None for Gaussian bands
+    Table = None
+    #: Band response matrices, keyed by the wavelength grid
+    MatrixCache = {}
+    #: Gaussian responses are cut off this many standard deviations from the center
+    Cutoff = 3.0
+
+
+    def __init__(self, definition):
+        """Reads a sensor definition.
+
+        :param definition: Comma separated Gaussian bands as *name:center/FWHM* (e.g. *B2:490/65, B3:560/35*), or the path of a CSV file with a header row and columns of wavelength and each band's response
+        :type definition: String
+        :raises ValueError: If the definition is not valid
+
+        """
+
+        self.MatrixCache = {}
+        definition = definition.strip()
+        if os.path.isfile(definition):
+            with open(definition, "r") as fh:
+                self.Names = [name.strip() for name in fh.readline().split(",")[1:]]
+                table = np.loadtxt(fh, delimiter=",", ndmin=2)
+            order = np.argsort(table[:, 0], kind="mergesort")
+            self.Table = (table[order, 0], table[order, 1:].T)
+        else:
+            self.Names = []
+            bands = []
+            for band in definition.split(","):
+                try:
+                    name, shape = band.split(":")
+                    center, fwhm = [float(v) for v in shape.split("/")]
+                except ValueError:
+                    raise ValueError("Invalid band definition: " + band.strip() + " (expected name:center/FWHM or a response file)")
+                self.Names.append(name.strip())
+                bands.append((center, fwhm))
+            self.Gaussian = np.array(bands)
+
+
+    def Matrix(self, grid):
+        """Returns the band response matrix for a wavelength grid.
+
+        :param grid: Wavelengths of the reflectance data
+        :type grid: Array of Floats
+        :returns: Normalized responses indexed as [band, wavelength]
+        :rtype: scipy.sparse.csr_matrix
+
+        """
+
+        key = grid.tobytes()
+        if key not in self.MatrixCache:
+            from scipy import sparse
+
+            if self.Gaussian is not None:
+                sigma = self.Gaussian[:, 1:2] / (2 * np.sqrt(2 * np.log(2)))
+                offset = (grid[None, :] - self.Gaussian[:, 0:1]) / sigma
+                response = np.where(np.abs(offset) <= self.Cutoff, np.exp(-0.5 * offset ** 2), 0)
+            else:
+                wl, table = self.Table
+                response = np.array([np.interp(grid, wl, band, left=0, right=0) for band in table])
+            total = response.sum(axis=1, keepdims=True)
+            self.MatrixCache[key] = sparse.csr_matrix(np.divide(response, total, out=np.zeros_like(response), where=total > 0))
+        return self.MatrixCache[key]
+
+
+    def Resample(self, data):
+        """Resamples the reflectance of every stop in **data** to the sensor's bands.  Bands with no response inside the wavelength range are NaN.
+
+        :param data: Array of reflectance data (as returned from :func:`~BasicProcessing.UnispecProcessing.Refl`)
+        :type data: Array of Floats indexed as [File, WL/Reflectance]
+        :returns: Band values
+        :rtype: Array of Floats indexed as [File, band]
+
+        """
+
+        matrix = self.Matrix(data[0, 0])
+        out = np.asarray(matrix.dot(data[:, 1].T)).T
+        out[:, np.diff(matrix.indptr) == 0] = np.nan
+        return out
+
+
+class ProcessingStats:
+    """Collects wall and CPU time of each processing stage and counts of files and bytes, and writes them as JSON lines.
+
+    Stages are methods of :class:`~BasicProcessing.UnispecProcessing` marked with :func:`~BasicProcessing.ProcessingStats.Timed`.  The time of a stage excludes the stages it calls, so stage times add up to the total.  When :data:`~BasicProcessing.UnispecProcessing.Stats` is None, nothing is collected.
+
+    """
+
+    #: Wall time, CPU time and number of calls of each stage, keyed by stage name
+    Stages = {}
+    #: Counters such as files and bytes read, keyed by name
+    Counters = {}
+    #: JSON lines file that records are appended to, or None
+    Path = None
+
+
+    def __init__(self, path=None):
+        """Starts collecting.
+
+        :param path: JSON lines file that records are appended to, or None to only collect
+        :type path: String
+
+        """
+
+        self.Path = path
+        self.Stages = {}
+        self.Counters = {}
+        self.stack = []
+
+
+    @staticmethod
+    def Timed(name):
+        """Returns a decorator that records calls of a :class:`~BasicProcessing.UnispecProcessing` method as stage **name**.
+
+        :param name: Stage name
+        :type name: String
+
+        """
+
+        def decorate(func):
+            @functools.wraps(func)
+            def wrapper(self, *args, **kwargs):
+                if self.Stats is None:
+                    return func(self, *args, **kwargs)
+                self.Stats.Start(name)
+                try:
+                    return func(self, *args, **kwargs)
+                finally:
+                    self.Stats.Stop()
+            return wrapper
+        return decorate
+
+
+    def Start(self, name):
+        """Marks the start of a stage."""
+
+        self.stack.append([name, time.perf_counter(), time.process_time(), 0.0, 0.0])
+
+
+    def Stop(self):
+        """Marks the end of the innermost stage and adds its time, less that of the stages it called."""
+
+        name, wall, cpu, child_wall, child_cpu = self.stack.pop()
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        stage = self.Stages.setdefault(name, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+        stage["wall"] += wall - child_wall
+        stage["cpu"] += cpu - child_cpu
+        if self.stack:
+            self.stack[-1][3] += wall
+            self.stack[-1][4] += cpu
+#        A stage calling itself (e.g. ReadRun calling ReadFiles) counts as one call
+        if not self.stack or self.stack[-1][0] != name:
+            stage["calls"] += 1
+
+
+    def Count(self, name, n=1):
+        """Adds **n** to counter **name**."""
+
+        self.Counters[name] = self.Counters.get(name, 0) + n
+
+
+    def Take(self):
+        """Returns the stages and counters collected so far and starts again.
+
+        :rtype: Dictionary
+
+        """
+
+        taken = {"stages": self.Stages, "counters": self.Counters}
+        self.Stages = {}
+        self.Counters = {}
+        return taken
+
+
+    @staticmethod
+    def Merge(total, taken):
+        """Adds stages and counters (as returned from :func:`~BasicProcessing.ProcessingStats.Take`) to **total** in place.
+
+        :returns: **total**
+        :rtype: Dictionary
+
+        """
+
+        for name, stage in taken["stages"].items():
+            into = total["stages"].setdefault(name, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+            for key in into:
+                into[key] += stage[key]
+        for name, n in taken["counters"].items():
+            total["counters"][name] = total["counters"].get(name, 0) + n
+        return total
+
+
+    def Emit(self, event, record):
+        """Appends a record to the JSON lines file, if there is one.
+
+        :param event: Record type, e.g. *run* or *summary*
+        :type event: String
+        :param record: Record fields
+        :type record: Dictionary
+
+        """
+
+        if self.Path is None:
+            return
+        if os.path.dirname(self.Path) and not os.path.exists(os.path.dirname(self.Path)):
+            os.makedirs(os.path.dirname(self.Path))
+        with open(self.Path, "a") as fh:
+            fh.write(json.dumps(dict({"event": event, "time": time.strftime("%Y-%m-%dT%H:%M:%S")}, **record)) + "\n")
+
 
 class UnispecProcessing:
     """Class for Unispec data processing"""
@@ -54,22 +1369,79 @@ class UnispecProcessing:
     SourcePath = ""
     OutputPath = ""
     OutputPrefix = ""
+    #: Number of decimal places written by :func:`~BasicProcessing.UnispecProcessing.WriteOutput`
+    Precision = 6
+    #: Output format of :func:`~BasicProcessing.UnispecProcessing.WriteOutput` (*csv* or *hdf5*)
+    OutputFormat = "csv"
+    #: HDF5 file that all runs are appended to, or "" to write one HDF5 file per run
+    SeasonFile = ""
+    #: File recording runs already processed, used by incremental processing in :mod:`Main`
+    StateFile = ""
     WP_identifier = ""
     HeaderLines = ""
+    #: Spectrum parser used by :func:`~BasicProcessing.UnispecProcessing.ReadFiles` (*array* or *text*)
+    Parser = "array"
+    #: Raw count at or above which a value is considered saturated
+    SatThreshold = 65535
+    #: Number of files read ahead concurrently by :func:`~BasicProcessing.UnispecProcessing.PrefetchFiles` (0 reads files one at a time)
+    Prefetch = 0
+    #: Cache of parsed spectra used by :func:`~BasicProcessing.UnispecProcessing.ReadFiles`, or None if disabled
+    Cache = None
+    #: Archive that files are read from instead of :data:`~BasicProcessing.UnispecProcessing.SourcePath`, or None
+    Archive = None
+    #: Catalog of :data:`~BasicProcessing.UnispecProcessing.SourcePath` used by :func:`~BasicProcessing.UnispecProcessing.GetFileLists`, or None
+    Catalog = None
     #: Array of white plate files indexed as *[Run #][WP #]* 
     WPs = [[]] # * 3
     #: Array of stop files indexed as *[Run #][Stop #]* 
     Stops = [[]] # * 200 
+    #: White plate files of the nearest run at or before each run that has them, indexed as *[Run #][WP #]*
+    PrevWPs = [[]]
+    #: White plate files of the nearest following run that has them, indexed as *[Run #][WP #]* (empty for the last runs)
+    NextWPs = [[]]
+    #: Largest gap in seconds between consecutive files of a run (see :class:`~BasicProcessing.RunSegmenter`), 0 to disable
+    RunGap = 1800.0
     WP_count = 0
     stop_count = 0
     run_count = 0
+    #: Interpolation indices/weights keyed by source wavelength axis and target grid (see :func:`~BasicProcessing.UnispecProcessing.InterpWeights`)
+    InterpCache = {}
+    #: Normalization applied by :func:`~BasicProcessing.UnispecProcessing.Normalize`, *none* or *integration*
+    Normalization = "none"
+    #: Dark level subtracted by :func:`~BasicProcessing.UnispecProcessing.Normalize`, *none*, *minimum* or the path of a dark Unispec file
+    Dark = "none"
+    #: Dark files read by :func:`~BasicProcessing.UnispecProcessing.ReadDark`, keyed by path
+    DarkCache = {}
+    #: With a dark level subtracted, fraction of the white plate's peak below which a wavelength has no reflectance (see :func:`~BasicProcessing.UnispecProcessing.ReflMask`)
+    DarkFloor = 0.005
+    #: White plate averaging used by :func:`~BasicProcessing.UnispecProcessing.AvgWPs`, *mean*, *median*, *trimmed* or *unsaturated*
+    WPAverage = "mean"
+    #: Fraction of values dropped from each end by the *trimmed* white plate average
+    WPTrim = 0.2
+    #: *time* to interpolate white plates between runs for each stop (see :func:`~BasicProcessing.UnispecProcessing.InterpWPs`), or *none*
+    WPInterpolation = "none"
+    #: Spectral indices written alongside the reflectance, from the [Indices] section of the configuration file, or None
+    Indices = None
+    #: Sensors whose bands are written alongside the reflectance, from the [Sensors] section of the configuration file, keyed by name
+    Sensors = {}
+    #: Stage timing and counters (see :class:`~BasicProcessing.ProcessingStats`), or None if disabled
+    Stats = None
+    #: Process stops with 16 bit counts, float32 values and a shared wavelength axis (see :class:`~BasicProcessing.CompactRun`)
+    Compact = False
+    #: Quality control limits from the [QC] section of the configuration file (see :func:`~BasicProcessing.UnispecProcessing.QCReject`), or None if disabled
+    QC = None
+    #: Per-stop quality control metrics (see :func:`~BasicProcessing.UnispecProcessing.QCMetrics`)
+    QCType = np.dtype([("saturation", "f8"), ("signal", "f8"), ("wp_cv", "f8"), ("out_of_range", "f8"), ("battery", "f8"),
+                       ("rejected", "?"), ("reasons", "U64")])
     
   
-    def __init__(self, config_file):
+    def __init__(self, config_file, catalog=True):
         """Initializes the class.  Reads input/output parameters from configuration file.
         
         :param config_file: Text file containing input/output configuration
         :type config_file: String
+        :param catalog: Open the configured catalog (see :class:`~BasicProcessing.FileCatalog`).  Pool workers, which are given their files, do not need it.
+        :type catalog: Boolean
         
         """
         
@@ -81,84 +1453,356 @@ class UnispecProcessing:
         self.SourcePath = InputParams['SourcePath']
         self.WP_identifier = InputParams['WP_Identifier']
         self.HeaderLines = int(InputParams['HeaderLines'])
+        self.Parser = InputParams.get('Parser', 'array')
+        self.SatThreshold = float(InputParams.get('SatThreshold', 65535))
+        self.Prefetch = int(InputParams.get('Prefetch', 0))
+        self.RunGap = float(InputParams.get('RunGap', 1800))
+        self.Archive = None
+        if InputParams.get('Archive', ''):
+            self.Archive = SpuArchive(InputParams['Archive'])
+        self.Catalog = None
+        if catalog and InputParams.get('Catalog', ''):
+            self.Catalog = FileCatalog(InputParams['Catalog'], self.SourcePath, self.WP_identifier, self.RunGap)
+        self.Cache = None
+        if InputParams.get('CachePath', ''):
+            self.Cache = SpectrumCache(InputParams['CachePath'], int(float(InputParams.get('CacheSize', 1024)) * 1024 ** 2))
         OutputParams = ""
         OutputParams = config['Output']
         self.OutputPath = OutputParams['OutputPath'] 
         self.OutputPrefix = OutputParams['OutputPrefix']
+        self.Precision = int(OutputParams.get('Precision', 6))
+        self.OutputFormat = OutputParams.get('Format', 'csv').lower()
+        if self.OutputFormat not in ("csv", "hdf5"):
+            raise ValueError("Unknown output format: " + self.OutputFormat)
+        self.SeasonFile = OutputParams.get('SeasonFile', '')
+        self.StateFile = OutputParams.get('StateFile', os.path.join(self.OutputPath, "processed_runs.json"))
+        self.Stats = ProcessingStats(OutputParams['StatsFile']) if OutputParams.get('StatsFile', '') else None
+        ProcessingParams = config['Processing'] if config.has_section('Processing') else {}
+        self.Normalization = ProcessingParams.get('Normalization', 'none').lower()
+        if self.Normalization not in ("none", "integration"):
+            raise ValueError("Unknown normalization: " + self.Normalization)
+        self.Dark = ProcessingParams.get('Dark', 'none')
+        if self.Dark.lower() in ("none", "minimum"):
+            self.Dark = self.Dark.lower()
+        self.DarkCache = {}
+        self.DarkFloor = float(ProcessingParams.get('DarkFloor', 0.005))
+        self.WPAverage = ProcessingParams.get('WPAverage', 'mean').lower()
+        if self.WPAverage not in ("mean", "median", "trimmed", "unsaturated"):
+            raise ValueError("Unknown white plate average: " + self.WPAverage)
+        self.WPTrim = float(ProcessingParams.get('WPTrim', 0.2))
+        self.WPInterpolation = ProcessingParams.get('WPInterpolation', 'none').lower()
+        if self.WPInterpolation not in ("none", "time"):
+            raise ValueError("Unknown white plate interpolation: " + self.WPInterpolation)
+        self.Compact = ProcessingParams.get('Compact', 'no').lower() in ("yes", "true", "on", "1")
+        self.QC = None
+        if config.has_section('QC'):
+            QCParams = config['QC']
+            self.QC = dict((key, float(QCParams[key]) if QCParams.get(key, '') else None)
+                           for key in ["MaxSaturation", "MinSignal", "MaxWPCV", "MaxOutOfRange", "MinBattery"])
+            self.QC["ReflRange"] = tuple(float(v) for v in QCParams.get('ReflRange', '0, 1.5').split(','))
+        
+#        Index names are case sensitive, so the section is read again without lowercasing keys
+        indices = configparser.ConfigParser(interpolation=None)
+        indices.optionxform = str
+        indices.read(config_file)
+        self.Indices = SpectralIndices(dict(indices['Indices'])) if indices.has_section('Indices') and len(indices['Indices']) > 0 else None
+        self.Sensors = dict((name, SensorBands(definition)) for name, definition in indices['Sensors'].items()) if indices.has_section('Sensors') else {}
+        
+        self.InterpCache = {}
 
 
+    @ProcessingStats.Timed("GetFileLists")
     def GetFileLists(self):
         """Reads input directory specified in config file and populates class arrays :data:`~BasicProcessing.UnispecProcessing.WPs` and :data:`~BasicProcessing.UnispecProcessing.Stops` with file paths/names that are to be processed.
         
-        File sets are split based on where white plates are identified date/time (assuming they are included in the filename) and .
+        Files are taken in name order, which is chronological for the file names written by the logger, and split into runs by :class:`~BasicProcessing.RunSegmenter`.  Timestamps and station numbers come from the file names, or from the headers of files whose names do not include them.  :data:`~BasicProcessing.UnispecProcessing.PrevWPs` and :data:`~BasicProcessing.UnispecProcessing.NextWPs` are set to the nearest white plates before and after each run.
+        
+        If an :data:`~BasicProcessing.UnispecProcessing.Archive` is configured, the files in the archive are used instead of the directory.  If a :data:`~BasicProcessing.UnispecProcessing.Catalog` is configured, it is updated and the runs are taken from it, including files in subdirectories.
+        
+        :return: # of runs, # of white plates, # of stops
+        :rtype: Integer, Integer, Integer
+
+        """
+         
+        if self.Archive is None and self.Catalog is not None:
+            self.Catalog.Update()
+            files = self.Catalog.Runs()
+            run = np.array([f[0] for f in files], dtype=np.int64)
+            is_wp = np.array([f[1] for f in files], dtype=bool)
+            flist = [f[2] for f in files]
+            source = self.SourcePath
+        else:
+            if self.Archive is not None:
+                flist = self.Archive.Names()
+                source = self.Archive.Path
+            else:
+                flist = os.listdir(self.SourcePath)
+                source = self.SourcePath
+#            Edited by A McMahon on 11/9/15 - Added check for empty files
+            flist = sorted(file for file in flist if file.endswith(".spu") and (self.Archive is not None or os.path.getsize(os.path.join(self.SourcePath,file)) > 0))
+
+            segmenter = RunSegmenter(self.WP_identifier, self.RunGap)
+            times, stations, is_wp = segmenter.Parse(flist)
+            unnamed = np.flatnonzero(np.isnat(times))
+            if len(unnamed):
+                fields = self.ReadRun([flist[i] for i in unnamed], self.HeaderLines).fields
+                times[unnamed] = fields["time"]
+                stations[unnamed] = fields["station"]
+            run = segmenter.Segment(times, stations, is_wp)
+
+        run_count = int(run[-1]) + 1 if len(run) else 1
+        self.WPs = [[] for r in range(0, run_count)]
+        self.Stops = [[] for r in range(0, run_count)]
+        for r, wp, file in zip(run.tolist(), is_wp.tolist(), flist):
+            (self.WPs if wp else self.Stops)[r].append(file)
+        preceding, following = RunSegmenter(self.WP_identifier, self.RunGap).Brackets(run, is_wp)
+        self.PrevWPs = [self.WPs[r] if r >= 0 else [] for r in preceding.tolist()]
+        self.NextWPs = [self.WPs[r] if r >= 0 else [] for r in following.tolist()]
+
+        self.WP_count = [len(self.WPs[i]) for i in range(0, run_count)]
+        self.stop_count = [len(self.Stops[i]) for i in range(0, run_count)]
+        print("Found " + str(run_count) + " runs in " + source + ".\n\tWPs\tStops\n")
+        for r in range(0, run_count):
+            print(str(r) + ":\t" + str(self.WP_count[r]) + "\t"+ str(self.stop_count[r]))
+        self.run_count = run_count
+        return self.run_count, self.WP_count, self.stop_count
+            
+
+    @ProcessingStats.Timed("ReadFiles")
+    def ReadFiles(self, flist, headerlen, parser=None, dtype=np.float64):
+        """Reads Unispec output files into a list, separating header and spectrum data for each file.
+        
+        With the *array* parser (default) the header lines are read once and the spectrum block of each file is converted in a single call into a (rows, 4) array.  The *text* parser is the original line-by-line reader, kept for reference.
+        
+        If a :data:`~BasicProcessing.UnispecProcessing.Cache` is configured, the *array* parser takes files from it when possible and adds newly parsed files to it.
+        
+        If an :data:`~BasicProcessing.UnispecProcessing.Archive` is configured, the files are copied from it instead and the result is always in the *array* layout.
+        
+        :param flist: List of files to read (as returned from :func:`~BasicProcessing.UnispecProcessing.GetFileLists`)
+        :type flist: Nested list of Strings
+        :param headerlen: Constant defining how many lines the header consists of
+        :type headerlen: Integer
+        :param parser: *array* or *text*, defaults to :data:`~BasicProcessing.UnispecProcessing.Parser`
+        :type parser: String
+        :param dtype: Data type of the spectrum arrays (*array* parser only)
+        :type dtype: numpy dtype
+        :returns: List of data indexed as [file index][:const:`~BasicProcessing.consts.header` / :const:`~BasicProcessing.consts.data`][row index][:const:`~BasicProcessing.consts.CH_B_WL` / :const:`~BasicProcessing.consts.CH_B` / :const:`~BasicProcessing.consts.CH_A_WL` / :const:`~BasicProcessing.consts.CH_A`]
+        :rtype: Nested list of Strings (*text*) or list of [header, (rows, 4) Array of Floats] (*array*)
+        
+        """
+        if parser is None:
+            parser = self.Parser
+        if parser not in ("array", "text"):
+            raise ValueError("Unknown parser: " + str(parser))
+        
+        if self.Archive is not None:
+            run = self.ReadArchive(flist, headerlen, dtype)
+            return [[run.headers[i], run.data[i]] for i in range(0, len(run))]
+        
+#            Edited by A McMahon on 11/9/15 - Corrected range values
+        outdata = [[[None],[None]] for item in range(0, len(flist))]
+        
+        todo = list(range(0, len(flist)))
+        if parser == "array" and self.Cache is not None:
+            keys = [self.Cache.Key(os.path.join(self.SourcePath,file), headerlen, dtype) for file in flist]
+            for i in range(0, len(flist)):
+                cached = self.Cache.Load(keys[i])
+                if cached is not None:
+                    outdata[i] = cached
+            todo = [i for i in todo if outdata[i][consts.header] == [None]]
+            if self.Stats is not None:
+                self.Stats.Count("cache_hits", len(flist) - len(todo))
+        
+        for i, text in zip(todo, self.PrefetchFiles([flist[i] for i in todo])):
+            if self.Stats is not None:
+                self.Stats.Count("files_read")
+                self.Stats.Count("bytes_read", len(text))
+            if parser == "array":
+                outdata[i] = self.ParseText(text, headerlen, dtype)
+            else:
+                data = text.splitlines(True)
+                
+#                Read Header
+                outdata[i][consts.header] = data[0:headerlen]
+                
+#                Read Spectra
+                outdata[i][consts.data] = [[float(l) for l in line.split("\t")] for line in data[headerlen + 1:]]
+            
+#            Remove invalid entries at the end of Chan B (last 8 values are system params, not spectra)
+#            Using "-1" prevents problems with different list lengths but ensures the data is out of the range interpolated so it is ignored
+            if parser == "array":
+                outdata[i][consts.data][-8:, consts.CH_B_WL:consts.CH_B + 1] = -1
+                if self.Cache is not None:
+                    self.Cache.Store(keys[i], outdata[i][consts.header], outdata[i][consts.data])
+            else:
+                for d in outdata[i][consts.data][-8::1]:
+                    d[0:2] = -1, -1
+            
+        return outdata
+
+
+    def ParseText(self, text, headerlen, dtype=np.float64):
+        """Splits the text of a single Unispec file into header lines and a (rows, 4) spectrum array, as the *array* parser of :func:`~BasicProcessing.UnispecProcessing.ReadFiles` does.  The Ch B system parameters are not masked.
+        
+        :param text: File text
+        :type text: String
+        :param headerlen: Constant defining how many lines the header consists of
+        :type headerlen: Integer
+        :param dtype: Data type of the spectrum array
+        :type dtype: numpy dtype
+        :returns: Header lines and spectra
+        :rtype: [List of Strings, (rows, 4) Array of Floats]
+        
+        """
+#        Read Header, skipping the column titles
+        data = text.split("\n", headerlen + 1)
+        header = [line + "\n" for line in data[0:headerlen]]
+        
+#        Read Spectra as a single block
+        spectra = np.fromstring(data[-1] if len(data) > headerlen + 1 else "", dtype=dtype, sep=" ")
+        return [header, spectra.reshape(-1, 4)]
+    
+    
+    @ProcessingStats.Timed("ReadFiles")
+    def ReadArchive(self, flist, headerlen, dtype=np.float64):
+        """Reads files from the :data:`~BasicProcessing.UnispecProcessing.Archive` into a :class:`~BasicProcessing.SpectralRun`.
+        
+        The spectra of all files are copied out of the memory map in one gather, so only the records of **flist** are read from disk.
+        
+        :param flist: List of files to read (as returned from :func:`~BasicProcessing.UnispecProcessing.GetFileLists`)
+        :type flist: List of Strings
+        :param headerlen: Constant defining how many lines the header consists of
+        :type headerlen: Integer
+        :param dtype: Data type of the spectrum arrays
+        :type dtype: numpy dtype
+        :rtype: :class:`~BasicProcessing.SpectralRun`
+        
+        """
+        idx = self.Archive.Find(flist)
+        headers = self.Archive.Headers(idx, headerlen)
+        data = self.Archive.records["data"][idx].astype(dtype)
+        if self.Stats is not None:
+            self.Stats.Count("files_read", len(idx))
+            self.Stats.Count("bytes_read", len(idx) * self.Archive.dtype.itemsize)
+        
+#        Remove invalid entries at the end of Chan B (see ReadFiles)
+        data[:, -8:, consts.CH_B_WL:consts.CH_B + 1] = -1
+        return SpectralRun(list(flist), headers, data)
+    
+    
+    def ReadRaw(self, file):
+        """Returns the full text of a single Unispec file.
+        
+        :param file: File name, relative to :data:`~BasicProcessing.UnispecProcessing.SourcePath`
+        :type file: String
+        :rtype: String
         
-        :return: # of runs, # of white plates, # of stops
-        :rtype: Integer, Integer, Integer
-
         """
-         
-        WP_break = False
-        run = 0
-        flist = os.listdir(self.SourcePath)
-        flist.sort()
-        for file in flist:
-#            Edited by A McMahon on 11/9/15 - Added check for empty files
-            if file.endswith(".spu") and os.path.getsize(os.path.join(self.SourcePath,file)) > 0:
-                if file.endswith(self.WP_identifier + ".spu"):
-                    if WP_break:
-                        run += 1
-                        self.WPs.append([])
-                        self.Stops.append([])
-                        WP_break = False
-                    self.WPs[run].append(file)
-                else:
-                    WP_break = True                        
-                    self.Stops[run].append(file)                    
-
-        self.WP_count = [len(self.WPs[i]) - 1 for i in range(0, run+1)]
-        self.stop_count = [len(self.Stops[i]) - 1 for i in range(0, run+1)]
-        print("Found " + str(run) + " runs in " + self.SourcePath + ".\n\tWPs\tStops\n")
-        for r in range(0, run+1):
-            print(str(r) + ":\t" + str(self.WP_count[r]) + "\t"+ str(self.stop_count[r]))
-        self.run_count = run +1
-        return self.run_count, self.WP_count, self.stop_count
-            
+#        *Edited by SPS on 11/06/2015
+#        sf = open(self.SourcePath + "\\" + flist[i], "Ur")
+        with open(os.path.join(self.SourcePath,file), "r") as sf:
+            return sf.read()
+    
+    
+    def PrefetchFiles(self, flist, prefetch=None):
+        """Yields the text of each file in **flist** in order.
+        
+        With prefetching enabled up to **prefetch** files are read concurrently by a thread pool ahead of the file being parsed, which hides the latency of opening many small files on network shares.
+        
+        :param flist: List of files to read
+        :type flist: List of Strings
+        :param prefetch: Number of files to read ahead, defaults to :data:`~BasicProcessing.UnispecProcessing.Prefetch`
+        :type prefetch: Integer
+        :returns: File text (as returned from :func:`~BasicProcessing.UnispecProcessing.ReadRaw`)
+        :rtype: Iterator of Strings
+        
+        """
+        if prefetch is None:
+            prefetch = self.Prefetch
+        
+        if prefetch <= 0:
+            for file in flist:
+                yield self.ReadRaw(file)
+            return
+        
+        from concurrent.futures import ThreadPoolExecutor
 
-    def ReadFiles(self, flist, headerlen):
-        """Reads Unispec output files into a list, separating header and spectrum data for each file.
+        with ThreadPoolExecutor(max_workers=prefetch) as pool:
+            pending = deque()
+            files = iter(flist)
+            for file in files:
+                pending.append(pool.submit(self.ReadRaw, file))
+                if len(pending) >= prefetch:
+                    break
+            while pending:
+                text = pending.popleft().result()
+                for file in files:
+                    pending.append(pool.submit(self.ReadRaw, file))
+                    break
+                yield text
+    
+    
+    @ProcessingStats.Timed("ReadFiles")
+    def ReadRun(self, flist, headerlen):
+        """Reads Unispec output files into a :class:`~BasicProcessing.SpectralRun`.
         
         :param flist: List of files to read (as returned from :func:`~BasicProcessing.UnispecProcessing.GetFileLists`)
-        :type flist: Nested list of Strings
+        :type flist: List of Strings
         :param headerlen: Constant defining how many lines the header consists of
         :type headerlen: Integer
-        :returns: List of data indexed as [file index][:const:`~BasicProcessing.consts.header` / :const:`~BasicProcessing.consts.data`][row index][:const:`~BasicProcessing.consts.CH_B_WL` / :const:`~BasicProcessing.consts.CH_B` / :const:`~BasicProcessing.consts.CH_A_WL` / :const:`~BasicProcessing.consts.CH_A`]
-        :rtype: Nested list of Strings
+        :returns: Run with spectra indexed as [file index, row index, :const:`~BasicProcessing.consts.CH_B_WL` / :const:`~BasicProcessing.consts.CH_B` / :const:`~BasicProcessing.consts.CH_A_WL` / :const:`~BasicProcessing.consts.CH_A`]
+        :rtype: :class:`~BasicProcessing.SpectralRun`
         
         """
-#            Edited by A McMahon on 11/9/15 - Corrected range values
-        outdata = [[[None],[None]] for item in range(0, len(flist))]
+        if self.Archive is not None:
+            return self.ReadArchive(flist, headerlen)
+        return SpectralRun.from_list(self.ReadFiles(flist, headerlen), flist)
+    
+    
+    @ProcessingStats.Timed("ReadFiles")
+    def ReadCompact(self, flist, headerlen, block=256):
+        """Reads Unispec output files into a :class:`~BasicProcessing.CompactRun`, **block** files at a time so the full-size arrays are never held for the whole run.
         
-        for i in range(0, len(flist)):
-#            Open File
-#           *Edited by SPS on 11/06/2015
-#           sf = open(self.SourcePath + "\\" + flist[i], "Ur")
-            sf = open(os.path.join(self.SourcePath,flist[i]), "Ur")
-            data = sf.readlines()
-            
-#            Read Header
-            outdata[i][consts.header] = data[0:headerlen - 1]
-            
-#            Read Spectra
-            outdata[i][consts.data] = [[float(l) for l in line.split("\t")] for line in data[headerlen + 1:]]
-                      
-            sf.close()
-            
-#            Remove invalid entries at the end of Chan B (last 8 values are system params, not spectra)
-#            Using "-1" prevents problems with different list lengths but ensures the data is out of the range interpolated so it is ignored
-            for d in outdata[i][consts.data][-8::1]:
-                d[0:2] = -1, -1
-            
-        return outdata
+        :param flist: List of files to read
+        :type flist: List of Strings
+        :param headerlen: Constant defining how many lines the header consists of
+        :type headerlen: Integer
+        :param block: Number of files read at a time
+        :type block: Integer
+        :rtype: :class:`~BasicProcessing.CompactRun`
+        
+        """
+        parts = [CompactRun.from_run(self.ReadRun(flist[first:first + block], headerlen)) for first in range(0, len(flist), block)]
+        if not parts:
+            return CompactRun([], [], np.zeros((0, 0, 2), dtype=np.uint16), np.zeros((0, 0, 2)), np.zeros(0, dtype=np.intp), np.zeros(0, SpectralRun.HeaderType))
+        
+#        Merge the wavelength axes of all blocks, keeping each distinct axis once
+        axes = []
+        axis = []
+        for part in parts:
+            index = []
+            for x in part.axes:
+                match = [a for a, known in enumerate(axes) if known.shape == x.shape and (known == x).all()]
+                if not match:
+                    axes.append(x)
+                index.append(match[0] if match else len(axes) - 1)
+            axis.append(np.array(index, dtype=np.intp)[part.axis])
+        return CompactRun([f for part in parts for f in part.files], [h for part in parts for h in part.headers],
+                          np.concatenate([part.counts for part in parts]), np.array(axes), np.concatenate(axis),
+                          np.concatenate([part.fields for part in parts]))
+    
+    
+    def ToRun(self, data):
+        """Returns **data** as a :class:`~BasicProcessing.SpectralRun`, converting it if it is a list from :func:`~BasicProcessing.UnispecProcessing.ReadFiles`.
+        
+        :param data: Run data
+        :type data: :class:`~BasicProcessing.SpectralRun` or nested list
+        :rtype: :class:`~BasicProcessing.SpectralRun`
+        
+        """
+        if isinstance(data, SpectralRun):
+            return data
+        return SpectralRun.from_list(data)
 
         """            
         def ReadHeader(self, sff):
@@ -169,70 +1813,182 @@ class UnispecProcessing:
         """
     
     
-    def CheckSaturation_WL(self, data):
+    @ProcessingStats.Timed("Saturation")
+    def Saturation(self, data, threshold=None):
+        """
+        Computes saturation statistics for every file of a run in a single pass over the run array.
+        
+        :param data: Full run data (as returned from :func:`~BasicProcessing.UnispecProcessing.ReadRun` or :func:`~BasicProcessing.UnispecProcessing.ReadFiles`)
+        :type data: :class:`~BasicProcessing.SpectralRun` or nested list
+        :param threshold: Saturation level, defaults to :data:`~BasicProcessing.UnispecProcessing.SatThreshold`
+        :type threshold: Float
+        :returns: Saturated value counts indexed as *[file index, Ch B(0) / Ch A(1)]*, saturation mask indexed as *[file index, row index, Ch B(0) / Ch A(1)]*, first and last saturated wavelengths indexed as *[file index, Ch B(0) / Ch A(1)]* (NaN where a channel is not saturated)
+        :rtype: Array of Integers, Array of Booleans, Array of Floats, Array of Floats
+        
+        """
+        
+        run = self.ToRun(data)
+        if threshold is None:
+            threshold = self.SatThreshold
+        
+        if isinstance(run, CompactRun):
+            mask = run.counts >= threshold
+            first = np.empty((len(run), 2))
+            last = np.empty((len(run), 2))
+            for a, WLs in enumerate(run.axes):
+                files = run.axis == a
+                first[files] = np.where(mask[files], WLs, np.inf).min(axis=1, initial=np.inf)
+                last[files] = np.where(mask[files], WLs, -np.inf).max(axis=1, initial=-np.inf)
+        else:
+            mask = run.data[:, :, [consts.CH_B, consts.CH_A]] >= threshold
+            WLs = run.data[:, :, [consts.CH_B_WL, consts.CH_A_WL]]
+            first = np.where(mask, WLs, np.inf).min(axis=1, initial=np.inf)
+            last = np.where(mask, WLs, -np.inf).max(axis=1, initial=-np.inf)
+        counts = np.count_nonzero(mask, axis=1)
+        first[counts == 0] = np.nan
+        last[counts == 0] = np.nan
+        
+        return counts, mask, first, last
+    
+    
+    def CheckSaturation_WL(self, data, threshold=None):
         """
         Returns a list of wavelengths with saturated values.
         
-        :param data: List of full run data (as returned from :func:`~BasicProcessing.UnispecProcessing.ReadFiles`)
-        :type data: Nested list of Strings
+        :param data: Full run data (as returned from :func:`~BasicProcessing.UnispecProcessing.ReadRun` or :func:`~BasicProcessing.UnispecProcessing.ReadFiles`)
+        :type data: :class:`~BasicProcessing.SpectralRun` or nested list
+        :param threshold: Saturation level, defaults to :data:`~BasicProcessing.UnispecProcessing.SatThreshold`
+        :type threshold: Float
         :returns: List wavelengths indexed as *[file index][Ch B(0) / Ch A(1)]*
         :rtype: Nested list of Floats
         
         """
         
-        sat = [[[None], [None]] for item in range(0, len(data))]
-        for i in range(0,len(data)):     
-            for k, val in enumerate([row[consts.CH_B] for row in [d[consts.data] for d in data][i]]):
-                if (val >= 65535):
-                    sat[i][0].append(data[i][consts.data][k][consts.CH_B_WL])
-            for k, val in enumerate([row[consts.CH_A] for row in [d[consts.data] for d in data][i]]):
-                if (val >= 65535):
-                    sat[i][1].append(data[i][consts.data][k][consts.CH_A_WL])
-            del(sat[i][0][0]) 
-            del(sat[i][1][0])
+        run = self.ToRun(data)
+        counts, mask, first, last = self.Saturation(run, threshold)
+        
+        WLs = run.data[:, :, [consts.CH_B_WL, consts.CH_A_WL]]
+        sat = [[[], []] for item in range(0, len(run))]
+        for i, chan in zip(*np.nonzero(counts)):
+            sat[i][chan] = list(WLs[i, mask[i, :, chan], chan])
         return sat
  
  
-    def CheckSaturation(self, data):
+    def CheckSaturation(self, data, threshold=None):
         """
         Returns a list with a count of saturated values per channel for each file.
         
-        :param data: List of full run data (as returned from :func:`~BasicProcessing.UnispecProcessing.ReadFiles`)
-        :type data: Nested list of Strings
-        :returns: List of Arrays *[file index, Ch B, Ch A]*
+        :param data: Full run data (as returned from :func:`~BasicProcessing.UnispecProcessing.ReadRun` or :func:`~BasicProcessing.UnispecProcessing.ReadFiles`)
+        :type data: :class:`~BasicProcessing.SpectralRun` or nested list
+        :param threshold: Saturation level, defaults to :data:`~BasicProcessing.UnispecProcessing.SatThreshold`
+        :type threshold: Float
+        :returns: List of Arrays *[file index, Ch B, Ch A]* for files with at least one saturated value
         :rtype: [Integer, Integer, Integer]
         
         """
         
-        sat = [None]
-        for i in range(0,len(data)):  
-            satcount_A = 0   
-            satcount_B = 0
-            for k, val in enumerate([d[consts.data] for d in data][i]):
-                if (val[consts.CH_B] >= 65535):
-                    satcount_B += 1
-                if (val[consts.CH_A] >= 65535):
-                    satcount_A += 1    
-            if (satcount_A > 0 or satcount_B > 0):     
-                sat.append([i, satcount_B, satcount_A])
-        del(sat[0]) 
-        return sat   
+        counts, mask, first, last = self.Saturation(data, threshold)
+        return [[int(i), int(counts[i, 0]), int(counts[i, 1])] for i in np.flatnonzero(counts.any(axis=1))]
     
                 
     def RemoveSaturated(self, orig_data, sat_data):
         """
         Removes data from files indexed in **sat_data** from **orig_data**.
         
-        :param orig_data: List of full run data (as returned from :func:`~BasicProcessing.UnispecProcessing.ReadFiles`)
-        :type orig_data: Nested list of Strings
+        Lists are reduced in place.  A :class:`~BasicProcessing.SpectralRun` cannot be resized in place, so a reduced copy is returned instead.
+        
+        :param orig_data: Full run data (as returned from :func:`~BasicProcessing.UnispecProcessing.ReadRun` or :func:`~BasicProcessing.UnispecProcessing.ReadFiles`)
+        :type orig_data: :class:`~BasicProcessing.SpectralRun` or nested list
         :param sat_data: List of Arrays *[file index, Ch B, Ch A]*
-        :returns: List of reduced run data (maintains list format)
-        :rtype: Nested list of Strings
+        :returns: Reduced run data (maintains list format)
+        :rtype: :class:`~BasicProcessing.SpectralRun` or nested list
         
         """   
+        if isinstance(orig_data, SpectralRun):
+            keep = np.ones(len(orig_data), dtype=bool)
+            keep[[item[0] for item in sat_data]] = False
+            return orig_data.select(keep)
+        
         for idx, item in enumerate(reversed(sat_data)):
             del(orig_data[item[0]])
+        return orig_data
 
+    @ProcessingStats.Timed("Normalize")
+    def Normalize(self, data, normalization=None, dark=None):
+        """
+        Subtracts a dark level from the counts of both channels and scales them by integration time, for all files of a run at once.
+        
+        The dark level is either the minimum counts of each channel from each file's header (*minimum*) or the spectrum of a dark file, scaled by the ratio of integration times.  With *integration* normalization, counts are divided by the integration time in ms so files captured with different integration times can be compared.
+        
+        Saturation should be checked before normalizing, since it is detected from raw counts.
+        
+        :param data: Full run data (as returned from :func:`~BasicProcessing.UnispecProcessing.ReadRun` or :func:`~BasicProcessing.UnispecProcessing.ReadFiles`)
+        :type data: :class:`~BasicProcessing.SpectralRun` or nested list
+        :param normalization: *none* or *integration*, defaults to :data:`~BasicProcessing.UnispecProcessing.Normalization`
+        :type normalization: String
+        :param dark: *none*, *minimum* or the path of a dark Unispec file, defaults to :data:`~BasicProcessing.UnispecProcessing.Dark`
+        :type dark: String
+        :returns: Normalized copy of the run with :data:`~BasicProcessing.SpectralRun.dark` set to the dark level subtracted, or the run itself if there is nothing to do
+        :rtype: :class:`~BasicProcessing.SpectralRun`
+        
+        """
+        if normalization is None:
+            normalization = self.Normalization
+        if dark is None:
+            dark = self.Dark
+        if normalization not in ("none", "integration"):
+            raise ValueError("Unknown normalization: " + str(normalization))
+        
+        run = self.ToRun(data)
+        if normalization == "none" and dark == "none":
+            return run
+        
+        if isinstance(run, CompactRun):
+            counts = run.counts.astype(np.float32)
+            out = counts
+        else:
+            out = run.data.copy()
+#            View of the Ch B and Ch A counts, indexed as [file, row, Ch B / Ch A]
+            counts = out[:, :, consts.CH_B::2]
+        integration = run.fields["integration"]
+        if (normalization == "integration" or dark not in ("none", "minimum")) and np.isnan(integration).any():
+            raise ValueError("No integration time in " + ", ".join(run.files[i] for i in np.flatnonzero(np.isnan(integration))))
+        
+        if dark == "minimum":
+            counts -= run.fields["minimum"][:, None, consts.CH_B::2]
+        elif dark != "none":
+            dark_run = self.ReadDark(dark)
+            if dark_run.data.shape[1] != out.shape[1]:
+                raise ValueError("Dark file " + dark + " has " + str(dark_run.data.shape[1]) + " rows, expected " + str(out.shape[1]))
+            counts -= dark_run.data[0, None, :, consts.CH_B::2] * (integration / dark_run.fields["integration"][0])[:, None, None]
+        
+        if normalization == "integration":
+            counts /= integration[:, None, None]
+        
+        if isinstance(run, CompactRun):
+            out = CompactRun(run.files, run.headers, counts, run.axes, run.axis, run.fields)
+        else:
+            out = SpectralRun(run.files, run.headers, out, run.fields)
+        out.dark = dark
+        return out
+    
+    
+    def ReadDark(self, file):
+        """
+        Reads a dark Unispec file, keeping it for later calls.
+        
+        :param file: Path of the dark file
+        :type file: String
+        :rtype: :class:`~BasicProcessing.SpectralRun`
+        
+        """
+        if file not in self.DarkCache:
+            with open(file, "r") as fh:
+                header, data = self.ParseText(fh.read(), self.HeaderLines)
+            data[-8:, consts.CH_B_WL:consts.CH_B + 1] = -1
+            self.DarkCache[file] = SpectralRun([file], [header], data[None])
+        return self.DarkCache[file]
+    
     """   
     def flatten(self, l, ltypes=(list, tuple)):
         ltype = type(l)
@@ -250,49 +2006,147 @@ class UnispecProcessing:
         return ltype(l)
     """    
     
-    def Interp(self,data):
+    def InterpWeights(self, x, xnew):
+        """
+        Returns the indices and weights for linearly interpolating values on wavelength axis **x** to **xnew**.
+        
+        Results are cached in :data:`~BasicProcessing.UnispecProcessing.InterpCache`, so each distinct instrument calibration is only processed once.  Applying the weights as *(y[hi] - y[lo]) / dx * t + y[lo]* gives the same result as :func:`scipy.interpolate.interp1d` (linear).
+        
+        :param x: Source wavelengths (need not be sorted, may include -1 for invalid rows)
+        :type x: Array of Floats
+        :param xnew: Target wavelengths
+        :type xnew: Array of Floats
+        :returns: Lower indices, upper indices, interval widths and offsets from the lower wavelength
+        :rtype: Array of Integers, Array of Integers, Array of Floats, Array of Floats
+        
+        """
+        
+        key = (x.tobytes(), xnew.tobytes())
+        if key in self.InterpCache:
+            return self.InterpCache[key]
+        
+        order = np.argsort(x, kind="mergesort")
+        xs = x[order]
+        if len(xnew) > 0 and xnew[0] < xs[0]:
+            raise ValueError("A value in x_new is below the interpolation range.")
+        if len(xnew) > 0 and xnew[-1] > xs[-1]:
+            raise ValueError("A value in x_new is above the interpolation range.")
+        
+        j = np.clip(np.searchsorted(xs, xnew, side="right") - 1, 0, len(xs) - 2)
+        lo = order[j]
+        hi = order[j + 1]
+        dx = xs[j + 1] - xs[j]
+        t = xnew - xs[j]
+        
+#        Values at the last source wavelength are taken directly rather than extrapolated from the last interval
+        end = xnew == xs[-1]
+        lo[end] = hi[end]
+        dx[end] = 1
+        t[end] = 0
+        
+        self.InterpCache[key] = lo, hi, dx, t
+        return lo, hi, dx, t
+    
+    
+    @ProcessingStats.Timed("Interp")
+    def Interp(self,data,grid=None):
         """
         Interpolates data to 1 nm.
         
-        Only includes wavelengths where data is present for both channels.
+        Only includes wavelengths where data is present for both channels in every file of the run.  The target grid is computed once per run and files that share a wavelength calibration are interpolated together (see :func:`~BasicProcessing.UnispecProcessing.InterpWeights`).
         
-        :param data: List of run data (as returned from :func:`~BasicProcessing.UnispecProcessing.ReadFiles`)
-        :type data: Nested list of Strings
+        :param data: Run data (as returned from :func:`~BasicProcessing.UnispecProcessing.ReadRun` or :func:`~BasicProcessing.UnispecProcessing.ReadFiles`)
+        :type data: :class:`~BasicProcessing.SpectralRun` or nested list
+        :param grid: Target wavelengths, e.g. from an earlier part of the same run.  Computed from the wavelength limits of **data** if not given.
+        :type grid: Array of Floats
         :returns: Array of interpolated data indexed as [file #, :data:`~BasicProcessing.consts.int_WL` / :data:`~BasicProcessing.consts.int_CH_B` / :data:`~BasicProcessing.consts.int_CH_A`]
         :rtype: [file, WL/Ch B/Ch A] Array of Floats
         
         """
         
-        newdata = np.array([])
-        limlist = [0, 0, 0, 0]
-        for f_idx, file in enumerate(data):   
-           
-            lims = file[consts.header][consts.WL_Lims]
-            limlist[consts.CH_A_WL_Start], limlist[consts.CH_A_WL_End], limlist[consts.CH_B_WL_Start], limlist[consts.CH_B_WL_End] = [float(s.replace('"','')) for s in lims.split() if s[0].isdigit()]
-            
-            WL_min = ceil(max(limlist[0::2]))
-            WL_max = floor(min(limlist[1::2]))
-            
-            xnew = np.arange(WL_min, WL_max, 1)
-            newdata = np.resize(newdata, (len(data), 3, len(xnew)))
-            newdata[f_idx, 0] = list(xnew)
-           
-            #newdata.append([])
-            for chan_idx, chan in enumerate([consts.CH_B_WL, consts.CH_A_WL]):
-                x = [row[chan] for row in [d[consts.data] for d in data][f_idx]]
-                y = [row[chan + 1] for row in [d[consts.data] for d in data][f_idx]]
-                f = interpolate.interp1d(x,y)
-                ynew = f(xnew)
+        run = self.ToRun(data)
+        if grid is not None:
+            xnew = np.asarray(grid, dtype=np.float64)
+        elif len(run) == 0:
+            return np.zeros((0, 3, 0))
+        else:
+            WL_min = ceil(np.max(run.limits[:, 0::2]))
+            WL_max = floor(np.min(run.limits[:, 1::2]))
+            xnew = np.arange(WL_min, WL_max, 1, dtype=np.float64)
+        
+        newdata = np.zeros((len(run), 3, len(xnew)))
+        newdata[:, consts.int_WL] = xnew
+        for chan_idx, chan in enumerate([consts.CH_B_WL, consts.CH_A_WL]):
+            WLs = run.data[:, :, chan]
+            todo = np.ones(len(run), dtype=bool)
+            while todo.any():
+#                Group all remaining files sharing the wavelength axis of the first remaining file
+                x = WLs[np.argmax(todo)]
+                files = todo & (WLs == x).all(axis=1)
+                todo &= ~files
                 
-                newdata[f_idx, chan_idx  + 1] = list(ynew)
+                lo, hi, dx, t = self.InterpWeights(x, xnew)
+                y = np.ascontiguousarray(run.data[files, :, chan + 1])
+                y_lo = np.take(y, lo, axis=1)
+                ynew = np.take(y, hi, axis=1)
+                ynew -= y_lo
+                ynew /= dx
+                ynew *= t
+                ynew += y_lo
+                newdata[files, chan_idx + 1] = ynew
         
-        #del(newdata[-1])
-                #plt.plot(x, y, 'o', xnew, ynew, '-')
-                #plt.show()
+        #plt.plot(x, y, 'o', xnew, ynew, '-')
+        #plt.show()
         
         return newdata
     
     
+    @ProcessingStats.Timed("Interp")
+    def InterpCompact(self, data, grid=None, block=1024):
+        """
+        Interpolates a :class:`~BasicProcessing.CompactRun` to 1 nm as float32, with the wavelengths kept once for the whole run instead of in every file.
+        
+        Uses the same interpolation weights as :func:`~BasicProcessing.UnispecProcessing.Interp`.  Files are processed **block** at a time, so temporary arrays stay small.
+        
+        :param data: Run data (as returned from :func:`~BasicProcessing.UnispecProcessing.ReadCompact`)
+        :type data: :class:`~BasicProcessing.CompactRun`
+        :param grid: Target wavelengths.  Computed from the wavelength limits of **data** if not given.
+        :type grid: Array of Floats
+        :param block: Number of files interpolated at a time
+        :type block: Integer
+        :returns: Target wavelengths, array of interpolated data indexed as [file #, Ch B(0) / Ch A(1)]
+        :rtype: Array of Floats, [file, Ch B/Ch A, WL] Array of float32
+        
+        """
+        
+        run = data
+        if grid is not None:
+            xnew = np.asarray(grid, dtype=np.float64)
+        elif len(run) == 0:
+            return np.zeros(0), np.zeros((0, 2, 0), dtype=np.float32)
+        else:
+            xnew = np.arange(ceil(np.max(run.limits[:, 0::2])), floor(np.min(run.limits[:, 1::2])), 1, dtype=np.float64)
+        
+        newdata = np.empty((len(run), 2, len(xnew)), dtype=np.float32)
+        for a, WLs in enumerate(run.axes):
+            for chan_idx in range(0, 2):
+                lo, hi, dx, t = self.InterpWeights(WLs[:, chan_idx], xnew)
+                dx = dx.astype(np.float32)
+                t = t.astype(np.float32)
+                files = np.flatnonzero(run.axis == a)
+                for first in range(0, len(files), block):
+                    y = run.counts[files[first:first + block], :, chan_idx].astype(np.float32)
+                    y_lo = np.take(y, lo, axis=1)
+                    ynew = np.take(y, hi, axis=1)
+                    ynew -= y_lo
+                    ynew /= dx
+                    ynew *= t
+                    ynew += y_lo
+                    newdata[files[first:first + block], chan_idx] = ynew
+        
+        return xnew, newdata
+    
+    
     def GetDateTime(self, file):
         """
         Gets the time and date from a specified file.
@@ -304,27 +2158,110 @@ class UnispecProcessing:
         
         """
         
-        dt = file[consts.header][consts.datetime].replace('"Time:    ','').replace('"\n','').split('  ')
+        dt = str(SpectralRun.ParseHeaders([file[consts.header]])["time"][0]).split("T")
         return dt
     
     
-    def AvgWPs(self,data):
+    @ProcessingStats.Timed("AvgWPs")
+    def AvgWPs(self, data, mode=None, mask=None, trim=None):
         """
         Averages values for each channel and file in **data**.
         
+        *mean* is the plain average of all files.  *median* and *trimmed* (the mean after dropping the **trim** fraction of the lowest and highest values at each wavelength) are less affected by a single bad white plate.  *unsaturated* averages only the files that are not saturated at each wavelength according to **mask**, using all files where every file is saturated.
+        
         :param data: Array of interpolated data (as returned from :func:`~BasicProcessing.UnispecProcessing.Interp`)
         :type file: Array of Floats indexed as [File, :data:`~BasicProcessing.consts.int_WL` / :data:`~BasicProcessing.consts.int_CH_B` / :data:`~BasicProcessing.consts.int_CH_A`]
+        :param mode: *mean*, *median*, *trimmed* or *unsaturated*, defaults to :data:`~BasicProcessing.UnispecProcessing.WPAverage`
+        :type mode: String
+        :param mask: Saturated values, required for *unsaturated* as **data** no longer holds the raw counts (as returned from :func:`~BasicProcessing.UnispecProcessing.InterpSaturation`)
+        :type mask: Array of Booleans indexed as [File, Ch B / Ch A, WL]
+        :param trim: Fraction dropped from each end for *trimmed*, defaults to :data:`~BasicProcessing.UnispecProcessing.WPTrim`
+        :type trim: Float
         :returns: Array of averaged values for each file
         :rtype: Array of Floats indexed as [:data:`~BasicProcessing.consts.int_WL` / :data:`~BasicProcessing.consts.int_CH_B` / :data:`~BasicProcessing.consts.int_CH_A`]
         
         """
+        if mode is None:
+            mode = self.WPAverage
+        if trim is None:
+            trim = self.WPTrim
+        
         newdata = np.array(np.zeros_like(data[0]))
         newdata[consts.int_WL] = data[0,0]
-        newdata[consts.int_CH_B] = np.average(data[:,1,:], axis=0)
-        newdata[consts.int_CH_A] = np.average(data[:,2,:], axis=0)
+        counts = data[:, consts.int_CH_B:consts.int_CH_A + 1, :]
+        if mode == "mean":
+            newdata[consts.int_CH_B] = np.average(data[:,1,:], axis=0)
+            newdata[consts.int_CH_A] = np.average(data[:,2,:], axis=0)
+        elif mode == "median":
+            newdata[consts.int_CH_B:] = np.median(counts, axis=0)
+        elif mode == "trimmed":
+            cut = int(floor(len(data) * trim))
+            if len(data) - 2 * cut < 1:
+                cut = (len(data) - 1) // 2
+            newdata[consts.int_CH_B:] = np.mean(np.sort(counts, axis=0)[cut:len(data) - cut], axis=0)
+        elif mode == "unsaturated":
+            if mask is None:
+                raise ValueError("White plate average unsaturated needs the saturation mask argument (see InterpSaturation)")
+            valid = ~mask
+            n_valid = valid.sum(axis=0)
+            total = np.where(valid, counts, 0).sum(axis=0)
+            newdata[consts.int_CH_B:] = np.where(n_valid > 0, total / np.maximum(n_valid, 1), np.mean(counts, axis=0))
+        else:
+            raise ValueError("Unknown white plate average: " + str(mode))
         return newdata
     
     
+    def InterpSaturation(self, data, grid):
+        """
+        Maps the saturated values of each file onto an interpolation grid.  A grid point is saturated if either value it is interpolated from is saturated.
+        
+        :param data: Full run data with raw counts (as returned from :func:`~BasicProcessing.UnispecProcessing.ReadRun` or :func:`~BasicProcessing.UnispecProcessing.ReadFiles`)
+        :type data: :class:`~BasicProcessing.SpectralRun` or nested list
+        :param grid: Wavelengths to interpolate to (as in :func:`~BasicProcessing.UnispecProcessing.Interp`)
+        :type grid: Array of Floats
+        :returns: Saturated values
+        :rtype: Array of Booleans indexed as [File, Ch B / Ch A, WL]
+        
+        """
+        run = self.ToRun(data)
+        counts, mask, first, last = self.Saturation(run)
+        
+#        Interpolate the mask in place of the counts; any weight from a saturated value makes the result positive
+        flags = run.data.copy()
+        flags[:, :, consts.CH_B] = mask[:, :, 0]
+        flags[:, :, consts.CH_A] = mask[:, :, 1]
+        return self.Interp(SpectralRun(run.files, run.headers, flags, run.fields), grid)[:, consts.int_CH_B:] > 0
+    
+    
+    @ProcessingStats.Timed("AvgWPs")
+    def InterpWPs(self, WP_data, WP_time, next_WP, next_time, times):
+        """
+        Interpolates linearly in time between the averaged white plates at the start of a run and those of the following run, giving one white plate for each stop.
+        
+        Stops outside the two times use the nearer white plate.
+        
+        :param WP_data: Averaged white plate at the start of the run (as returned from :func:`~BasicProcessing.UnispecProcessing.AvgWPs`)
+        :type WP_data: Array of Floats indexed as [:data:`~BasicProcessing.consts.int_WL` / :data:`~BasicProcessing.consts.int_CH_B` / :data:`~BasicProcessing.consts.int_CH_A`]
+        :param WP_time: Time of **WP_data**
+        :type WP_time: datetime64
+        :param next_WP: Averaged white plate of the following run, on the same wavelengths as **WP_data**
+        :type next_WP: Array of Floats
+        :param next_time: Time of **next_WP**
+        :type next_time: datetime64
+        :param times: Time of each stop
+        :type times: Array of datetime64
+        :returns: White plate for each stop
+        :rtype: Array of Floats indexed as [File, :data:`~BasicProcessing.consts.int_WL` / :data:`~BasicProcessing.consts.int_CH_B` / :data:`~BasicProcessing.consts.int_CH_A`]
+        
+        """
+        span = (next_time - WP_time) / np.timedelta64(1, "s")
+        if span > 0:
+            weight = np.clip(((times - WP_time) / np.timedelta64(1, "s")) / span, 0, 1)
+        else:
+            weight = np.zeros(len(times))
+        return WP_data[None] + weight[:, None, None] * (next_WP - WP_data)[None]
+    
+    
     def plot_Averaging(self,orig_data,avg_data):
         """
         Creates a plot comparing a collection of data with its average.
@@ -339,6 +2276,8 @@ class UnispecProcessing:
         :rtype: Integer
         
         """
+        import matplotlib.pyplot as plt
+
         for chan_idx, chan in enumerate(['Chan B', 'Chan A']):
             axs = plt.subplot(1, 2, chan_idx + 1)  
             plt.title(chan) 
@@ -349,30 +2288,92 @@ class UnispecProcessing:
         return 0
     
     
-    def Refl(self,Stop_data, WP_data):
+    @ProcessingStats.Timed("Refl")
+    def Refl(self,Stop_data, WP_data, dark=None):
         """
         Calculates reflectance for an array of data.
         
         :param Stop_data: Stop data to be used 
         :type Stop_data: Array of Floats indexed as [File, :data:`~BasicProcessing.consts.int_WL` / :data:`~BasicProcessing.consts.int_CH_B` / :data:`~BasicProcessing.consts.int_CH_A`]
-        :param WP_data: White plate data to be used (as returned from :func:`~BasicProcessing.UnispecProcessing.AvgWPs`)
-        :type WP_data: Array of Floats indexed as [:data:`~BasicProcessing.consts.int_WL` / :data:`~BasicProcessing.consts.int_CH_B` / :data:`~BasicProcessing.consts.int_CH_A`]
+        :param WP_data: White plate data to be used (as returned from :func:`~BasicProcessing.UnispecProcessing.AvgWPs`), or one white plate per stop (as returned from :func:`~BasicProcessing.UnispecProcessing.InterpWPs`)
+        :type WP_data: Array of Floats indexed as [(File,) :data:`~BasicProcessing.consts.int_WL` / :data:`~BasicProcessing.consts.int_CH_B` / :data:`~BasicProcessing.consts.int_CH_A`]
+        :param dark: Dark level subtracted from the data (:data:`~BasicProcessing.SpectralRun.dark` of the normalized stops), defaults to :data:`~BasicProcessing.UnispecProcessing.Dark`
+        :type dark: String
         :returns: Array of reflectance values for each file
         :rtype: [File, WL] Float
         
         """
         
-        refl = np.array(np.zeros((len(Stop_data),2,len(Stop_data[0, 0]))))
+        refl = np.empty((len(Stop_data), 2, Stop_data.shape[-1]))
+        if self.Stats is not None:
+            self.Stats.Count("stops", len(Stop_data))
 
-        for s_idx, stop in enumerate(Stop_data):
-            refl[s_idx, 0] = stop[consts.int_WL]
-            #Reflec = (I_up / I_WP) * (I_trg / I_up)
-            # Edited by A. McMahon 11/9/15 - Channels A and B swapped
-            refl[s_idx, 1] = (stop[consts.int_CH_B] / WP_data[consts.int_CH_A]) * (stop[consts.int_CH_A] / stop[consts.int_CH_B])
+        refl[:, 0] = Stop_data[:, consts.int_WL]
+        #Reflec = (I_up / I_WP) * (I_trg / I_up)
+        # Edited by A. McMahon 11/9/15 - Channels A and B swapped
+        with np.errstate(divide="ignore", invalid="ignore"):
+            refl[:, 1] = (Stop_data[:, consts.int_CH_B] / WP_data[..., consts.int_CH_A, :]) * (Stop_data[:, consts.int_CH_A] / Stop_data[:, consts.int_CH_B])
+        refl[:, 1][self.ReflMask(Stop_data[:, consts.int_CH_B], WP_data[..., consts.int_CH_A, :], dark)] = np.nan
         
         return refl
     
     
+    def ReflMask(self, CH_B, WP_CH_A, dark=None):
+        """
+        Returns where reflectance cannot be computed: the stop's Ch B or the white plate's Ch A is not positive, or, when a dark level is subtracted (see :func:`~BasicProcessing.UnispecProcessing.Normalize`), the white plate is below :data:`~BasicProcessing.UnispecProcessing.DarkFloor` of its peak.
+        
+        Subtracting the *minimum* dark level leaves counts of zero or close to it at the ends of the spectrum, where the ratios are dominated by noise.
+        
+        :param CH_B: Ch B of the stops
+        :type CH_B: Array of Floats indexed as [File, WL]
+        :param WP_CH_A: Ch A of the white plate, or of one white plate per stop
+        :type WP_CH_A: Array of Floats indexed as [(File,) WL]
+        :param dark: Dark level subtracted from the data, defaults to :data:`~BasicProcessing.UnispecProcessing.Dark`
+        :type dark: String
+        :returns: Mask of values that are set to NaN
+        :rtype: [File, WL] Array of Booleans
+        
+        """
+        
+        if dark is None:
+            dark = self.Dark
+        floor = 0
+        if dark != "none" and WP_CH_A.shape[-1] > 0:
+            floor = self.DarkFloor * WP_CH_A.max(axis=-1, keepdims=True)
+        return (CH_B <= 0) | (WP_CH_A <= floor)
+    
+    
+    @ProcessingStats.Timed("Refl")
+    def ReflCompact(self, Stop_data, WP_data, dark=None):
+        """
+        Calculates reflectance in place in the float32 array from :func:`~BasicProcessing.UnispecProcessing.InterpCompact`, with the same formula as :func:`~BasicProcessing.UnispecProcessing.Refl`.
+        
+        :param Stop_data: Interpolated stops, overwritten
+        :type Stop_data: Array of float32 indexed as [File, Ch B(0) / Ch A(1), WL]
+        :param WP_data: White plate data on the same wavelengths (as returned from :func:`~BasicProcessing.UnispecProcessing.AvgWPs` or :func:`~BasicProcessing.UnispecProcessing.InterpWPs`)
+        :type WP_data: Array of Floats indexed as [(File,) :data:`~BasicProcessing.consts.int_WL` / :data:`~BasicProcessing.consts.int_CH_B` / :data:`~BasicProcessing.consts.int_CH_A`]
+        :param dark: Dark level subtracted from the data, defaults to :data:`~BasicProcessing.UnispecProcessing.Dark`
+        :type dark: String
+        :returns: Reflectance values, a view of **Stop_data**
+        :rtype: [File, WL] Array of float32
+        
+        """
+        
+        if self.Stats is not None:
+            self.Stats.Count("stops", len(Stop_data))
+        
+        CH_B = Stop_data[:, 0]
+        CH_A = Stop_data[:, 1]
+        mask = self.ReflMask(CH_B, WP_data[..., consts.int_CH_A, :], dark)
+        #Same as Refl, evaluated in place: (CH_B / WP CH_A) * (CH_A / CH_B)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            np.divide(CH_A, CH_B, out=CH_A)
+            np.divide(CH_B, WP_data[..., consts.int_CH_A, :], out=CH_B)
+            np.multiply(CH_B, CH_A, out=CH_A)
+        CH_A[mask] = np.nan
+        return CH_A
+    
+    
     def plot_R(self,R_data,idx):
         """
         Creates a plot from reflectance data.
@@ -385,58 +2386,414 @@ class UnispecProcessing:
         :rtype: Integer
         
         """
+        import matplotlib.pyplot as plt
+
         plt.title('Reflectance') 
         plt.plot(R_data[idx, 0], R_data[idx, 1], '-')           
         plt.show()
         return 0
     
-    def WriteOutput(self,data,path,filename):
+    
+    def WPStability(self, data):
+        """
+        Returns the coefficient of variation across the white plates of a run: the median, over the rows of both channels, of the standard deviation divided by the mean of the raw counts.
+        
+        :param data: White plate data (as returned from :func:`~BasicProcessing.UnispecProcessing.ReadRun`)
+        :type data: :class:`~BasicProcessing.SpectralRun`
+        :returns: Coefficient of variation (0 for a single white plate)
+        :rtype: Float
+        
+        """
+        
+        counts = self.ToRun(data).data[:, :, [consts.CH_B, consts.CH_A]]
+        mean = counts.mean(axis=0)
+        valid = mean > 0
+        if not valid.any():
+            return np.nan
+        return float(np.median(counts.std(axis=0)[valid] / mean[valid]))
+    
+    
+    @ProcessingStats.Timed("QC")
+    def QCMetrics(self, data, R, wp_cv=np.nan):
+        """
+        Computes quality control metrics for all stops of a run in one pass over the run arrays.
+        
+        :param data: Stop data (as returned from :func:`~BasicProcessing.UnispecProcessing.ReadRun`)
+        :type data: :class:`~BasicProcessing.SpectralRun`
+        :param R: Reflectance of the same stops (as returned from :func:`~BasicProcessing.UnispecProcessing.Refl`)
+        :type R: Array of Floats
+        :param wp_cv: White plate stability of the run (as returned from :func:`~BasicProcessing.UnispecProcessing.WPStability`)
+        :type wp_cv: Float
+        :returns: Fraction of saturated values (largest of both channels), signal level (smaller of the header maximum counts of both channels), **wp_cv**, fraction of reflectance values outside *ReflRange* or not finite, battery voltage, for each stop
+        :rtype: Array of :data:`~BasicProcessing.UnispecProcessing.QCType`
+        
+        """
+        
+        run = self.ToRun(data)
+        metrics = np.zeros(len(run), dtype=self.QCType)
+        counts, mask, first, last = self.Saturation(run)
+#        Rows without a wavelength (the system parameters at the end of Ch B, padding) are not checked for saturation
+        if isinstance(run, CompactRun):
+            checked = np.count_nonzero(run.axes >= 0, axis=1)[run.axis]
+        else:
+            checked = np.count_nonzero(run.data[:, :, [consts.CH_B_WL, consts.CH_A_WL]] >= 0, axis=1)
+        metrics["saturation"] = (counts / np.maximum(checked, 1)).max(axis=1)
+        metrics["signal"] = run.fields["maximum"][:, [consts.CH_B, consts.CH_A]].min(axis=1)
+        metrics["wp_cv"] = wp_cv
+        lo, hi = self.QC["ReflRange"] if self.QC is not None else (0, 1.5)
+        with np.errstate(invalid="ignore"):
+            metrics["out_of_range"] = (~((R[:, 1] >= lo) & (R[:, 1] <= hi))).mean(axis=1)
+        metrics["battery"] = run.fields["battery"]
+        return metrics
+    
+    
+    def QCReject(self, metrics):
+        """
+        Applies the limits in :data:`~BasicProcessing.UnispecProcessing.QC` to quality control metrics, setting the *rejected* and *reasons* fields in place.  A limit that is not configured, or a metric that is unknown (NaN), never rejects a stop.
+        
+        :param metrics: Metrics (as returned from :func:`~BasicProcessing.UnispecProcessing.QCMetrics`)
+        :type metrics: Array of :data:`~BasicProcessing.UnispecProcessing.QCType`
+        :returns: Mask of rejected stops
+        :rtype: Array of Booleans
+        
+        """
+        
+        QC = self.QC or {}
+        rules = [("MaxSaturation", "saturation", np.greater), ("MinSignal", "signal", np.less), ("MaxWPCV", "wp_cv", np.greater),
+                 ("MaxOutOfRange", "out_of_range", np.greater), ("MinBattery", "battery", np.less)]
+        reasons = np.zeros(len(metrics), dtype=metrics.dtype["reasons"])
+        for key, field, compare in rules:
+            if QC.get(key) is not None:
+                failed = compare(metrics[field], QC[key])
+                reasons[failed] = np.char.add(reasons[failed], field + " ")
+        metrics["reasons"] = np.char.strip(reasons)
+        metrics["rejected"] = metrics["reasons"] != ""
+        return metrics["rejected"]
+    
+    
+    def WriteQCReport(self, metrics, files, path, filename):
+        """
+        Creates a CSV file with the quality control metrics, rejection flag and reasons of each stop of a run.  The file is written under a temporary name and renamed when complete.
+        
+        :param metrics: Metrics with rejections applied (see :func:`~BasicProcessing.UnispecProcessing.QCReject`)
+        :type metrics: Array of :data:`~BasicProcessing.UnispecProcessing.QCType`
+        :param files: Stop file of each row
+        :type files: List of Strings
+        :param path: Directory to save the generated file in
+        :type path: String
+        :param filename: Filename to use for the generated file
+        :type filename: String
+        :returns: Filename of the generated file
+        :rtype: String
+        
+        """
+        
+        names = ["saturation", "signal", "wp_cv", "out_of_range", "battery"]
+        with AtomicFile(os.path.join(path,filename), self.Stats) as tmpname:
+            with open(tmpname, "w") as fh:
+                fh.write("Stop,File," + ",".join(names) + ",rejected,reasons\n")
+                for idx, (file, row) in enumerate(zip(files, metrics.tolist())):
+                    fh.write(str(idx + 1) + "," + file + "," + ",".join(("%." + str(self.Precision) + "g") % value for value in row[:len(names)]) +
+                             "," + str(int(row[-2])) + "," + row[-1] + "\n")
+        
+        print("Rejected " + str(int(metrics["rejected"].sum())) + " of " + str(len(metrics)) + " stop(s), report written to " + filename + ".")
+        return filename
+    
+    def FormatRows(self, data, first=1, precision=None):
+        """
+        Formats reflectance data as CSV rows in a single formatting call.
+        
+        Each row starts with a newline and the stop number, matching the layout written by :func:`~BasicProcessing.UnispecProcessing.WriteOutput`.
+        
+        :param data: Array of reflectance data (as returned from :func:`~BasicProcessing.UnispecProcessing.Refl`)
+        :type data: Array of Floats indexed as [File, WL/Reflectance]
+        :param first: Stop number of the first row
+        :type first: Integer
+        :param precision: Number of decimal places, defaults to :data:`~BasicProcessing.UnispecProcessing.Precision`
+        :type precision: Integer
+        :rtype: String
+        
+        """
+        
+        if precision is None:
+            precision = self.Precision
+        
+        values = np.empty((len(data), data.shape[2] + 1))
+        values[:, 0] = np.arange(first, first + len(data))
+        values[:, 1:] = data[:, 1]
+        rowformat = "\n%d" + (",%." + str(precision) + "f") * data.shape[2]
+        return (rowformat * len(data)) % tuple(values.ravel().tolist())
+    
+    
+    def UniqueFilename(self, filename, exists):
+        """
+        Returns **filename**, or if it is already used, the first free name with a "_n" suffix before the extension.
+        
+        :param filename: Preferred filename
+        :type filename: String
+        :param exists: Function returning True if a name is already used
+        :type exists: Function
+        :rtype: String
+        
+        """
+        
+        base, ext = os.path.splitext(filename)
+        n = 0
+        while exists(filename):
+            n += 1
+            filename = base + "_" + str(n) + ext
+        return filename
+    
+    
+    @ProcessingStats.Timed("WriteOutput")
+    def WriteOutput(self,data,path,filename,overwrite=False,meta=None):
         """
         Creates a CSV file of the reflectance data in *data*.
         
         A file should be generated for each set of stops.  Each row then represents a stop and each column corresponds with a wavelength.
         
+        **data** can also be an iterator of arrays (e.g. a generator processing a run a few stops at a time), in which case each array is written as soon as it is produced.
+        
+        The file is written under a temporary name in the same directory and renamed when complete, so other programs never see a partially written file.
+        
         :param data: Array of reflectance data (as returned from :func:`~BasicProcessing.UnispecProcessing.Refl`)
-        :type data: Array of Floats indexed as [File, :data:`~BasicProcessing.consts.int_WL` / :data:`~BasicProcessing.consts.int_CH_B` / :data:`~BasicProcessing.consts.int_CH_A`]
+        :type data: Array of Floats indexed as [File, :data:`~BasicProcessing.consts.int_WL` / :data:`~BasicProcessing.consts.int_CH_B` / :data:`~BasicProcessing.consts.int_CH_A`], or iterator of such arrays
         :param path: Directory to save the generated file in
         :type path: String
         :param filename: Filename to use for the generated file
         :type filename: String
-        :returns: 0
-        :rtype: Integer
+        :param overwrite: Replace an existing file with the same name instead of adding a "_n" suffix
+        :type overwrite: Boolean
+        :param meta: Stop metadata, only used by the *hdf5* format (see :func:`~BasicProcessing.UnispecProcessing.WriteHDF5`)
+        :type meta: Dictionary
+        :returns: Filename of the generated file
+        :rtype: String
         
         """
         
+        if self.OutputFormat == "hdf5":
+            return self.WriteHDF5(data, path, filename, overwrite, meta)
+        
         # Added by SPS 11/06/2015 to create output directory on-the-fly
         if not os.path.exists(os.path.dirname(os.path.join(path,filename))):
             os.makedirs(os.path.dirname(os.path.join(path,filename)))
         
-        if (os.path.isfile(os.path.join(path,filename)) == True) :
-            n = 0
-            exists = True
-            while (exists) :
-                n += 1
-                if (n > 1):
-                    filename = filename[:len(filename) - 6] + "_" + str(n) + filename[-4:]
-                else:
-                    filename = filename[:len(filename) - 4] + "_" + str(n) + filename[-4:]
-                exists = os.path.isfile(os.path.join(path,filename))
+        if not overwrite:
+            filename = self.UniqueFilename(filename, lambda f: os.path.isfile(os.path.join(path,f)))
     
         print("Writing file: " + filename)    
         
+        if isinstance(data, np.ndarray):
+            data = [data]
+        
+        rows = 0
         # *Edited by SPS 11/06/2015
         #fh = open(path + r'\\' + filename, "a")
-        fh = open(os.path.join(path,filename), "a")
-
-        #Write header
-        fh.write("Stop," + ",".join(['%f' % num for num in data[0,0]])) #str(data[0,0])[2:-2].replace("  ", ",").replace(" ","").replace("\n",""))
-       
-        for s_idx, stop in enumerate(data):
-            fh.write("\n" + str(s_idx+1) + "," + ",".join(['%f' % num for num in stop[1]])) #str(stop[1])[2:-2].replace("  ", ",").replace(" ","").replace("\n",""))
+        with AtomicFile(os.path.join(path,filename), self.Stats) as tmpname:
+            with open(tmpname, "w", buffering=1024 ** 2) as fh:
+                for chunk in data:
+                    if len(chunk) == 0:
+                        continue
+                    #Write header
+                    if rows == 0:
+                        fh.write("Stop," + ",".join(['%.*f' % (self.Precision, num) for num in chunk[0,0]]))
+                    
+                    fh.write(self.FormatRows(chunk, rows + 1))
+                    rows += len(chunk)
+        
+        print("Wrote " + str(rows) + " row(s).\nFile closed.") 
+        
+        return filename
+    
+    
+    @ProcessingStats.Timed("WriteOutput")
+    def WriteTable(self, values, names, path, filename):
+        """
+        Creates a CSV file of values derived from reflectance, such as spectral indices or sensor bands, with one row per stop and one column per name.
+        
+        The file is written under a temporary name and renamed when complete, as in :func:`~BasicProcessing.UnispecProcessing.WriteOutput`.  An existing file with the same name is replaced.
+        
+        :param values: Values (as returned from :func:`~BasicProcessing.SpectralIndices.Compute` or :func:`~BasicProcessing.SensorBands.Resample`)
+        :type values: Array of Floats indexed as [File, column]
+        :param names: Column names
+        :type names: List of Strings
+        :param path: Directory to save the generated file in
+        :type path: String
+        :param filename: Filename to use for the generated file
+        :type filename: String
+        :returns: Filename of the generated file
+        :rtype: String
+        
+        """
+        
+        table = np.empty((len(values), 2, len(names)))
+        table[:, 1] = values
+        
+        with AtomicFile(os.path.join(path,filename), self.Stats) as tmpname:
+            with open(tmpname, "w") as fh:
+                fh.write("Stop," + ",".join(names))
+                fh.write(self.FormatRows(table))
+        
+        print("Wrote " + str(len(values)) + " row(s) to " + filename + ".")
+        return filename
+    
+    
+    @ProcessingStats.Timed("WriteOutput")
+    def WriteHDF5(self, data, path, filename, overwrite=False, meta=None):
+        """
+        Writes reflectance data for a run to an HDF5 file (requires `h5py <http://www.h5py.org/>`_).
+        
+        Each run is a group named after **filename** (without extension) containing:
+        
+        - *wavelength*: [WL] wavelengths, stored once for the run
+        - *reflectance*: [stop, WL] reflectance values, chunked so wavelength ranges or stops can be read on their own
+        - *stop*: [stop] stop numbers (starting from 1, as in the CSV files)
+        - *file*, *header*: [stop] and [stop, line] source file names and header lines, if given in **meta**
         
-        fh.flush()
-        fh.close()
+        and the run's date and time as the *datetime* attribute.  If :data:`~BasicProcessing.UnispecProcessing.SeasonFile` is set, all runs are added to that file; otherwise each run gets its own file in a temporary file that is renamed when complete.  Use :func:`~BasicProcessing.UnispecProcessing.ReadOutput` to read the data back.
         
-        print("Wrote " + str(len(data)) + " row(s).\nFile closed.") 
+        :param data: Array (or iterator of arrays) of reflectance data (as returned from :func:`~BasicProcessing.UnispecProcessing.Refl`)
+        :type data: Array of Floats indexed as [File, WL/Reflectance]
+        :param path: Directory to save the generated file in
+        :type path: String
+        :param filename: Filename of the run, the extension is replaced with ".h5"
+        :type filename: String
+        :param overwrite: Replace an existing run with the same name instead of adding a "_n" suffix
+        :type overwrite: Boolean
+        :param meta: Stop metadata with keys *datetime* (String), *files* (List of Strings) and *headers* (Nested list of Strings).  *headers* may be filled in while **data** is being consumed.
+        :type meta: Dictionary
+        :returns: Name of the generated file (and run group, separated by ":", for season files)
+        :rtype: String
+        
+        """
+        
+        import h5py
+        
+        if meta is None:
+            meta = {}
+        if not os.path.exists(path):
+            os.makedirs(path)
+        
+        run = os.path.splitext(filename)[0]
+        if self.SeasonFile:
+            h5name = self.SeasonFile
+            with h5py.File(os.path.join(path, h5name), "a") as h5:
+                if overwrite and run in h5:
+                    del h5[run]
+                run = self.UniqueFilename(run, lambda r: r in h5)
+                print("Writing file: " + h5name + " (" + run + ")")
+                try:
+                    rows = self.WriteHDF5Run(h5, run, data, meta)
+                except BaseException:
+                    if run in h5:
+                        del h5[run]
+                    raise
+            if self.Stats is not None:
+                self.Stats.Count("files_written")
+        else:
+            h5name = run + ".h5"
+            if not overwrite:
+                h5name = self.UniqueFilename(h5name, lambda f: os.path.isfile(os.path.join(path, f)))
+            print("Writing file: " + h5name + " (" + run + ")")
+            with AtomicFile(os.path.join(path, h5name), self.Stats) as tmpname:
+                with h5py.File(tmpname, "w") as h5:
+                    rows = self.WriteHDF5Run(h5, run, data, meta)
+        
+        print("Wrote " + str(rows) + " row(s).\nFile closed.")
+        
+        return h5name + ":" + run if self.SeasonFile else h5name
+    
+    
+    def WriteHDF5Run(self, h5, run, data, meta):
+        """
+        Writes the group of one run to an open HDF5 file, in the layout described in :func:`~BasicProcessing.UnispecProcessing.WriteHDF5`.
+        
+        :param h5: Open HDF5 file
+        :type h5: :class:`h5py.File`
+        :param run: Name of the run group
+        :type run: String
+        :param data: Array (or iterator of arrays) of reflectance data (as returned from :func:`~BasicProcessing.UnispecProcessing.Refl`)
+        :type data: Array of Floats indexed as [File, WL/Reflectance]
+        :param meta: Stop metadata (see :func:`~BasicProcessing.UnispecProcessing.WriteHDF5`)
+        :type meta: Dictionary
+        :returns: Number of stops written
+        :rtype: Integer
+        
+        """
+        
+        import h5py
+        
+        if isinstance(data, np.ndarray):
+            data = [data]
+        
+        rows = 0
+        group = h5.create_group(run)
+        for chunk in data:
+            if len(chunk) == 0:
+                continue
+            if rows == 0:
+                group.create_dataset("wavelength", data=chunk[0, 0])
+                refl = group.create_dataset("reflectance", shape=(0, chunk.shape[2]), maxshape=(None, chunk.shape[2]), dtype=chunk.dtype, chunks=(64, min(128, chunk.shape[2])))
+            refl.resize(rows + len(chunk), axis=0)
+            refl[rows:] = chunk[:, 1]
+            rows += len(chunk)
+        if rows == 0:
+            #A run without stops (e.g. all removed by segmentation) still gets its datasets, so it reads back as empty
+            group.create_dataset("wavelength", data=np.zeros(0))
+            group.create_dataset("reflectance", shape=(0, 0), maxshape=(None, None), dtype=np.float64)
+        
+        group.create_dataset("stop", data=np.arange(1, rows + 1))
+        if "datetime" in meta:
+            group.attrs["datetime"] = meta["datetime"]
+        if meta.get("files"):
+            group.create_dataset("file", data=np.array(meta["files"], dtype=h5py.string_dtype()))
+        if meta.get("headers"):
+            group.create_dataset("header", data=np.array([[line.strip() for line in h] for h in meta["headers"]], dtype=h5py.string_dtype()))
+        return rows
+    
+    
+    def ReadOutput(self, filename, run=None, wl_range=None, stops=None):
+        """
+        Reads reflectance data written by :func:`~BasicProcessing.UnispecProcessing.WriteHDF5`, loading only the requested wavelengths and stops from the file.
+        
+        :param filename: HDF5 file
+        :type filename: String
+        :param run: Name of the run group, may be omitted if the file holds a single run
+        :type run: String
+        :param wl_range: Lowest and highest wavelength to read (inclusive), or None for all
+        :type wl_range: (Float, Float)
+        :param stops: Stop numbers to read (starting from 1), or None for all
+        :type stops: List of Integers
+        :returns: Array of reflectance values in the same layout as :func:`~BasicProcessing.UnispecProcessing.Refl`, with no stops or wavelengths for a run without stops
+        :rtype: [File, WL/Reflectance] Array of Floats
+        
+        """
+        
+        import h5py
+        
+        with h5py.File(filename, "r") as h5:
+            if run is None:
+                if len(h5) != 1:
+                    raise KeyError("File holds " + str(len(h5)) + " runs, one must be selected: " + ", ".join(h5.keys()))
+                run = list(h5.keys())[0]
+            group = h5[run]
+            if "reflectance" not in group:
+                #Written without datasets because the run had no stops
+                return np.zeros((0, 2, 0))
+            
+            wl = group["wavelength"][:]
+            cols = slice(0, len(wl))
+            if wl_range is not None:
+                cols = slice(int(np.searchsorted(wl, wl_range[0], side="left")), int(np.searchsorted(wl, wl_range[1], side="right")))
+            
+            if stops is None:
+                refl = group["reflectance"][:, cols]
+            else:
+                #h5py reads rows given in increasing order, each once, so repeated or unordered stops are expanded afterwards
+                rows, inverse = np.unique(np.asarray(stops, dtype=np.intp) - 1, return_inverse=True)
+                refl = group["reflectance"][rows, cols][inverse.ravel()]
         
-        return 0
\ No newline at end of file
+        R = np.zeros((len(refl), 2, refl.shape[1]), dtype=refl.dtype)
+        R[:, 0] = wl[cols]
+        R[:, 1] = refl
+        return R
\ No newline at end of file
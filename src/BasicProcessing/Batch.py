@@ -0,0 +1,175 @@
+'''
+Processes many days of Unispec data in one invocation.
+
+Run with "python Batch.py OUTPUT_ROOT SOURCE [SOURCE ...]" or
+"python Batch.py OUTPUT_ROOT --root DIRECTORY --from 20150625 --to 20150810".
+Every source directory is processed as Main.py would with SourcePath set to
+it, writing to "OUTPUT_ROOT/<directory name>_processed", so the sources of a
+batch must have different directory names.  Other settings are read from
+config.txt (or --config FILE).  The interpreter, libraries and the process
+pool are only started once, and a manifest of the files written for each
+directory, with timings, is saved as OUTPUT_ROOT/manifest.json.
+'''
+from BasicProcessing import UnispecProcessing
+from BasicProcessing import FileCatalog
+from BasicProcessing import ProcessingStats
+import Main
+import argparse
+import datetime
+import os.path
+import re
+import time
+
+
+#: Matches day directories such as 20150625, optionally followed by a suffix
+DayPattern = re.compile(r"^(\d{8})")
+
+
+def ListDays(root, first=None, last=None):
+    """
+    Returns the day directories below **root**, optionally limited to a range of dates, in date order.
+
+    :param root: Directory containing one subdirectory per day, named YYYYMMDD
+    :type root: String
+    :param first: First date to include, as YYYYMMDD, or None for no limit
+    :type first: String
+    :param last: Last date to include, as YYYYMMDD, or None for no limit
+    :type last: String
+    :rtype: List of Strings
+
+    """
+
+    days = []
+    for entry in sorted(os.listdir(root)):
+        match = DayPattern.match(entry)
+        if match is None or not os.path.isdir(os.path.join(root, entry)):
+            continue
+        if (first is not None and match.group(1) < first) or (last is not None and match.group(1) > last):
+            continue
+        days.append(os.path.join(root, entry))
+    return days
+
+
+def ProcessSource(Spec, source_path, output_path, pool=None, incremental=False, chunk=None):
+    """
+    Points **Spec** at a source directory and processes it with :func:`Main.ProcessAll`.
+
+    The state file and catalog (if one is configured) are kept per directory, in **output_path**.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param source_path: Directory of Unispec files
+    :type source_path: String
+    :param output_path: Directory to write to
+    :type output_path: String
+    :param pool: Process pool (see :func:`Main.init_worker`), or None
+    :type pool: :class:`multiprocessing.pool.Pool`
+    :param incremental: Only process runs that are new or changed
+    :type incremental: Boolean
+    :param chunk: Number of stops to process at a time, or None
+    :type chunk: Integer
+    :returns: Manifest entry for the directory
+    :rtype: Dictionary
+
+    """
+
+    Spec.SourcePath = source_path
+    Spec.OutputPath = output_path
+    Spec.StateFile = os.path.join(output_path, "processed_runs.json")
+    if Spec.Catalog is not None:
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+        Spec.Catalog = FileCatalog(os.path.join(output_path, os.path.basename(Spec.Catalog.Path)), source_path, Spec.WP_identifier, Spec.RunGap)
+
+    state = Main.LoadState(Spec.StateFile) if incremental else None
+    produced = []
+    start = time.perf_counter()
+    Main.ProcessAll(Spec, pool, state, chunk=chunk, produced=produced)
+    return {"source": source_path, "output": output_path, "runs": produced, "seconds": round(time.perf_counter() - start, 3)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate reflectance CSV files from many directories of Unispec data.")
+    parser.add_argument("output", help="directory that a subdirectory is written to for each source")
+    parser.add_argument("sources", nargs="*", help="directories of .spu files")
+    parser.add_argument("--root", help="also process the day directories (named YYYYMMDD) in this directory")
+    parser.add_argument("--from", dest="first", metavar="YYYYMMDD", help="first day processed from --root")
+    parser.add_argument("--to", dest="last", metavar="YYYYMMDD", help="last day processed from --root")
+    parser.add_argument("--config", default=os.path.join(str(os.path.realpath('.')), "config.txt"), help="configuration file (default config.txt)")
+    parser.add_argument("--manifest", help="manifest file (default manifest.json in the output directory)")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes used to process runs (default 1)")
+    parser.add_argument("--incremental", action="store_true", help="only process runs that are new or changed since the last batch")
+    parser.add_argument("--chunk", type=int, metavar="STOPS", help="read and write stops this many at a time to bound memory use")
+    parser.add_argument("--stats", metavar="FILE", help="append per-stage timing of each run to FILE as JSON lines")
+    parser.add_argument("--profile", metavar="FILE", help="save a cProfile dump of the main process to FILE")
+    args = parser.parse_args(argv)
+    if args.chunk and args.workers > 1:
+        parser.error("--chunk cannot be combined with --workers")
+    for date in (args.first, args.last):
+        if date is not None:
+            try:
+                datetime.datetime.strptime(date, "%Y%m%d")
+            except ValueError:
+                parser.error("dates must be given as YYYYMMDD: " + date)
+
+    sources = [os.path.realpath(source) for source in args.sources]
+    if args.root:
+        sources += [source for source in ListDays(os.path.realpath(args.root), args.first, args.last) if source not in sources]
+    if not sources:
+        parser.error("no source directories given")
+    #Each source is written to a directory named after it, which also holds its state file and catalog
+    names = {}
+    for source_path in sources:
+        names.setdefault(os.path.basename(source_path), []).append(source_path)
+    clashes = [paths for paths in names.values() if len(paths) > 1]
+    if clashes:
+        parser.error("sources with the same directory name would be written to the same output directory, process them in separate batches: " +
+                     "; ".join(", ".join(paths) for paths in clashes))
+
+    Spec = UnispecProcessing(args.config)
+    if Spec.Archive is not None:
+        parser.error("the configured Archive already covers all its days, process it with Main.py")
+    if args.stats:
+        Spec.Stats = ProcessingStats(args.stats)
+
+    manifest_file = args.manifest or os.path.join(args.output, "manifest.json")
+    manifest = {"config": os.path.realpath(args.config), "started": datetime.datetime.now().isoformat(timespec="seconds"), "sources": []}
+
+    pool = None
+    if args.workers > 1:
+        import multiprocessing
+
+        pool = multiprocessing.Pool(args.workers, Main.init_worker, (args.config, Spec.Stats is not None))
+
+    profile = None
+    if args.profile:
+        import cProfile
+
+        profile = cProfile.Profile()
+        profile.enable()
+
+    start = time.perf_counter()
+    try:
+        for source_path in sources:
+            output_path = os.path.join(args.output, os.path.basename(source_path) + "_processed")
+            print("Processing " + source_path + " to " + output_path)
+            manifest["sources"].append(ProcessSource(Spec, source_path, output_path, pool, args.incremental, args.chunk))
+            manifest["seconds"] = round(time.perf_counter() - start, 3)
+            #Saved after every directory so an interrupted batch still records what was written
+            Main.SaveState(manifest_file, manifest)
+    except KeyboardInterrupt:
+        print("Stopped.")
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(args.profile)
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    print("Processed " + str(len(manifest["sources"])) + " of " + str(len(sources)) + " director" + ("y" if len(sources) == 1 else "ies") +
+          " in %.3f s.  Manifest written to " % (time.perf_counter() - start) + manifest_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,972 @@
+'''
+Benchmarks for the BasicProcessing library.
+
+Run from this directory with "python Benchmark.py [data directory]".  The
+directory defaults to the first day of the bundled example data.  With
+--synthetic, runs of generated files are used instead (see Synthetic.py), so
+results can be compared across machines and data sizes.  --only selects
+benchmarks, and the per-stage results of the Pipeline benchmark can be saved
+as JSON with --save and compared with a previous run with --compare.
+'''
+from BasicProcessing import UnispecProcessing
+from BasicProcessing import CompactRun
+import BasicProcessing
+import Main
+import Synthetic
+from math import floor, ceil
+import argparse
+import json
+import os.path
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+
+def make_spec(source_path, output_path="", cls=UnispecProcessing):
+    """
+    Creates a :class:`~BasicProcessing.UnispecProcessing` object from a temporary configuration file.
+
+    :param source_path: Directory of Unispec files
+    :type source_path: String
+    :param output_path: Directory for generated files
+    :type output_path: String
+    :param cls: Class to create
+    :type cls: :class:`~BasicProcessing.UnispecProcessing` or a subclass
+    :returns: Configured processing object
+    :rtype: :class:`~BasicProcessing.UnispecProcessing`
+
+    """
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as cf:
+        cf.write("[Input]\nSourcePath = " + source_path + "\nWP_Identifier = 000\nHeaderLines = 10\n\n"
+                 "[Output]\nOutputPath = " + output_path + "\nOutputPrefix = Bench_\n")
+    try:
+        return cls(cf.name)
+    finally:
+        os.remove(cf.name)
+
+
+class StageTimer:
+    """Accumulates wall time, CPU time, item and byte counts and peak memory for each stage of a pipeline."""
+
+    def __init__(self, memory=False):
+        #: Results keyed by stage name, in the order stages were first run
+        self.stages = {}
+        #: Whether to measure peak memory with tracemalloc, which slows some stages
+        self.memory = memory
+
+    def run(self, name, items, nbytes, func, *args):
+        """
+        Calls **func** with **args** and adds its cost to stage **name**.
+
+        :returns: Result of **func**
+
+        """
+        stage = self.stages.setdefault(name, {"seconds": 0.0, "cpu": 0.0, "items": 0, "bytes": 0, "peak_mb": 0.0})
+        if self.memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        start, cpu = time.perf_counter(), time.process_time()
+        result = func(*args)
+        stage["seconds"] += time.perf_counter() - start
+        stage["cpu"] += time.process_time() - cpu
+        if self.memory:
+            stage["peak_mb"] = max(stage["peak_mb"], (tracemalloc.get_traced_memory()[1] - base) / 1024 ** 2)
+        stage["items"] += items
+        stage["bytes"] += nbytes
+        return result
+
+
+def pipeline_pass(Spec, timer, output_path):
+    """
+    Processes every run of the source directory stage by stage, as :func:`Main.ProcessRun` does, recording each stage in **timer**.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param timer: Stage results
+    :type timer: :class:`StageTimer`
+    :param output_path: Directory for output files
+    :type output_path: String
+
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        run_count = timer.run("GetFileLists", 1, 0, Spec.GetFileLists)[0]
+        for run in range(0, run_count):
+            WPs, Stops = Spec.WPs[run], Spec.Stops[run]
+            if not WPs or not Stops:
+                continue
+            files = WPs + Stops
+            nbytes = sum(os.path.getsize(os.path.join(Spec.SourcePath, f)) for f in files)
+            WP_data = timer.run("ReadFiles", len(WPs), 0, Spec.ReadRun, WPs, Spec.HeaderLines)
+            Stop_data = timer.run("ReadFiles", len(Stops), nbytes, Spec.ReadRun, Stops, Spec.HeaderLines)
+            timer.run("CheckSaturation", len(files), 0, lambda: (Spec.CheckSaturation(WP_data), Spec.CheckSaturation(Stop_data)))
+            intdata_WPs = timer.run("Interp", len(WPs), 0, Spec.Interp, WP_data)
+            intdata_Stops = timer.run("Interp", len(Stops), 0, Spec.Interp, Stop_data)
+            avg_WP = timer.run("AvgWPs", len(WPs), 0, Spec.AvgWPs, intdata_WPs)
+            R = timer.run("Refl", len(Stops), 0, Spec.Refl, intdata_Stops, avg_WP)
+            filename = timer.run("WriteOutput", len(Stops), 0, Spec.WriteOutput, R, output_path, "run_%d.csv" % run, True)
+            timer.stages["WriteOutput"]["bytes"] += os.path.getsize(os.path.join(output_path, filename))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def bench_Pipeline(Spec, memory=True):
+    """
+    Measures throughput (files per second and MB per second read or written) and peak memory of each processing stage over all runs of the source directory.
+
+    Times are taken from a pass without memory tracing; peak memory from a second pass with it.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param memory: Also measure peak memory of each stage
+    :type memory: Boolean
+    :returns: Results keyed by stage name
+    :rtype: Dictionary
+
+    """
+    output_path = tempfile.mkdtemp()
+    try:
+        timer = StageTimer()
+        pipeline_pass(Spec, timer, output_path)
+        if memory:
+            mem_timer = StageTimer(memory=True)
+            tracemalloc.start()
+            try:
+                pipeline_pass(Spec, mem_timer, output_path)
+            finally:
+                tracemalloc.stop()
+            for name, stage in mem_timer.stages.items():
+                timer.stages[name]["peak_mb"] = stage["peak_mb"]
+    finally:
+        shutil.rmtree(output_path)
+
+    print("Pipeline: " + str(Spec.run_count) + " runs")
+    print("\t%-16s %9s %9s %10s %9s %9s" % ("stage", "wall ms", "cpu ms", "files/s", "MB/s", "peak MB"))
+    for name, stage in timer.stages.items():
+        rate = stage["items"] / stage["seconds"] if stage["seconds"] > 0 else float("inf")
+        mbps = "%9.1f" % (stage["bytes"] / 1024 ** 2 / stage["seconds"]) if stage["bytes"] and stage["seconds"] > 0 else "%9s" % "-"
+        print("\t%-16s %9.2f %9.2f %10.1f %s %9.2f" % (name, stage["seconds"] * 1000, stage["cpu"] * 1000, rate, mbps, stage["peak_mb"]))
+    return timer.stages
+
+
+def compare_results(old, new):
+    """
+    Prints the change in wall time of each stage between two saved :func:`bench_Pipeline` results.
+
+    :param old: Earlier results
+    :type old: Dictionary
+    :param new: Current results
+    :type new: Dictionary
+
+    """
+    print("Compared with saved results (ratio > 1 is slower):")
+    for name, stage in new.items():
+        if name in old and old[name]["seconds"] > 0 and old[name]["items"] == stage["items"]:
+            print("\t%-16s %6.2fx" % (name, stage["seconds"] / old[name]["seconds"]))
+        else:
+            print("\t%-16s %7s" % (name, "n/a"))
+
+
+def bench_ReadFiles(Spec, repeat=3):
+    """
+    Compares files/second of the *text* and *array* parsers of :func:`~BasicProcessing.UnispecProcessing.ReadFiles`.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param repeat: Number of passes over the directory, best is reported
+    :type repeat: Integer
+
+    """
+    flist = sorted(f for f in os.listdir(Spec.SourcePath) if f.endswith(".spu") and os.path.getsize(os.path.join(Spec.SourcePath, f)) > 0)
+
+    print("ReadFiles: " + str(len(flist)) + " files from " + Spec.SourcePath)
+    rates = {}
+    for parser in ["text", "array"]:
+        best = None
+        for r in range(0, repeat):
+            start = time.perf_counter()
+            Spec.ReadFiles(flist, Spec.HeaderLines, parser)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        rates[parser] = len(flist) / best
+        print("\t%-6s %10.1f files/s" % (parser, rates[parser]))
+    print("\tspeedup %9.2fx" % (rates["array"] / rates["text"]))
+
+
+def bench_Saturation(Spec, repeat=3):
+    """
+    Compares the time of a whole-run saturation screen (:func:`~BasicProcessing.UnispecProcessing.Saturation`) with the time to read the run.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param repeat: Number of passes, best is reported
+    :type repeat: Integer
+
+    """
+    flist = sorted(f for f in os.listdir(Spec.SourcePath) if f.endswith(".spu") and os.path.getsize(os.path.join(Spec.SourcePath, f)) > 0)
+
+    start = time.perf_counter()
+    run = Spec.ReadRun(flist, Spec.HeaderLines)
+    read_time = time.perf_counter() - start
+
+    best = None
+    for r in range(0, repeat):
+        start = time.perf_counter()
+        Spec.Saturation(run)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("Saturation: " + str(len(run)) + " files")
+    print("\tread   %10.2f ms\n\tscreen %10.2f ms" % (read_time * 1000, best * 1000))
+
+
+def interp_reference(run):
+    """
+    Per-file :func:`scipy.interpolate.interp1d` interpolation, as :func:`~BasicProcessing.UnispecProcessing.Interp` was originally implemented.
+
+    :param run: Run data
+    :type run: :class:`~BasicProcessing.SpectralRun`
+    :returns: Array of interpolated data indexed as [file #, WL/Ch B/Ch A]
+    :rtype: Array of Floats
+
+    """
+    from scipy import interpolate
+
+    WL_min = ceil(np.max(run.limits[:, 0::2]))
+    WL_max = floor(np.min(run.limits[:, 1::2]))
+    xnew = np.arange(WL_min, WL_max, 1)
+    newdata = np.zeros((len(run), 3, len(xnew)))
+    newdata[:, 0] = xnew
+    for f_idx in range(0, len(run)):
+        for chan_idx, chan in enumerate([0, 2]):
+            f = interpolate.interp1d(run.data[f_idx, :, chan], run.data[f_idx, :, chan + 1])
+            newdata[f_idx, chan_idx + 1] = f(xnew)
+    return newdata
+
+
+def bench_Interp(Spec, repeat=3):
+    """
+    Compares :func:`~BasicProcessing.UnispecProcessing.Interp` with per-file interp1d calls and checks that the results are identical.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param repeat: Number of passes, best is reported
+    :type repeat: Integer
+
+    """
+    flist = sorted(f for f in os.listdir(Spec.SourcePath) if f.endswith(".spu") and os.path.getsize(os.path.join(Spec.SourcePath, f)) > 0)
+    run = Spec.ReadRun(flist, Spec.HeaderLines)
+
+    print("Interp: " + str(len(run)) + " files")
+    times = {}
+    results = {}
+    for name, func in [("interp1d", interp_reference), ("Interp", Spec.Interp)]:
+        best = None
+        for r in range(0, repeat):
+            Spec.InterpCache.clear()
+            start = time.perf_counter()
+            results[name] = func(run)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        times[name] = best
+        print("\t%-8s %10.2f ms" % (name, best * 1000))
+    print("\tspeedup  %9.1fx\n\tidentical %s" % (times["interp1d"] / times["Interp"], np.array_equal(results["interp1d"], results["Interp"])))
+
+
+def refl_reference(Stop_data, WP_data):
+    """
+    Per-stop reflectance loop, as :func:`~BasicProcessing.UnispecProcessing.Refl` was originally implemented.
+
+    :param Stop_data: Interpolated stop data
+    :type Stop_data: Array of Floats
+    :param WP_data: Averaged white plate
+    :type WP_data: Array of Floats
+    :returns: Array of reflectance values for each file
+    :rtype: [File, WL] Float
+
+    """
+    refl = np.array(np.zeros((len(Stop_data), 2, len(Stop_data[0, 0]))))
+    for s_idx, stop in enumerate(Stop_data):
+        refl[s_idx, 0] = stop[0]
+        refl[s_idx, 1] = (stop[1] / WP_data[2]) * (stop[2] / stop[1])
+    return refl
+
+
+def bench_Refl(Spec, repeat=20):
+    """
+    Compares :func:`~BasicProcessing.UnispecProcessing.Refl` with the per-stop loop and checks that the results are identical, then times each white plate average of :func:`~BasicProcessing.UnispecProcessing.AvgWPs`.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param repeat: Number of calls timed
+    :type repeat: Integer
+
+    """
+    Spec.GetFileLists()
+    WP_data = Spec.ReadRun(Spec.WPs[0], Spec.HeaderLines)
+    intdata_WPs = Spec.Interp(WP_data)
+    intdata_Stops = Spec.Interp(Spec.ReadRun(Spec.Stops[0], Spec.HeaderLines), intdata_WPs[0, 0])
+    avg_WP = Spec.AvgWPs(intdata_WPs, "mean")
+
+    print("Refl: " + str(len(intdata_Stops)) + " stops")
+    results = {}
+    for name, func in [("loop", refl_reference), ("Refl", Spec.Refl)]:
+        start = time.perf_counter()
+        for i in range(0, repeat):
+            results[name] = func(intdata_Stops, avg_WP)
+        print("\t%-6s %10.3f ms" % (name, (time.perf_counter() - start) / repeat * 1000))
+    print("\tidentical %s" % np.array_equal(results["loop"], results["Refl"]))
+
+    print("AvgWPs: " + str(len(intdata_WPs)) + " white plates")
+    mask = Spec.InterpSaturation(WP_data, intdata_WPs[0, 0])
+    for mode in ["mean", "median", "trimmed", "unsaturated"]:
+        start = time.perf_counter()
+        for i in range(0, repeat):
+            Spec.AvgWPs(intdata_WPs, mode, mask)
+        print("\t%-11s %8.3f ms" % (mode, (time.perf_counter() - start) / repeat * 1000))
+
+
+def bench_Resample(Spec, repeat=20):
+    """
+    Times building and applying sensor band matrices (see :class:`~BasicProcessing.SensorBands`) for a run's reflectance, and checks them against a dense weighted mean.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param repeat: Number of calls timed
+    :type repeat: Integer
+
+    """
+    Spec.GetFileLists()
+    start = time.perf_counter()
+    R = Main.ProcessRun(Spec, Spec.WPs[0], Spec.Stops[0])[0]
+    run_time = time.perf_counter() - start
+
+    sensors = {"Sentinel-2": "B1:443/20, B2:490/65, B3:560/35, B4:665/30, B5:705/15, B6:740/15, B7:783/20, B8:842/115, B8A:865/20, B9:945/20",
+               "Landsat-8": "B1:443/16, B2:482/60, B3:561/57, B4:655/37, B5:865/28",
+               "MODIS": "B1:645/50, B2:858/35, B3:469/20, B4:555/20, B5:1240/20"}
+    print("Resample: " + str(len(R)) + " stops, run processed in %.2f ms" % (run_time * 1000))
+    for name, definition in sensors.items():
+        sensor = BasicProcessing.SensorBands(definition)
+        start = time.perf_counter()
+        sensor.Matrix(R[0, 0])
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in range(0, repeat):
+            values = sensor.Resample(R)
+        apply = (time.perf_counter() - start) / repeat
+
+        dense = sensor.Matrix(R[0, 0]).toarray()
+        reference = R[:, 1] @ dense.T
+        reference[:, dense.sum(axis=1) == 0] = np.nan
+        print("\t%-10s %2d bands  build %6.2f ms  apply %6.3f ms  matches %s" % (name, len(sensor.Names), build * 1000, apply * 1000, np.allclose(values, reference, equal_nan=True)))
+
+
+class DelayedSpec(UnispecProcessing):
+    """Processing object that adds a fixed delay to every file open, to simulate a network share."""
+
+    #: Delay added to each file read in seconds
+    Latency = 0.005
+
+    def ReadRaw(self, file):
+        time.sleep(self.Latency)
+        return UnispecProcessing.ReadRaw(self, file)
+
+
+def bench_Prefetch(Spec, latency=0.005, files=200, prefetch=(0, 4, 16, 32)):
+    """
+    Compares :func:`~BasicProcessing.UnispecProcessing.ReadFiles` throughput for different prefetch limits with an artificial per-file latency.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param latency: Delay added to each file read in seconds
+    :type latency: Float
+    :param files: Number of files to read
+    :type files: Integer
+    :param prefetch: Prefetch limits to compare
+    :type prefetch: Tuple of Integers
+
+    """
+    flist = sorted(f for f in os.listdir(Spec.SourcePath) if f.endswith(".spu") and os.path.getsize(os.path.join(Spec.SourcePath, f)) > 0)[:files]
+    Delayed = make_spec(Spec.SourcePath, Spec.OutputPath, DelayedSpec)
+    Delayed.Latency = latency
+
+    print("Prefetch: " + str(len(flist)) + " files, %.1f ms latency per file" % (latency * 1000))
+    for n in prefetch:
+        Delayed.Prefetch = n
+        start = time.perf_counter()
+        Delayed.ReadFiles(flist, Delayed.HeaderLines)
+        elapsed = time.perf_counter() - start
+        print("\t%-3d %10.1f files/s" % (n, len(flist) / elapsed))
+
+
+def bench_Cache(Spec):
+    """
+    Compares :func:`~BasicProcessing.UnispecProcessing.ReadFiles` without a cache, with an empty cache and with a warm cache, and checks that cached spectra are identical.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+
+    """
+    flist = sorted(f for f in os.listdir(Spec.SourcePath) if f.endswith(".spu") and os.path.getsize(os.path.join(Spec.SourcePath, f)) > 0)
+    cache_path = tempfile.mkdtemp()
+
+    print("Cache: " + str(len(flist)) + " files")
+    try:
+        results = {}
+        for name in ["none", "cold", "warm"]:
+            Spec.Cache = None if name == "none" else BasicProcessing.SpectrumCache(cache_path, 1024 ** 3)
+            start = time.perf_counter()
+            results[name] = Spec.ReadFiles(flist, Spec.HeaderLines)
+            elapsed = time.perf_counter() - start
+            print("\t%-5s %10.1f files/s" % (name, len(flist) / elapsed))
+        identical = all(a[0] == b[0] and np.array_equal(a[1], b[1]) for a, b in zip(results["none"], results["warm"]))
+        print("\tidentical %s" % identical)
+    finally:
+        Spec.Cache = None
+        shutil.rmtree(cache_path)
+
+
+def bench_Catalog(Spec, repeat=20):
+    """
+    Compares :func:`~BasicProcessing.UnispecProcessing.GetFileLists` listing the source directory and using an up-to-date catalog (see :class:`~BasicProcessing.FileCatalog`), and checks that the runs are identical and that a file rewritten in place changes its run's signature (see :func:`Main.RunSignature`).
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param repeat: Number of calls timed
+    :type repeat: Integer
+
+    """
+    catalog_path = tempfile.mkdtemp()
+    stdout = sys.stdout
+
+    print("Catalog:")
+    try:
+        results = {}
+        for name in ["listdir", "catalog"]:
+            Spec.Catalog = None if name == "listdir" else BasicProcessing.FileCatalog(os.path.join(catalog_path, "catalog.db"), Spec.SourcePath, Spec.WP_identifier)
+            sys.stdout = open(os.devnull, "w")
+            Spec.GetFileLists()
+            start = time.perf_counter()
+            for i in range(0, repeat):
+                Spec.GetFileLists()
+            elapsed = (time.perf_counter() - start) / repeat
+            sys.stdout.close()
+            sys.stdout = stdout
+            results[name] = (Spec.WPs, Spec.Stops)
+            print("\t%-7s %10.2f ms" % (name, elapsed * 1000))
+        print("\tidentical %s" % (results["listdir"] == results["catalog"]))
+
+        #A file rewritten in place leaves its directory's modification time unchanged, but must still change the run's signature
+        source_path = os.path.join(catalog_path, "source")
+        os.makedirs(source_path)
+        files = Spec.WPs[0] + Spec.Stops[0]
+        for f in files:
+            shutil.copy(os.path.join(Spec.SourcePath, f), source_path)
+        Small = make_spec(source_path)
+        Small.Catalog = BasicProcessing.FileCatalog(os.path.join(catalog_path, "edit.db"), source_path, Small.WP_identifier)
+        Small.Catalog.Update()
+        before = Main.RunSignature(Small, Spec.WPs[0], Spec.Stops[0])
+        dir_mtime = os.stat(source_path).st_mtime_ns
+        with open(os.path.join(source_path, files[-1]), "a") as fh:
+            fh.write("\n")
+        os.utime(os.path.join(source_path, files[-1]), ns=(dir_mtime + 10 ** 9, dir_mtime + 10 ** 9))
+        Small.Catalog.Update()
+        after = Main.RunSignature(Small, Spec.WPs[0], Spec.Stops[0])
+        print("\tin-place edit detected %s" % (os.stat(source_path).st_mtime_ns == dir_mtime and after != before))
+    finally:
+        sys.stdout = stdout
+        Spec.Catalog = None
+        shutil.rmtree(catalog_path)
+
+
+def bench_Archive(Spec):
+    """
+    Compares reading a run from individual files and from a season archive (see :class:`~BasicProcessing.SpuArchive`), and checks that the spectra are identical, also when an ingest was interrupted partway through a record.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+
+    """
+    flist = sorted(f for f in os.listdir(Spec.SourcePath) if f.endswith(".spu") and os.path.getsize(os.path.join(Spec.SourcePath, f)) > 0)
+    archive_path = tempfile.mkdtemp()
+
+    print("Archive: " + str(len(flist)) + " files")
+    try:
+        start = time.perf_counter()
+        BasicProcessing.SpuArchive.Ingest(os.path.join(archive_path, "season.uspa"), Spec.SourcePath, flist, Spec.HeaderLines)
+        print("\tingest %10.1f files/s" % (len(flist) / (time.perf_counter() - start)))
+
+        results = {}
+        for name in ["files", "archive"]:
+            Spec.Archive = None if name == "files" else BasicProcessing.SpuArchive(os.path.join(archive_path, "season.uspa"))
+            start = time.perf_counter()
+            results[name] = Spec.ReadRun(flist, Spec.HeaderLines)
+            elapsed = time.perf_counter() - start
+            print("\t%-7s %10.1f files/s" % (name, len(flist) / elapsed))
+        identical = results["files"].headers == results["archive"].headers and np.array_equal(results["files"].data, results["archive"].data)
+        print("\tidentical %s" % identical)
+
+        #An ingest interrupted partway through a record must not misalign the records appended later
+        half = len(flist) // 2
+        resumed = os.path.join(archive_path, "resumed.uspa")
+        BasicProcessing.SpuArchive.Ingest(resumed, Spec.SourcePath, flist[:half], Spec.HeaderLines)
+        with open(resumed, "ab") as fh:
+            fh.write(b"\1" * 1000)
+        BasicProcessing.SpuArchive.Ingest(resumed, Spec.SourcePath, flist[half:], Spec.HeaderLines)
+        Spec.Archive = BasicProcessing.SpuArchive(resumed)
+        run = Spec.ReadRun(flist, Spec.HeaderLines)
+        print("\tidentical after interrupted ingest %s" % (run.headers == results["files"].headers and np.array_equal(run.data, results["files"].data)))
+    finally:
+        Spec.Archive = None
+        shutil.rmtree(archive_path)
+
+
+def bench_Streaming(Spec, stops=2000, chunk=100):
+    """
+    Compares peak memory of processing one large run at once and in chunks (see :func:`Main.ProcessRun`).
+
+    The run is built from the first white plates of the source directory followed by copies of one stop file.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param stops: Number of stops in the run
+    :type stops: Integer
+    :param chunk: Stops per chunk
+    :type chunk: Integer
+
+    """
+    Spec.GetFileLists()
+    source_path = tempfile.mkdtemp()
+    output_path = tempfile.mkdtemp()
+    try:
+        WPs = Spec.WPs[0]
+        for f in WPs:
+            shutil.copy(os.path.join(Spec.SourcePath, f), source_path)
+        Stops = ["Uni_Stop_%06d.spu" % i for i in range(0, stops)]
+        for f in Stops:
+            shutil.copy(os.path.join(Spec.SourcePath, Spec.Stops[0][0]), os.path.join(source_path, f))
+        Large = make_spec(source_path, output_path)
+
+        print("Streaming: run of " + str(len(WPs)) + " WPs and " + str(stops) + " stops")
+        for n in [None, chunk]:
+            tracemalloc.start()
+            start = time.perf_counter()
+            R, filename, log, elapsed, meta = Main.ProcessRun(Large, WPs, Stops, n)
+            sys.stdout = open(os.devnull, "w")
+            try:
+                Large.WriteOutput(R, output_path, filename)
+            finally:
+                sys.stdout.close()
+                sys.stdout = sys.__stdout__
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print("\tchunk %-5s %8.1f MB peak %8.2f s" % (n or "-", peak / 1024 ** 2, elapsed))
+    finally:
+        shutil.rmtree(source_path)
+        shutil.rmtree(output_path)
+
+
+def run_paths(Spec, WPs, Stops, chunk):
+    """
+    Processes a run with :func:`Main.ProcessRun` as a whole, in chunks and in compact mode.
+
+    :returns: Reflectance of each path, keyed by name
+    :rtype: Dictionary of Arrays of Floats
+
+    """
+    results = {}
+    sys.stdout = open(os.devnull, "w")
+    try:
+        for name, n, compact in [("whole", None, False), ("chunk", chunk, False), ("compact", None, True)]:
+            Spec.Compact = compact
+            R = Main.ProcessRun(Spec, WPs, Stops, n)[0]
+            results[name] = R if isinstance(R, np.ndarray) else np.concatenate(list(R))
+    finally:
+        Spec.Compact = False
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+    return results
+
+
+def bench_Paths(Spec, chunk=40):
+    """
+    Checks that a run gives the same reflectance processed as a whole, in chunks and in compact mode (to float32 precision), both as read and with the stops' header limits changed so they differ from the white plates'.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param chunk: Stops per chunk
+    :type chunk: Integer
+
+    """
+    sys.stdout = open(os.devnull, "w")
+    try:
+        Spec.GetFileLists()
+    finally:
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+    run = next(run for run in range(0, len(Spec.WPs)) if Spec.WPs[run] and Spec.Stops[run])
+    WPs, Stops = Spec.WPs[run], Spec.Stops[run]
+
+    source_path = tempfile.mkdtemp()
+    try:
+        for f in WPs:
+            shutil.copy(os.path.join(Spec.SourcePath, f), source_path)
+        #Stops whose Ch B range starts 3.5 nm above the white plates' get a different default wavelength grid
+        for f in Stops:
+            with open(os.path.join(Spec.SourcePath, f), "r") as fh:
+                text = fh.read()
+            text = re.sub(r"(Limits_Ch_B:\s*)([\d.]+)", lambda m: m.group(1) + "%.1f" % (float(m.group(2)) + 3.5), text, count=1)
+            with open(os.path.join(source_path, f), "w") as fh:
+                fh.write(text)
+        Shifted = make_spec(source_path)
+        Shifted.Dark, Shifted.Normalization, Shifted.WPInterpolation = Spec.Dark, Spec.Normalization, Spec.WPInterpolation
+
+        print("Paths:")
+        for name, S in [("as read", Spec), ("shifted limits", Shifted)]:
+            results = run_paths(S, WPs, Stops, chunk)
+            print("\t%-15s chunk identical %s  compact max diff %.1e" % (name, np.array_equal(results["whole"], results["chunk"], equal_nan=True),
+                                                                         np.nanmax(np.abs(results["whole"] - results["compact"]))))
+    finally:
+        shutil.rmtree(source_path)
+
+
+def bench_Compact(Spec, stops=3000):
+    """
+    Compares memory use and results of processing one large synthetic run (see :mod:`Synthetic`) with float64 arrays and in compact mode (see :data:`~BasicProcessing.UnispecProcessing.Compact`).
+
+    :param Spec: Configured processing object (only used for its settings, the run is generated)
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param stops: Number of stops in the run
+    :type stops: Integer
+
+    """
+    source_path = tempfile.mkdtemp()
+    try:
+        #Station numbers have three digits, so longer runs are joined from several generated runs
+        Synthetic.GenerateRuns(source_path, runs=ceil(stops / 999), stops=min(stops, 999))
+        Large = make_spec(source_path)
+        sys.stdout = open(os.devnull, "w")
+        try:
+            Large.GetFileLists()
+        finally:
+            sys.stdout.close()
+            sys.stdout = sys.__stdout__
+        WPs, Stops = Large.WPs[0], [f for run in Large.Stops for f in run][:stops]
+
+        print("Compact: run of " + str(len(WPs)) + " WPs and " + str(len(Stops)) + " stops")
+        full = Large.ReadRun(Stops, Large.HeaderLines)
+        compact = CompactRun.from_run(full)
+        print("\traw data         float64 %8.1f MB  compact %8.1f MB" % (full.data.nbytes / 1024 ** 2, (compact.counts.nbytes + compact.axes.nbytes) / 1024 ** 2))
+        interpolated = Large.Interp(Large.Normalize(full))
+        grid, compact_interpolated = Large.InterpCompact(Large.Normalize(compact))
+        print("\tinterpolated     float64 %8.1f MB  compact %8.1f MB" % (interpolated.nbytes / 1024 ** 2, compact_interpolated.nbytes / 1024 ** 2))
+        del full, compact, interpolated, compact_interpolated
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        R = Main.ProcessRun(Large, WPs, Stops)[0]
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("\tfloat64 %8.1f MB peak %8.2f s" % (peak / 1024 ** 2, elapsed))
+
+        #The float64 result is held for the comparison, so it is left out of the compact peak
+        Large.Compact = True
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        diff = rel = 0.0
+        printed = 0
+        first = 0
+        for block in Main.ProcessRun(Large, WPs, Stops)[0]:
+            ref = R[first:first + len(block)]
+            first += len(block)
+            diff = max(diff, np.nanmax(np.abs(block - ref)))
+            rel = max(rel, np.nanmax(np.abs(block[:, 1] - ref[:, 1]) / np.abs(ref[:, 1])))
+            printed += np.count_nonzero(np.round(block[:, 1], Large.Precision) != np.round(ref[:, 1], Large.Precision))
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+        print("\tcompact %8.1f MB peak %8.2f s" % (peak / 1024 ** 2, elapsed))
+        print("\tmax abs diff %.2e, max rel diff %.2e, %.2f%% of values differ at %d decimals" % (diff, rel, 100.0 * printed / R[:, 1].size, Large.Precision))
+    finally:
+        shutil.rmtree(source_path)
+
+
+def bench_Dark(Spec, limit=1.5):
+    """
+    Processes every run of the source directory with each dark level (see :data:`~BasicProcessing.UnispecProcessing.Dark`) and checks that no warnings are raised and that reflectance is never infinite and stays in a plausible range.  Wavelengths without a usable white plate (see :func:`~BasicProcessing.UnispecProcessing.ReflMask`) are NaN.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param limit: Highest plausible reflectance
+    :type limit: Float
+
+    """
+    import warnings
+
+    sys.stdout = open(os.devnull, "w")
+    try:
+        Spec.GetFileLists()
+    finally:
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+    dark = Spec.Dark
+
+    print("Dark:")
+    try:
+        for Spec.Dark in ["none", "minimum"]:
+            values = []
+            with warnings.catch_warnings():
+                warnings.simplefilter("error")
+                for run in range(0, len(Spec.WPs)):
+                    if Spec.WPs[run] and Spec.Stops[run]:
+                        values.append(Main.ProcessRun(Spec, Spec.WPs[run], Spec.Stops[run])[0][:, 1].ravel())
+            values = np.concatenate(values)
+            finite = values[np.isfinite(values)]
+            print("\t%-8s %6.1f%% nan  range %.3f - %.3f  plausible %s" % (Spec.Dark, 100.0 * np.isnan(values).mean(), finite.min(), finite.max(),
+                                                                        not np.isinf(values).any() and finite.min() >= 0 and finite.max() <= limit))
+
+        #The floor follows the dark level Normalize applied, not the configured one
+        run = next(run for run in range(0, len(Spec.WPs)) if Spec.WPs[run] and Spec.Stops[run])
+        WP_data = Spec.ReadRun(Spec.WPs[run], Spec.HeaderLines)
+        Stop_data = Spec.ReadRun(Spec.Stops[run], Spec.HeaderLines)
+        results = []
+        for Spec.Dark, explicit in [("minimum", None), ("none", "minimum")]:
+            avg_WP = Spec.AvgWPs(Spec.Interp(Spec.Normalize(WP_data, dark=explicit)), "mean")
+            norm_Stops = Spec.Normalize(Stop_data, dark=explicit)
+            results.append(Spec.Refl(Spec.Interp(norm_Stops, avg_WP[BasicProcessing.consts.int_WL]), avg_WP, norm_Stops.dark))
+        print("\texplicit dark identical %s" % np.array_equal(results[0], results[1], equal_nan=True))
+    finally:
+        Spec.Dark = dark
+
+
+def write_reference(data, filename):
+    """
+    Writes reflectance data row by row with per-value formatting, as :func:`~BasicProcessing.UnispecProcessing.WriteOutput` was originally implemented.
+
+    :param data: Array of reflectance data
+    :type data: Array of Floats indexed as [File, WL/Reflectance]
+    :param filename: Path of the file to write
+    :type filename: String
+
+    """
+    fh = open(filename, "a")
+    fh.write("Stop," + ",".join(['%f' % num for num in data[0,0]]))
+    for s_idx, stop in enumerate(data):
+        fh.write("\n" + str(s_idx+1) + "," + ",".join(['%f' % num for num in stop[1]]))
+    fh.close()
+
+
+def bench_WriteOutput(Spec, stops=500):
+    """
+    Compares :func:`~BasicProcessing.UnispecProcessing.WriteOutput` with row-by-row writing and checks that the files are identical.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param stops: Number of stops (rows) to write
+    :type stops: Integer
+
+    """
+    R = np.zeros((stops, 2, 814))
+    R[:, 0] = np.arange(303, 303 + 814)
+    R[:, 1] = np.random.default_rng(0).random((stops, 814))
+    output_path = tempfile.mkdtemp()
+
+    print("WriteOutput: " + str(stops) + " stops x " + str(R.shape[2]) + " wavelengths")
+    try:
+        start = time.perf_counter()
+        write_reference(R, os.path.join(output_path, "reference.csv"))
+        ref_time = time.perf_counter() - start
+
+        sys.stdout = open(os.devnull, "w")
+        try:
+            start = time.perf_counter()
+            Spec.WriteOutput(R, output_path, "bulk.csv")
+            bulk_time = time.perf_counter() - start
+        finally:
+            sys.stdout.close()
+            sys.stdout = sys.__stdout__
+
+        with open(os.path.join(output_path, "reference.csv"), "rb") as a, open(os.path.join(output_path, "bulk.csv"), "rb") as b:
+            identical = a.read() == b.read()
+        print("\trow by row %8.2f ms\n\tbulk       %8.2f ms\n\tidentical %s" % (ref_time * 1000, bulk_time * 1000, identical))
+    finally:
+        shutil.rmtree(output_path)
+
+
+def bench_ReadOutput(Spec, stops=500):
+    """
+    Times reading a run back from HDF5 output with :func:`~BasicProcessing.UnispecProcessing.ReadOutput` in full, as a wavelength range and as a subset of stops, and checks each against the array written.  The subset lists stops out of order and repeats one.  A run without stops must read back as an empty array.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param stops: Number of stops (rows) to write
+    :type stops: Integer
+
+    """
+    try:
+        import h5py
+    except ImportError:
+        print("ReadOutput: skipped, h5py is not installed")
+        return
+
+    R = np.zeros((stops, 2, 814))
+    R[:, 0] = np.arange(303, 303 + 814)
+    R[:, 1] = np.random.default_rng(0).random((stops, 814))
+    output_path = tempfile.mkdtemp()
+    output_format = Spec.OutputFormat
+    subset = [7, 3, 3, stops]
+
+    print("ReadOutput: " + str(stops) + " stops x " + str(R.shape[2]) + " wavelengths")
+    try:
+        Spec.OutputFormat = "hdf5"
+        sys.stdout = open(os.devnull, "w")
+        try:
+            filename = os.path.join(output_path, Spec.WriteOutput(R, output_path, "run.csv"))
+            empty = os.path.join(output_path, Spec.WriteOutput(np.zeros((0, 2, 814)), output_path, "empty.csv"))
+        finally:
+            sys.stdout.close()
+            sys.stdout = sys.__stdout__
+
+        checks = [("all", {}, R),
+                  ("600-700 nm", {"wl_range": (600, 700)}, R[:, :, 297:398]),
+                  ("stops " + ",".join(str(stop) for stop in subset), {"stops": subset}, R[np.array(subset) - 1])]
+        for name, kwargs, expected in checks:
+            start = time.perf_counter()
+            result = Spec.ReadOutput(filename, **kwargs)
+            elapsed = time.perf_counter() - start
+            print("\t%-16s %8.2f ms  identical %s" % (name, elapsed * 1000, np.array_equal(result, expected)))
+        print("\tempty run        shape %s" % (Spec.ReadOutput(empty).shape,))
+    finally:
+        Spec.OutputFormat = output_format
+        shutil.rmtree(output_path)
+
+
+def import_time(module, env):
+    """
+    Returns the cumulative import time in seconds of **module** in a new interpreter, as reported by *-X importtime*.
+
+    :param module: Module name
+    :type module: String
+    :param env: Environment of the interpreter
+    :type env: Dictionary
+    :rtype: Float
+
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module], env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1e6
+    return float("nan")
+
+
+def bench_Startup(Spec, stops=10, repeat=5):
+    """
+    Measures the cold start of processing: import times of the modules and the wall time of "python Main.py" on a small run, each in a new interpreter.  Main.py is also timed with matplotlib.pyplot imported first, which is what every invocation paid while BasicProcessing imported it at load.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param stops: Stops in the small run
+    :type stops: Integer
+    :param repeat: Number of invocations, best is reported
+    :type repeat: Integer
+
+    """
+    here = os.path.dirname(os.path.realpath(__file__))
+    env = dict(os.environ, PYTHONPATH=here + os.pathsep + os.environ.get("PYTHONPATH", ""), MPLBACKEND="Agg")
+
+    print("Startup: import time (best of %d)" % repeat)
+    for module in ["numpy", "BasicProcessing", "Main", "matplotlib.pyplot"]:
+        print("	%-18s %8.1f ms" % (module, 1000 * min(import_time(module, env) for r in range(0, repeat))))
+
+    Spec.GetFileLists()
+    run = next(run for run in range(0, len(Spec.WPs)) if Spec.WPs[run] and Spec.Stops[run])
+    work_path = tempfile.mkdtemp()
+    try:
+        source_path = os.path.join(work_path, "source")
+        os.makedirs(source_path)
+        for file in Spec.WPs[run] + Spec.Stops[run][:stops]:
+            shutil.copy(os.path.join(Spec.SourcePath, file), source_path)
+        with open(os.path.join(work_path, "config.txt"), "w") as cf:
+            cf.write("[Input]\nSourcePath = " + source_path + "\nWP_Identifier = " + Spec.WP_identifier + "\nHeaderLines = " + str(Spec.HeaderLines) + "\n\n"
+                     "[Output]\nOutputPath = " + os.path.join(work_path, "output") + "\nOutputPrefix = Bench_\n")
+
+        print("\tMain.py on %d white plates and %d stops (best of %d)" % (len(Spec.WPs[run]), len(Spec.Stops[run][:stops]), repeat))
+        commands = {"lazy": [sys.executable, os.path.join(here, "Main.py")],
+                    "with pyplot": [sys.executable, "-c", "import matplotlib.pyplot, runpy; runpy.run_path(" + repr(os.path.join(here, "Main.py")) + ", run_name='__main__')"]}
+        times = {}
+        for name, command in commands.items():
+            best = None
+            for r in range(0, repeat):
+                start = time.perf_counter()
+                subprocess.run(command, cwd=work_path, env=env, stdout=subprocess.DEVNULL, check=True)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            times[name] = best
+            print("\t%-18s %8.1f ms" % (name, 1000 * best))
+        print("\tsaved %18.1f ms (%.0f%%)" % (1000 * (times["with pyplot"] - times["lazy"]), 100 * (1 - times["lazy"] / times["with pyplot"])))
+    finally:
+        shutil.rmtree(work_path)
+
+
+def main(argv=None):
+    benches = {"Pipeline": bench_Pipeline, "ReadFiles": bench_ReadFiles, "Saturation": bench_Saturation, "Interp": bench_Interp,
+               "Refl": bench_Refl, "Resample": bench_Resample, "Prefetch": bench_Prefetch, "Cache": bench_Cache,
+               "Catalog": bench_Catalog, "Archive": bench_Archive, "Streaming": bench_Streaming, "WriteOutput": bench_WriteOutput,
+               "Startup": bench_Startup, "Compact": bench_Compact, "Dark": bench_Dark,
+               "Paths": bench_Paths, "ReadOutput": bench_ReadOutput}
+
+    parser = argparse.ArgumentParser(description="Benchmark the BasicProcessing library.")
+    parser.add_argument("source", nargs="?", help="directory of Unispec files (default: first day of the example data)")
+    parser.add_argument("--only", nargs="+", choices=list(benches), metavar="NAME", help="benchmarks to run: " + ", ".join(benches))
+    parser.add_argument("--synthetic", action="store_true", help="generate the data instead of reading SOURCE (see Synthetic.py)")
+    parser.add_argument("--runs", type=int, default=3, help="synthetic runs (default 3)")
+    parser.add_argument("--wps", type=int, default=3, help="synthetic white plates per run (default 3)")
+    parser.add_argument("--stops", type=int, default=100, help="synthetic stops per run (default 100)")
+    parser.add_argument("--rows", type=int, default=256, help="synthetic rows per file (default 256)")
+    parser.add_argument("--saturation", type=float, default=0.0, metavar="FRACTION", help="fraction of synthetic files with saturated values")
+    parser.add_argument("--seed", type=int, default=0, help="synthetic random seed")
+    parser.add_argument("--save", metavar="FILE", help="save the Pipeline results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="compare the Pipeline results with a saved JSON file")
+    args = parser.parse_args(argv)
+
+    synthetic_path = None
+    if args.synthetic:
+        synthetic_path = tempfile.mkdtemp()
+        start = time.perf_counter()
+        files = Synthetic.GenerateRuns(synthetic_path, args.runs, args.wps, args.stops, args.rows, args.saturation, args.seed)
+        print("Generated %d files in %.2f s" % (len(files), time.perf_counter() - start))
+        source_path = synthetic_path
+    elif args.source:
+        source_path = args.source
+    else:
+        source_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "example_data", "20150625")
+
+    try:
+        Spec = make_spec(os.path.realpath(source_path))
+        for name in args.only or list(benches):
+            result = benches[name](Spec)
+            if name == "Pipeline":
+                if args.compare:
+                    with open(args.compare, "r") as fh:
+                        compare_results(json.load(fh)["stages"], result)
+                if args.save:
+                    with open(args.save, "w") as fh:
+                        json.dump({"source": "synthetic" if args.synthetic else os.path.realpath(source_path), "arguments": vars(args), "stages": result}, fh, indent=1)
+    finally:
+        if synthetic_path is not None:
+            shutil.rmtree(synthetic_path)
+
+
+if __name__ == "__main__":
+    main()
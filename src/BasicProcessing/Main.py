@@ -4,79 +4,688 @@ Created on Aug 4, 2015
 @author: amcmahon
 '''
 from BasicProcessing import UnispecProcessing
+from BasicProcessing import ProcessingStats
+from BasicProcessing import AtomicFile
 from BasicProcessing import consts
+import argparse
+import json
+import numpy as np
 import os.path
 import sys
+import time
 
 
-def main():
+#: Processing object used by pool workers (see :func:`init_worker`)
+WorkerSpec = None
+
+
+def AverageWPs(Spec, WP_data, grid=None):
+    """
+    Normalizes, interpolates and averages the white plates of a run as configured.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param WP_data: White plate data (as returned from :func:`~BasicProcessing.UnispecProcessing.ReadRun`)
+    :type WP_data: :class:`~BasicProcessing.SpectralRun`
+    :param grid: Wavelengths to interpolate to, or None for the white plates' own range
+    :type grid: Array of Floats
+    :returns: Averaged white plate (as returned from :func:`~BasicProcessing.UnispecProcessing.AvgWPs`)
+    :rtype: Array of Floats
+
+    """
+
+    intdata_WPs = Spec.Interp(Spec.Normalize(WP_data), grid)
+    mask = None
+    if Spec.WPAverage == "unsaturated":
+        mask = Spec.InterpSaturation(WP_data, intdata_WPs[0, consts.int_WL])
+    return Spec.AvgWPs(intdata_WPs, mask=mask)
+
+
+def WPBracket(Spec, WP_data, avg_WP, next_WPs):
+    """
+    Reads and averages the white plates of the following run for time interpolation (see :func:`~BasicProcessing.UnispecProcessing.InterpWPs`).
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param WP_data: White plate data of the run
+    :type WP_data: :class:`~BasicProcessing.SpectralRun`
+    :param avg_WP: Averaged white plate of the run
+    :type avg_WP: Array of Floats
+    :param next_WPs: White plate files of the following run
+    :type next_WPs: List of Strings
+    :returns: Time of the run's white plates, averaged white plate of the following run on the same wavelengths and its time
+    :rtype: datetime64, Array of Floats, datetime64
+
+    """
+
+    next_data = Spec.ReadRun(next_WPs, Spec.HeaderLines)
+    next_avg = AverageWPs(Spec, next_data, avg_WP[consts.int_WL])
+    times = [run.fields["time"] for run in (WP_data, next_data)]
+    return times[0][0] + (times[0] - times[0][0]).mean(), next_avg, times[1][0] + (times[1] - times[1][0]).mean()
+
+
+def StopWPs(Spec, avg_WP, bracket, Stop_data):
+    """
+    Returns the white plate to divide each stop by: **avg_WP**, or one interpolated in time if **bracket** is given.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param avg_WP: Averaged white plate of the run
+    :type avg_WP: Array of Floats
+    :param bracket: Result of :func:`WPBracket`, or None
+    :type bracket: Tuple
+    :param Stop_data: Stop data
+    :type Stop_data: :class:`~BasicProcessing.SpectralRun`
+    :rtype: Array of Floats
+
+    """
+
+    if bracket is None:
+        return avg_WP
+    return Spec.InterpWPs(avg_WP, bracket[0], bracket[1], bracket[2], Stop_data.fields["time"])
+
+
+def StreamStops(Spec, Stops, avg_WP, chunk, headers=None, bracket=None, qc=None, wp_cv=np.nan):
+    """
+    Reads stops and converts them to reflectance **chunk** stops at a time, so memory use is bounded by the chunk size rather than the run size.
+
+    Saturation counts are printed for each chunk as it is processed.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param Stops: Stop files of the run
+    :type Stops: List of Strings
+    :param avg_WP: Averaged white plate data (as returned from :func:`~BasicProcessing.UnispecProcessing.AvgWPs`), whose wavelengths are used for all stops
+    :type avg_WP: Array of Floats
+    :param chunk: Number of stops per chunk
+    :type chunk: Integer
+    :param headers: List that the header lines of each stop are added to as it is read
+    :type headers: List
+    :param bracket: White plates of the following run for time interpolation (as returned from :func:`WPBracket`), or None
+    :type bracket: Tuple
+    :param qc: List that the quality control metrics of each chunk are added to (see :func:`QualityControl`), or None to skip quality control
+    :type qc: List
+    :param wp_cv: White plate stability of the run (as returned from :func:`~BasicProcessing.UnispecProcessing.WPStability`)
+    :type wp_cv: Float
+    :returns: Reflectance values for each chunk (as returned from :func:`~BasicProcessing.UnispecProcessing.Refl`)
+    :rtype: Iterator of Arrays of Floats
+
+    """
+
+    sat_count = 0
+    for first in range(0, len(Stops), chunk):
+        Stop_data = Spec.ReadRun(Stops[first:first + chunk], Spec.HeaderLines)
+        if headers is not None:
+            headers.extend(Stop_data.headers)
+
+        sat_stops = Spec.CheckSaturation(Stop_data)
+        for curfile in sat_stops:
+            print("Stop " + str(first + curfile[0]) + ":\t\t" + str(curfile[1]) + "\t" + str(curfile[2]))
+        sat_count += len(sat_stops)
+
+        WP = StopWPs(Spec, avg_WP, bracket, Stop_data)
+        norm_Stops = Spec.Normalize(Stop_data)
+        R = Spec.Refl(Spec.Interp(norm_Stops, avg_WP[consts.int_WL]), WP, norm_Stops.dark)
+        if qc is not None:
+            qc.append(QualityControl(Spec, Stop_data, R, wp_cv))
+        yield R
+
+    print(str(sat_count) + " stops saturated.")
+
+
+def CompactBlocks(Spec, R, grid, Stop_data, block=256, qc=None, wp_cv=np.nan):
+    """
+    Converts compact reflectance (see :func:`~BasicProcessing.UnispecProcessing.ReflCompact`) to the layout returned by :func:`~BasicProcessing.UnispecProcessing.Refl` **block** stops at a time, so only one block is held in full size.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param R: Reflectance values indexed as [File, WL]
+    :type R: Array of float32
+    :param grid: Wavelengths of **R**
+    :type grid: Array of Floats
+    :param Stop_data: Stop data, before normalization
+    :type Stop_data: :class:`~BasicProcessing.CompactRun`
+    :param block: Number of stops per block
+    :type block: Integer
+    :param qc: List that the quality control metrics of each block are added to (see :func:`QualityControl`), or None to skip quality control
+    :type qc: List
+    :param wp_cv: White plate stability of the run
+    :type wp_cv: Float
+    :returns: Reflectance values for each block
+    :rtype: Iterator of Arrays of Floats
+
+    """
+
+    for first in range(0, len(R), block):
+        refl = np.empty((len(R[first:first + block]), 2, len(grid)))
+        refl[:, 0] = grid
+        refl[:, 1] = R[first:first + block]
+        if qc is not None:
+            qc.append(QualityControl(Spec, Stop_data.select(np.arange(first, first + len(refl))), refl, wp_cv))
+        yield refl
+
+
+def TakeStats(Spec, R, meta):
+    """
+    Yields the arrays of a generator of reflectance, then stores the stage timing collected for the run in **meta** (as *stats*), so that the stages run while the generator is consumed are included in the run's record.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param R: Reflectance values for each block (as returned from :func:`StreamStops` or :func:`CompactBlocks`)
+    :type R: Iterator of Arrays of Floats
+    :param meta: Stop metadata of the run
+    :type meta: Dictionary
+    :returns: The arrays of **R**
+    :rtype: Iterator of Arrays of Floats
+
+    """
+
+    for block in R:
+        yield block
+    if Spec.Stats is not None:
+        meta["stats"] = Spec.Stats.Take()
+
+
+def QualityControl(Spec, Stop_data, R, wp_cv):
+    """
+    Computes quality control metrics for stops (see :func:`~BasicProcessing.UnispecProcessing.QCMetrics`) and sets the reflectance of rejected stops to NaN, so stop numbers in the output are unchanged.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param Stop_data: Stop data, before normalization
+    :type Stop_data: :class:`~BasicProcessing.SpectralRun`
+    :param R: Reflectance of the stops, changed in place
+    :type R: Array of Floats
+    :param wp_cv: White plate stability of the run
+    :type wp_cv: Float
+    :returns: Metrics with rejections applied
+    :rtype: Array of :data:`~BasicProcessing.UnispecProcessing.QCType`
+
+    """
+
+    metrics = Spec.QCMetrics(Stop_data, R, wp_cv)
+    R[Spec.QCReject(metrics), 1] = np.nan
+    return metrics
+
+
+def ProcessRun(Spec, WPs, Stops, chunk=None, next_WPs=None, prev_WPs=None):
+    """
+    Converts a single run to reflectance.
+
+    Messages are collected and returned rather than printed so that runs processed in parallel can be reported in order.
+
+    If **chunk** is given, only the white plates are processed here and the reflectance is returned as a generator (see :func:`StreamStops`) that is consumed as the output file is written.  Otherwise, with :data:`~BasicProcessing.UnispecProcessing.Compact` set, the stops are processed in compact arrays and the reflectance is also returned as a generator (see :func:`CompactBlocks`).
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param WPs: White plate files of the run
+    :type WPs: List of Strings
+    :param Stops: Stop files of the run
+    :type Stops: List of Strings
+    :param chunk: Number of stops to process at a time, or None to process the whole run at once
+    :type chunk: Integer
+    :param next_WPs: White plate files of the following run, used when white plates are interpolated in time
+    :type next_WPs: List of Strings
+    :param prev_WPs: White plate files of the nearest preceding run, used if the run has none of its own.  The output file is then named after the first stop.
+    :type prev_WPs: List of Strings
+    :returns: Array (or iterator of arrays) of reflectance values (as returned from :func:`~BasicProcessing.UnispecProcessing.Refl`), output filename, diagnostic messages, processing time in seconds, stop metadata for :func:`~BasicProcessing.UnispecProcessing.WriteOutput`
+    :rtype: Array of Floats, String, String, Float, Dictionary
+
+    """
+
+    start = time.perf_counter()
+    log = []
+
+    named_by_stop = not WPs
+    if named_by_stop:
+        WPs = prev_WPs
+        log.append("Run has no white plates, using those from " + WPs[0] + ".")
+
+    if chunk:
+        WP_data = Spec.ReadRun(WPs, Spec.HeaderLines)
+        sat_WP = Spec.CheckSaturation(WP_data)
+        log.append("Saturated Measurement Count\n\t\tCh_B\tCh_A")
+        for idx, curfile in enumerate(sat_WP):
+            log.append("WP " + str(idx) + ":\t\t" + str(curfile[1]) + "\t" + str(curfile[2]))
+        log.append(str(len(sat_WP)) + " WPs saturated.")
+
+        avg_WP = AverageWPs(Spec, WP_data)
+        bracket = RunBracket(Spec, WP_data, avg_WP, next_WPs, log)
+        dt = Spec.GetDateTime(Spec.ReadRun(Stops[:1], Spec.HeaderLines)[0] if named_by_stop else WP_data[0])
+        filename = Spec.OutputPrefix + dt[consts.date] + "__" + dt[consts.time].replace(':','_') + ".csv"
+        meta = {"datetime": " ".join(dt), "files": list(Stops), "headers": []}
+        wp_cv = np.nan
+        if Spec.QC is not None:
+            meta["qc"] = []
+            wp_cv = Spec.WPStability(WP_data)
+        return TakeStats(Spec, StreamStops(Spec, Stops, avg_WP, chunk, meta["headers"], bracket, meta.get("qc"), wp_cv), meta), filename, "\n".join(log), time.perf_counter() - start, meta
+
+    if Spec.Compact:
+        #Stops are held as 16 bit counts and processed as float32 on one wavelength axis; the white plates are few, so they are processed as usual
+        WP_data = Spec.ReadRun(WPs, Spec.HeaderLines)
+        Stop_data = Spec.ReadCompact(Stops, Spec.HeaderLines)
+        sat_WP = Spec.CheckSaturation(WP_data)
+        sat_stops = Spec.CheckSaturation(Stop_data)
+        log.append("Saturated Measurement Count\n\t\tCh_B\tCh_A")
+        for idx, curfile in enumerate(sat_WP):
+            log.append("WP " + str(idx) + ":\t\t" + str(curfile[1]) + "\t" + str(curfile[2]))
+        for idx, curfile in enumerate(sat_stops):
+            log.append("Stop " + str(idx) + ":\t\t" + str(curfile[1]) + "\t" + str(curfile[2]))
+        log.append("\n" + str(len(sat_WP)) + " WPs and " + str(len(sat_stops)) + " stops saturated.")
+
+        avg_WP = AverageWPs(Spec, WP_data)
+        WP = StopWPs(Spec, avg_WP, RunBracket(Spec, WP_data, avg_WP, next_WPs, log), Stop_data)
+        norm_Stops = Spec.Normalize(Stop_data)
+        grid, intdata_Stops = Spec.InterpCompact(norm_Stops, avg_WP[consts.int_WL])
+        R = Spec.ReflCompact(intdata_Stops, WP, norm_Stops.dark)
+
+        dt = Spec.GetDateTime(Stop_data[0] if named_by_stop else WP_data[0])
+        filename = Spec.OutputPrefix + dt[consts.date] + "__" + dt[consts.time].replace(':','_') + ".csv"
+        meta = {"datetime": " ".join(dt), "files": Stop_data.files, "headers": Stop_data.headers}
+        wp_cv = np.nan
+        if Spec.QC is not None:
+            meta["qc"] = []
+            wp_cv = Spec.WPStability(WP_data)
+        return TakeStats(Spec, CompactBlocks(Spec, R, grid, Stop_data, qc=meta.get("qc"), wp_cv=wp_cv), meta), filename, "\n".join(log), time.perf_counter() - start, meta
+
+    #When getting data from these, they are formatted as:
+    #    var.data[file index, row index, CH_B_WL/CH_B/CH_A_WL/CH_A]
+    #    var[file index] still returns [header, data] for a single file
+    WP_data = Spec.ReadRun(WPs, Spec.HeaderLines)
+    Stop_data = Spec.ReadRun(Stops, Spec.HeaderLines)
+
+    #Formatted as:
+    #    var[file index][CH_B/CH_A][WL]
+    #    value of var is the WL saturation occurred at
+    sat_WP = Spec.CheckSaturation(WP_data)
+    sat_stops = Spec.CheckSaturation(Stop_data)
+
+    log.append("Saturated Measurement Count\n\t\tCh_B\tCh_A")
+    for idx, curfile in enumerate(sat_WP):
+        log.append("WP " + str(idx) + ":\t\t" + str(curfile[1]) + "\t" + str(curfile[2]))
+    for idx, curfile in enumerate(sat_stops):
+        log.append("Stop " + str(idx) + ":\t\t" + str(curfile[1]) + "\t" + str(curfile[2]))
+    log.append("\n" + str(len(sat_WP)) + " WPs and " + str(len(sat_stops)) + " stops saturated.")
+
+    #WP_data = Spec.RemoveSaturated(WP_data, sat_WP)
+    #Stop_data = Spec.RemoveSaturated(Stop_data, sat_stops)
+
+    #Formatted as:
+    #    var[WL/CH_B/CH_A] = [1 dim array of values]
+    avg_WP = AverageWPs(Spec, WP_data)
+    WP = StopWPs(Spec, avg_WP, RunBracket(Spec, WP_data, avg_WP, next_WPs, log), Stop_data)
+
+    #Dark subtraction / integration time normalization, if configured
+    #Stops are interpolated to the white plates' wavelengths, as their header limits may differ
+    #Formatted as:
+    #    var[file, WL/CH_B/CH_A] = [1 dim array of values]
+    norm_Stops = Spec.Normalize(Stop_data)
+    intdata_Stops = Spec.Interp(norm_Stops, avg_WP[consts.int_WL])
+
+    #Plot all WPs with average
+    #Spec.plot_Averaging(Spec.Interp(WP_data), avg_WP)
+
+    R = Spec.Refl(intdata_Stops, WP, norm_Stops.dark)
+
+    #Quality control: metrics of all stops, rejected stops are written as NaN
+    qc = None
+    if Spec.QC is not None:
+        qc = QualityControl(Spec, Stop_data, R, Spec.WPStability(WP_data))
+        log.append(str(int(qc["rejected"].sum())) + " of " + str(len(qc)) + " stops rejected by quality control.")
+
+    #Plot reflectance for a particular stop
+    #    plot_R_A(Refl data, Stop #)
+    #Spec.plot_R(R,20)
+
+    dt = Spec.GetDateTime(Stop_data[0] if named_by_stop else WP_data[0])
+    filename = Spec.OutputPrefix + dt[consts.date] + "__" + dt[consts.time].replace(':','_') + ".csv"
+    meta = {"datetime": " ".join(dt), "files": Stop_data.files, "headers": Stop_data.headers}
+    if qc is not None:
+        meta["qc"] = [qc]
+    if Spec.Stats is not None:
+        meta["stats"] = Spec.Stats.Take()
+
+    return R, filename, "\n".join(log), time.perf_counter() - start, meta
+
+
+def RunBracket(Spec, WP_data, avg_WP, next_WPs, log):
+    """
+    Calls :func:`WPBracket` if white plates are interpolated in time and the following run is known, noting in **log** when they cannot be.
+
+    :returns: Result of :func:`WPBracket`, or None
+    :rtype: Tuple
+
+    """
+
+    if Spec.WPInterpolation != "time":
+        return None
+    if not next_WPs:
+        log.append("No following white plates, using the run's white plates for all stops.")
+        return None
+    try:
+        return WPBracket(Spec, WP_data, avg_WP, next_WPs)
+    except ValueError as err:
+        log.append("Following white plates not usable (" + str(err) + "), using the run's white plates for all stops.")
+        return None
+
+
+def DerivedTables(Spec):
+    """
+    Lists the tables written alongside the reflectance of each run: spectral indices (see :class:`~BasicProcessing.SpectralIndices`) and sensor bands (see :class:`~BasicProcessing.SensorBands`).
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :returns: Filename suffix, column names and function computing the table from reflectance
+    :rtype: List of (String, List of Strings, Function)
+
+    """
+
+    tables = []
+    if Spec.Indices is not None:
+        tables.append(("indices", Spec.Indices.Names, Spec.Indices.Compute))
+    for name, sensor in Spec.Sensors.items():
+        tables.append((name, sensor.Names, sensor.Resample))
+    return tables
+
+
+def TapTables(R, tables, values):
+    """
+    Computes derived tables (see :func:`DerivedTables`) for reflectance data as it is written.
+
+    :param R: Reflectance values, or iterator of them (as returned from :func:`ProcessRun`)
+    :type R: Array of Floats
+    :param tables: Tables to compute (as returned from :func:`DerivedTables`)
+    :type tables: List
+    :param values: Lists, one per table, that the values computed from each array are added to
+    :type values: List of Lists
+    :returns: **R**, or an iterator yielding the same arrays
+    :rtype: Array of Floats or iterator
+
+    """
+
+    if isinstance(R, np.ndarray):
+        for (suffix, names, func), table in zip(tables, values):
+            table.append(func(R))
+        return R
+
+    def tap():
+        for chunk in R:
+            for (suffix, names, func), table in zip(tables, values):
+                table.append(func(chunk))
+            yield chunk
+    return tap()
+
+
+def init_worker(config_file, stats=False):
+    """
+    Creates the processing object for a pool worker from the configuration file.
+
+    :param config_file: Text file containing input/output configuration
+    :type config_file: String
+    :param stats: Collect stage timing, which is returned with each run's metadata
+    :type stats: Boolean
+
+    """
+
+    global WorkerSpec
+    #Workers are given their files, and opening the catalog would write to it while the main process updates it
+    WorkerSpec = UnispecProcessing(config_file, catalog=False)
+    #Workers only collect; records are written by the main process
+    WorkerSpec.Stats = ProcessingStats() if stats else None
+
+
+def ProcessRun_worker(job):
+    """
+    Calls :func:`ProcessRun` with the worker's processing object.
+
+    :param job: Source directory of the run, followed by the arguments of :func:`ProcessRun` after **Spec**
+    :type job: Tuple
+
+    """
+
+    WorkerSpec.SourcePath = job[0]
+    start = time.perf_counter()
+    R, filename, log, elapsed, meta = ProcessRun(WorkerSpec, *job[1:])
+    if not isinstance(R, np.ndarray):
+        #Generators cannot be sent back to the main process, so the blocks are computed here
+        R = list(R)
+        elapsed = time.perf_counter() - start
+    return R, filename, log, elapsed, meta
+
+
+def LoadState(state_file):
+    """
+    Loads the record of processed runs written by :func:`SaveState`.
+
+    :param state_file: Path of the state file
+    :type state_file: String
+    :returns: Processed runs keyed by the filename of the run's first file
+    :rtype: Dictionary
+
+    """
+
+    if not os.path.isfile(state_file):
+        return {}
+    with open(state_file, "r") as fh:
+        return json.load(fh)
+
+
+def SaveState(state_file, state):
+    """
+    Writes the record of processed runs, replacing the previous file only once the new one is complete.
+
+    :param state_file: Path of the state file
+    :type state_file: String
+    :param state: Processed runs keyed by the filename of the run's first file
+    :type state: Dictionary
+
+    """
+
+    with AtomicFile(state_file) as tmpname:
+        with open(tmpname, "w") as fh:
+            json.dump(state, fh, indent=1, sort_keys=True)
+
+
+def RunSignature(Spec, WPs, Stops):
+    """
+    Summarizes the files of a run so that changes to it can be detected.
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param WPs: White plate files of the run
+    :type WPs: List of Strings
+    :param Stops: Stop files of the run
+    :type Stops: List of Strings
+    :returns: File count and latest modification time of the run's files
+    :rtype: Dictionary
+
+    """
+
+    files = WPs + Stops
+#    Archive records never change once added, so only the file count matters
+    if Spec.Archive is not None:
+        return {"files": len(files), "mtime": 0}
+    if Spec.Catalog is not None:
+        return {"files": len(files), "mtime": Spec.Catalog.LastModified(files)}
+    return {"files": len(files), "mtime": max(os.path.getmtime(os.path.join(Spec.SourcePath, f)) for f in files)}
+
+
+def PrintStats(total):
+    """
+    Prints the time of each stage and the counters collected by :class:`~BasicProcessing.ProcessingStats`.
+
+    :param total: Stages and counters (as returned from :func:`~BasicProcessing.ProcessingStats.Take`)
+    :type total: Dictionary
+
+    """
+
+    print("Stage\t\tWall s\tCPU s\tCalls")
+    for name, stage in sorted(total["stages"].items(), key=lambda item: -item[1]["wall"]):
+        print("%-15s\t%.3f\t%.3f\t%d" % (name, stage["wall"], stage["cpu"], stage["calls"]))
+    print(", ".join(name + " " + str(n) for name, n in sorted(total["counters"].items())))
+
+
+def ProcessAll(Spec, pool=None, state=None, complete_only=False, chunk=None, produced=None):
+    """
+    Lists the source directory and processes its runs, writing one CSV file per run (and tables of spectral indices and sensor bands if configured).
+
+    :param Spec: Configured processing object
+    :type Spec: :class:`~BasicProcessing.UnispecProcessing`
+    :param pool: Process pool (see :func:`init_worker`), or None to process runs in this process
+    :type pool: :class:`multiprocessing.pool.Pool`
+    :param state: Processed runs (as returned from :func:`LoadState`).  If given, only new or changed runs are processed and the state file is updated after each run.
+    :type state: Dictionary
+    :param complete_only: Only process runs that have been closed by the white plates of a following run
+    :type complete_only: Boolean
+    :param chunk: Number of stops to process at a time (see :func:`ProcessRun`), or None to process whole runs.  Cannot be combined with **pool**.
+    :type chunk: Integer
+    :param produced: List that a record of each run processed (run number, output and table files, processing time) is added to
+    :type produced: List
+    :returns: Number of runs processed
+    :rtype: Integer
+
+    """
+
+    run_count, WP_count, stop_count = Spec.GetFileLists()
+    if Spec.Stats is not None:
+        total = Spec.Stats.Take()
+        Spec.Stats.Emit("scan", dict(total, source=Spec.SourcePath, runs=run_count))
+
+    #There must be at least one white plate (the run's own or, if its white plates are missing, the nearest preceding ones) and one stop for a run to produce any useful data, otherwise skip it.
+    runs = [run for run in range(0,run_count) if (WP_count[run] != 0 or Spec.PrevWPs[run]) and (stop_count[run] != 0)]
+    if complete_only:
+        runs = [run for run in runs if run < run_count - 1]
+
+    #With time interpolation a run also depends on the white plates of the following run
+    next_WPs = dict((run, Spec.NextWPs[run] if Spec.WPInterpolation == "time" else []) for run in runs)
+    prev_WPs = dict((run, Spec.PrevWPs[run] if WP_count[run] == 0 else []) for run in runs)
+    #Runs are identified by their first file
+    keys = dict((run, (Spec.WPs[run] + Spec.Stops[run])[0]) for run in runs)
+
+    if state is not None:
+        signatures = dict((run, RunSignature(Spec, Spec.WPs[run] + prev_WPs[run], Spec.Stops[run] + next_WPs[run])) for run in runs)
+        runs = [run for run in runs if state.get(keys[run], {}).get("signature") != signatures[run]]
+        print(str(len(runs)) + " new or changed run(s).")
+
+    jobs = [(Spec.WPs[run], Spec.Stops[run], chunk, next_WPs[run], prev_WPs[run]) for run in runs]
+
+    start = time.perf_counter()
+    if pool is not None:
+        results = pool.imap(ProcessRun_worker, [(Spec.SourcePath,) + job for job in jobs])
+    else:
+        results = (ProcessRun(Spec, *job) for job in jobs)
+
+    for run, (R, filename, log, elapsed, meta) in zip(runs, results):
+        print(log)
+        write_start = time.perf_counter()
+        tables = DerivedTables(Spec)
+        table_values = [[] for table in tables]
+        if tables:
+            R = TapTables(R, tables, table_values)
+        if state is not None and keys[run] in state:
+            #Runs that have changed replace their previous output
+            filename = Spec.WriteOutput(R, Spec.OutputPath, state[keys[run]]["output"].split(":")[-1], overwrite=True, meta=meta)
+        else:
+            filename = Spec.WriteOutput(R, Spec.OutputPath, filename, meta=meta)
+        table_files = []
+        for (suffix, names, func), values in zip(tables, table_values):
+            table_files.append(os.path.splitext(filename.split(":")[-1])[0] + "_" + suffix + ".csv")
+            Spec.WriteTable(np.concatenate(values) if values else np.zeros((0, len(names))), names, Spec.OutputPath, table_files[-1])
+        if "qc" in meta:
+            table_files.append(os.path.splitext(filename.split(":")[-1])[0] + "_qc.csv")
+            Spec.WriteQCReport(np.concatenate(meta["qc"]) if meta["qc"] else np.zeros(0, Spec.QCType), meta["files"], Spec.OutputPath, table_files[-1])
+        print("Run " + str(run) + " processed in %.3f s." % (elapsed + time.perf_counter() - write_start))
+        if produced is not None:
+            produced.append({"run": run, "output": filename, "tables": table_files, "stops": len(Spec.Stops[run]),
+                             "seconds": round(elapsed + time.perf_counter() - write_start, 3)})
+
+        if Spec.Stats is not None:
+            record = ProcessingStats.Merge(Spec.Stats.Take(), meta.pop("stats", {"stages": {}, "counters": {}}))
+            Spec.Stats.Emit("run", dict(record, run=run, output=filename, wall=elapsed + time.perf_counter() - write_start))
+            ProcessingStats.Merge(total, record)
+
+        if state is not None:
+            state[keys[run]] = {"signature": signatures[run], "output": filename}
+            SaveState(Spec.StateFile, state)
+
+    print("Processed " + str(len(runs)) + " run(s) in %.3f s." % (time.perf_counter() - start))
+    if Spec.Stats is not None:
+        Spec.Stats.Emit("summary", dict(total, runs=len(runs), wall=time.perf_counter() - start))
+        PrintStats(total)
+    return len(runs)
+
+
+def main(argv=None):
     """
     Main function for generating CSV files from a directory of Unispec data.
-    
+
     Input/Output paths, white plate identifier string and header size should be specified in "config.txt".
-    
+
     Outputs one CSV file per tram run, where each row represets a stop and columns are wavelengths interpolated to 1nm.
-    
+
+    With *--workers N* runs are processed by a pool of N processes.  Results are returned in run order and written by this process only, so output filenames are the same as for sequential processing.
+
+    With *--chunk STOPS* stops are read, converted and written a few at a time, so memory use does not grow with the size of a run.
+
+    With *--stats FILE* (or *StatsFile* in the configuration file) the time of each processing stage and counts of files and bytes are written to FILE as JSON lines: one record for the directory scan, one per run and a summary.  *--profile FILE* saves a cProfile dump of this process.
+
+    With *--incremental* runs already recorded in the state file (:data:`~BasicProcessing.UnispecProcessing.StateFile`) are skipped unless their files have changed, in which case their previous output is replaced.  *--watch SECONDS* repeats incremental processing at the given interval, and only processes a run once the white plates that close it have been recorded.
+
     """
 
+    parser = argparse.ArgumentParser(description="Generate reflectance CSV files from a directory of Unispec data.")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes used to process runs (default 1)")
+    parser.add_argument("--incremental", action="store_true", help="only process runs that are new or changed since the last run")
+    parser.add_argument("--watch", type=float, metavar="SECONDS", help="poll the source directory for completed runs at this interval (implies --incremental)")
+    parser.add_argument("--chunk", type=int, metavar="STOPS", help="read and write stops this many at a time to bound memory use")
+    parser.add_argument("--stats", metavar="FILE", help="append per-stage timing of each run to FILE as JSON lines")
+    parser.add_argument("--profile", metavar="FILE", help="save a cProfile dump of the main process to FILE")
+    args = parser.parse_args(argv)
+    if args.chunk and args.workers > 1:
+        parser.error("--chunk cannot be combined with --workers")
+
     path = str(os.path.realpath('.'))
     # Edited by SPS on 11/06/2015
     #Spec = UnispecProcessing(path + r'\config.txt')
-    Spec = UnispecProcessing(os.path.join(path, "config.txt"))
-    
-    run_count, WP_count, stop_count = Spec.GetFileLists()
-    
-    for run in range(0,run_count):
-        
-        if (WP_count[run] == 0) or (stop_count[run] == 0):
-            continue
-    
-        WP_data = [[[None], [None]] for item in range(0,WP_count[run])]
-        Stop_data = [[[None], [None]] for item in range(0,stop_count[run])]
-        sat = [[None], [None]]
-        
-        
-        #When getting data from these, they are formatted as:
-        #    var[file index][header/data][row index][CH_B_WL/CH_B/CH_A_WL/CH_A]
-        WP_data = Spec.ReadFiles(Spec.WPs[run], Spec.HeaderLines)
-        Stop_data = Spec.ReadFiles(Spec.Stops[run], Spec.HeaderLines)
-        
-        #Formatted as:
-        #    var[file index][CH_B/CH_A][WL]
-        #    value of var is the WL saturation occurred at
-        sat_WP = Spec.CheckSaturation(WP_data)
-        sat_stops = Spec.CheckSaturation(Stop_data)
-        
-        print("Saturated Measurement Count\n\t\tCh_B\tCh_A")
-        for idx, curfile in enumerate(sat_WP):
-            print("WP " + str(idx) + ":\t\t" + str(curfile[1]) + "\t" + str(curfile[2])) 
-        for idx, curfile in enumerate(sat_stops):
-            print("Stop " + str(idx) + ":\t\t" + str(curfile[1]) + "\t" + str(curfile[2]))        
-        print("\n" + str(len(sat_WP)) + " WPs and " + str(len(sat_stops)) + " stops saturated.")
-        
-        #Spec.RemoveSaturated(WP_data, sat_WP)
-        #Spec.RemoveSaturated(Stop_data, sat_stops)
-        
-        #Formatted as:
-        #    var[file, WL/CH_B/CH_A] = [1 dim array of values]
-        intdata_WPs = Spec.Interp(WP_data)
-        intdata_Stops = Spec.Interp(Stop_data)
-        
-        avg_WP = Spec.AvgWPs(intdata_WPs)
-        
-        #Plot all WPs with average
-        #Spec.plot_Averaging(intdata_WPs, avg_WP)
-        
-        R = Spec.Refl(intdata_Stops, avg_WP)
-        
-        #Plot reflectance for a particular stop
-        #    plot_R_A(Refl data, Stop #)
-        #Spec.plot_R(R,20)
-        
-        dt = Spec.GetDateTime(WP_data[0])
-        
-        Spec.WriteOutput(R, Spec.OutputPath, Spec.OutputPrefix + dt[consts.date] + "__" + dt[consts.time].replace(':','_') + ".csv")
-        
-        
+    config_file = os.path.join(path, "config.txt")
+    Spec = UnispecProcessing(config_file)
+    if args.stats:
+        Spec.Stats = ProcessingStats(args.stats)
+
+    state = None
+    if args.incremental or args.watch:
+        state = LoadState(Spec.StateFile)
+
+    pool = None
+    if args.workers > 1:
+        import multiprocessing
+
+        pool = multiprocessing.Pool(args.workers, init_worker, (config_file, Spec.Stats is not None))
+
+    profile = None
+    if args.profile:
+        import cProfile
+
+        profile = cProfile.Profile()
+        profile.enable()
+
+    try:
+        if args.watch:
+            while True:
+                ProcessAll(Spec, pool, state, complete_only=True, chunk=args.chunk)
+                time.sleep(args.watch)
+        else:
+            ProcessAll(Spec, pool, state, chunk=args.chunk)
+    except KeyboardInterrupt:
+        print("Stopped.")
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(args.profile)
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
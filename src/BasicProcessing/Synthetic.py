@@ -0,0 +1,170 @@
+'''
+Generates synthetic Unispec-DC files in the format of example_data.
+
+Run with "python Synthetic.py DIRECTORY [--runs N] [--wps N] [--stops N]
+[--rows N] [--saturation FRACTION] [--seed N]".  Each run is a set of white
+plates followed by stops, with file names, header lines and spectrum layout
+(including the system parameters in the last 8 rows of Ch B) matching the
+files written by the logging script, so they can be processed by Main.py and
+used by Benchmark.py.
+'''
+import argparse
+import datetime
+import os.path
+
+import numpy as np
+
+
+#: Header written to every file, filled in by :func:`WriteSpu`
+HeaderFormat = ('"Remarks:    Synthetic data generated by Synthetic.py"\n'
+                '"Time:    %s"\n'
+                '"Limits_Ch_A:     %.1f - %.1f\tLimits_Ch_B:     %.1f - %.1f"\n'
+                '"Environment:    DegreesC=%.3f BattV=9.682 A1=1 A2=3 A3=12 A4=15"\n'
+                '"Minimum CH A:    %.1fnm\t%d\tMinimum CH B:    %.1fnm\t%d"\n'
+                '"Maximum CH A:    %.1fnm\t%d\tMaximum CH B:    %.1fnm\t%d"\n'
+                '"Integration:    %.1f ms"\n'
+                '"Number Scans:    20"\n'
+                '"GPS:     LAT= Ukn     LON=Ukn     ALT=Ukn     Updated=Ukn"\n'
+                '"Station#: %03d"\n'
+                '"Ch_B_WL    Ch_B_Value    Ch_A_WL    Ch_A_Value"\n')
+
+
+def Wavelengths(rows=256):
+    """
+    Returns the wavelength axes of both channels, spanning the range of the example data.
+
+    :param rows: Rows per file
+    :type rows: Integer
+    :returns: Ch B and Ch A wavelengths
+    :rtype: Array of Floats, Array of Floats
+
+    """
+    return np.round(np.linspace(302.0, 1143.5, rows), 1), np.round(np.linspace(292.6, 1139.4, rows), 1)
+
+
+def WriteSpu(filename, when, station, counts_B, counts_A, integration=28.0, temperature=11.5):
+    """
+    Writes a single Unispec file.  The last 8 rows of Ch B hold system parameters instead of counts, as in real files.
+
+    :param filename: File to write
+    :type filename: String
+    :param when: Time of the measurement
+    :type when: datetime.datetime
+    :param station: Station number (0 for white plates)
+    :type station: Integer
+    :param counts_B: Ch B counts for each row
+    :type counts_B: Array of Integers
+    :param counts_A: Ch A counts for each row
+    :type counts_A: Array of Integers
+    :param integration: Integration time in ms
+    :type integration: Float
+    :param temperature: Temperature in degrees C
+    :type temperature: Float
+
+    """
+    WL_B, WL_A = Wavelengths(len(counts_B))
+    counts_B = np.array(counts_B, dtype=np.int64)
+    counts_B[-8:] = [1, 3, 12, 27, 50, 211, 294, 993][:min(8, len(counts_B))]
+    valid_B = counts_B[:-8]
+    header = HeaderFormat % (when.strftime("%Y-%m-%d  %H:%M:%S"),
+                             WL_A[0], WL_A[-1], WL_B[0], WL_B[-9],
+                             temperature,
+                             WL_A[np.argmin(counts_A)], np.min(counts_A), WL_B[np.argmin(valid_B)], np.min(valid_B),
+                             WL_A[np.argmax(counts_A)], np.max(counts_A), WL_B[np.argmax(valid_B)], np.max(valid_B),
+                             integration, station)
+
+    values = np.empty((len(counts_B), 4))
+    values[:, 0] = WL_B
+    values[:, 1] = counts_B
+    values[:, 2] = WL_A
+    values[:, 3] = counts_A
+    with open(filename, "w") as fh:
+        fh.write(header)
+        fh.write(("%.1f\t%d\t%.1f\t%d\n" * len(values)) % tuple(values.ravel().tolist()))
+
+
+def Spectrum(WL, peak, rng, noise=0.01):
+    """
+    Returns smooth counts with a single broad peak and some noise, limited to the 16 bit range.
+
+    :param WL: Wavelengths
+    :type WL: Array of Floats
+    :param peak: Counts at the peak
+    :type peak: Float
+    :param rng: Random number generator
+    :type rng: numpy.random.Generator
+    :param noise: Relative noise level
+    :type noise: Float
+    :rtype: Array of Integers
+
+    """
+    shape = np.exp(-((WL - 560.0) / 260.0) ** 2) + 0.02
+    return np.clip(np.rint(peak * shape * (1 + noise * rng.standard_normal(len(WL)))), 0, 65535).astype(np.int64)
+
+
+def GenerateRuns(path, runs=3, wps=3, stops=100, rows=256, saturation=0.0, seed=0, start=datetime.datetime(2015, 6, 25, 0, 2, 26)):
+    """
+    Writes runs of synthetic files to a directory.
+
+    :param path: Directory to write to (created if needed)
+    :type path: String
+    :param runs: Number of runs
+    :type runs: Integer
+    :param wps: White plates per run
+    :type wps: Integer
+    :param stops: Stops per run
+    :type stops: Integer
+    :param rows: Rows per file
+    :type rows: Integer
+    :param saturation: Fraction of files with a saturated section in Ch A
+    :type saturation: Float
+    :param seed: Seed of the random number generator
+    :type seed: Integer
+    :param start: Time of the first file
+    :type start: datetime.datetime
+    :returns: Names of the files written
+    :rtype: List of Strings
+
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    rng = np.random.default_rng(seed)
+    WL_B, WL_A = Wavelengths(rows)
+
+    files = []
+    when = start
+    for run in range(0, runs):
+        for station in [0] * wps + list(range(1, stops + 1)):
+            if station == 0:
+                counts_B, counts_A = Spectrum(WL_B, 27000, rng), Spectrum(WL_A, 30000, rng)
+            else:
+                counts_B, counts_A = Spectrum(WL_B, 27000, rng), Spectrum(WL_A, 30000 * rng.uniform(0.05, 0.6), rng, 0.03)
+            if rng.random() < saturation:
+                peak = np.argmax(counts_A)
+                counts_A[max(0, peak - rows // 32):peak + rows // 32] = 65535
+
+            name = "Uni_" + when.strftime("%Y-%m-%d__%H_%M_%S") + "_%03d.spu" % station
+            WriteSpu(os.path.join(path, name), when, station, counts_B, counts_A)
+            files.append(name)
+            when += datetime.timedelta(seconds=1 if station == 0 else 44)
+        when += datetime.timedelta(hours=1)
+    return files
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write synthetic Unispec files.")
+    parser.add_argument("path", help="directory to write to")
+    parser.add_argument("--runs", type=int, default=3, help="number of runs (default 3)")
+    parser.add_argument("--wps", type=int, default=3, help="white plates per run (default 3)")
+    parser.add_argument("--stops", type=int, default=100, help="stops per run (default 100)")
+    parser.add_argument("--rows", type=int, default=256, help="rows per file (default 256)")
+    parser.add_argument("--saturation", type=float, default=0.0, metavar="FRACTION", help="fraction of files with saturated values (default 0)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default 0)")
+    args = parser.parse_args(argv)
+
+    files = GenerateRuns(args.path, args.runs, args.wps, args.stops, args.rows, args.saturation, args.seed)
+    print("Wrote " + str(len(files)) + " files to " + args.path + ".")
+
+
+if __name__ == "__main__":
+    main()